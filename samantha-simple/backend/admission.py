@@ -0,0 +1,148 @@
+"""聊天请求的准入控制
+
+- 每个用户一个令牌桶，超过速率直接返回429
+- 全局并发上限 + 有界等待队列，队列满或等待超时返回503
+- 两条通道：短消息走快速通道，不会排在长回复生成后面
+"""
+import asyncio
+import logging
+import math
+from collections import OrderedDict, deque
+
+from cache import normalize_message
+from resilience import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """请求被拒绝，status_code为HTTP状态码，retry_after为建议的重试秒数"""
+
+    def __init__(self, status_code: int, retry_after: float, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.detail = detail
+
+
+class _Lane:
+    """并发上限 + 有界FIFO等待队列"""
+
+    def __init__(self, name: str, limit: int, max_queue: int):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._waiters = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, timeout: float):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise AdmissionRejected(503, timeout, "服务繁忙，请稍后再试")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            # 槽位由release()直接转交，in_flight不变
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self._abandon(future)
+            raise AdmissionRejected(503, timeout, "排队超时，请稍后再试")
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+
+    def _abandon(self, future: asyncio.Future):
+        if future.done() and not future.cancelled():
+            # 已经拿到了转交的槽位，还回去
+            self.release()
+        else:
+            future.cancel()
+            if future in self._waiters:
+                self._waiters.remove(future)
+
+    def release(self):
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+class Ticket:
+    """已准入的请求，处理完后调用release()；重复调用无副作用"""
+
+    def __init__(self, lane: _Lane):
+        self._lane = lane
+
+    def release(self):
+        if self._lane is not None:
+            self._lane.release()
+            self._lane = None
+
+
+class AdmissionController:
+    """按用户限速并限制全局并发"""
+
+    def __init__(self, user_rate_per_minute: float = 30, user_burst: int = 10,
+                 max_concurrent: int = 64, max_queue: int = 256, max_wait: float = 10.0,
+                 fast_concurrent: int = 16, fast_max_chars: int = 20, max_users: int = 100000):
+        self.user_rate = user_rate_per_minute / 60
+        self.user_burst = user_burst
+        self.max_wait = max_wait
+        self.fast_max_chars = fast_max_chars
+        self.max_users = max_users
+        self.lanes = {
+            "normal": _Lane("normal", max_concurrent, max_queue),
+            "fast": _Lane("fast", fast_concurrent, max_queue),
+        }
+        self._buckets = OrderedDict()
+        self.rejected = {429: 0, 503: 0}
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+            self._buckets[user_id] = bucket
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket
+
+    def lane_for(self, message: str) -> str:
+        """短消息（问候、确认等）走快速通道"""
+        return "fast" if len(normalize_message(message)) <= self.fast_max_chars else "normal"
+
+    async def acquire(self, user_id: int, message: str) -> Ticket:
+        """准入一个请求，被拒绝时抛出AdmissionRejected"""
+        if self.user_rate > 0:
+            wait = self._bucket(user_id).try_acquire()
+            if wait > 0:
+                self.rejected[429] += 1
+                raise AdmissionRejected(429, wait, "请求过于频繁，请稍后再试")
+
+        lane = self.lanes[self.lane_for(message)]
+        try:
+            await lane.acquire(self.max_wait)
+        except AdmissionRejected as e:
+            self.rejected[503] += 1
+            logger.warning(f"{lane.name} 通道拒绝请求: {e.detail}")
+            raise
+        return Ticket(lane)
+
+    def stats(self) -> dict:
+        return {
+            "lanes": {
+                name: {"in_flight": lane.in_flight, "queued": lane.queued, "limit": lane.limit}
+                for name, lane in self.lanes.items()
+            },
+            "rejected": {str(code): count for code, count in self.rejected.items()},
+        }
@@ -0,0 +1,83 @@
+"""情感分析微批处理
+
+在一个很短的时间窗口内收集待分析的文本，凑成一批后用一次
+结构化输出请求分析，再把结果分发给各自的调用方。
+"""
+import asyncio
+import json
+import logging
+
+from prompts import PromptRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class EmotionBatcher:
+    """把并发的情感分析请求合并成批量请求"""
+
+    def __init__(self, llm, max_batch: int = 32, max_wait: float = 0.005,
+                 prompts: PromptRegistry = None):
+        self.llm = llm
+        self.prompts = prompts if prompts is not None else PromptRegistry()
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+
+    async def classify(self, text: str) -> str:
+        """返回文本的情感标签；批量请求失败时抛出异常"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        # 调用方已取消的请求不再发送
+        batch = [(text, future) for text, future in batch if not future.done()]
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            contents, gen_config = await self.prompts.build(
+                "emotion_batch", texts=json.dumps(texts, ensure_ascii=False)
+            )
+            response = await self.llm.generate(contents, generation_config=gen_config)
+            labels = json.loads(response.text)
+            if not isinstance(labels, list) or len(labels) != len(texts):
+                raise ValueError(f"批量结果数量不符: 期望 {len(texts)}，实际 {len(labels)}")
+        except Exception as e:
+            logger.error(f"批量情感分析失败 ({len(texts)} 条): {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        results = dict(zip(texts, labels))
+        logger.info(f"批量情感分析完成: {len(batch)} 个请求，{len(texts)} 条文本")
+        for text, future in batch:
+            if not future.done():
+                future.set_result(str(results[text]))
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
@@ -0,0 +1,214 @@
+"""批量处理
+
+离线重放和回填：一次提交成千上万条消息，用有限的并发跑同一条处理流程
+（共享回复缓存和Gemini客户端），结果按完成顺序逐条返回。
+
+每个任务有一个job_id，已完成的结果追加到本地的进度日志。
+同一个job_id再次提交时，日志里已有的条目直接返回，不再重复处理。
+结果先批量写入数据库，再记入日志，所以崩溃后最多重做最后一批。
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+
+from metrics import record_error, track
+from pipeline import FALLBACK_RESPONSE
+from tracing import span
+
+try:
+    import fcntl
+except ImportError:  # Windows：不做跨进程互斥
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+BATCH_TASKS = ("chat", "emotion")
+JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+
+class JobBusy(Exception):
+    """同一个job_id正在被另一个请求处理"""
+
+
+class BatchJournal:
+    """按job_id保存已完成结果的追加日志（每行一个JSON）"""
+
+    def __init__(self, directory: str = "batch_jobs"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, job_id: str) -> str:
+        if not JOB_ID_PATTERN.match(job_id):
+            raise ValueError(f"无效的job_id: {job_id}")
+        return os.path.join(self.directory, f"{job_id}.ndjson")
+
+    def open(self, job_id: str):
+        """打开日志并加独占锁，返回 (文件, 已完成的结果{id: 结果})"""
+        f = open(self.path(job_id), "a+", encoding="utf-8")
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                raise JobBusy(job_id)
+        f.seek(0)
+        done = {}
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # 崩溃时写了一半的最后一行
+                continue
+            done[result["id"]] = result
+        return f, done
+
+    @staticmethod
+    def append(f, results: list[dict]):
+        f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in results))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class BatchRunner:
+    """用固定数量的worker处理一批消息"""
+
+    def __init__(self, pipeline, store, journal: BatchJournal, concurrency: int = 8,
+                 flush_size: int = 50, flush_interval: float = 1.0):
+        self.pipeline = pipeline
+        self.store = store
+        self.journal = journal
+        self.concurrency = concurrency
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._jobs = set()
+
+    async def run(self, job_id: str, items: list[dict], task: str = "chat",
+                  save: bool = True, concurrency: int = None):
+        """先产出 ("start", 概况)，再逐条产出 ("result" | "error", 数据)，最后产出 ("done", 汇总)
+
+        items 中每条包含 id、message、user_id，可选 history。
+        """
+        if task not in BATCH_TASKS:
+            raise ValueError(f"未知的批量任务: {task}")
+        # 同一进程内的重复提交；跨进程由日志文件锁保证
+        if job_id in self._jobs:
+            raise JobBusy(job_id)
+        self._jobs.add(job_id)
+        try:
+            f, done = await asyncio.to_thread(self.journal.open, job_id)
+        except BaseException:
+            self._jobs.discard(job_id)
+            raise
+
+        started = time.monotonic()
+        counts = {"total": len(items), "resumed": 0, "completed": 0, "failed": 0}
+        queue = asyncio.Queue()
+        results = asyncio.Queue()
+        workers = []
+        pending = []
+        try:
+            resumed = []
+            for item in items:
+                result = done.get(item["id"])
+                if result is not None and result.get("task") == task:
+                    resumed.append(result)
+                else:
+                    queue.put_nowait(item)
+            counts["resumed"] = len(resumed)
+            yield "start", {"job_id": job_id, "total": len(items), "resumed": len(resumed)}
+            for result in resumed:
+                yield "result", {**result, "resumed": True}
+
+            workers = [
+                asyncio.create_task(self._work(queue, results, task))
+                for _ in range(min(concurrency or self.concurrency, queue.qsize()))
+            ]
+            remaining = queue.qsize()
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.flush_interval
+            while remaining:
+                try:
+                    kind, data = await asyncio.wait_for(results.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    kind = None
+                else:
+                    remaining -= 1
+                    if kind == "error":
+                        counts["failed"] += 1
+                        yield "error", data
+                    else:
+                        pending.append(data)
+
+                if pending and (len(pending) >= self.flush_size or not remaining
+                                or loop.time() >= deadline):
+                    batch, pending = pending, []
+                    try:
+                        await self._commit(f, batch, save and task == "chat")
+                    except Exception as e:
+                        # 没有记入日志，重新提交时会再处理
+                        logger.error(f"保存批量结果失败 ({job_id}, {len(batch)} 条): {e}")
+                        counts["failed"] += len(batch)
+                        for data in batch:
+                            yield "error", {"id": data["id"], "error": f"保存失败: {e}"}
+                    else:
+                        counts["completed"] += len(batch)
+                        for data in batch:
+                            yield "result", {**data, "resumed": False}
+                if loop.time() >= deadline:
+                    deadline = loop.time() + self.flush_interval
+        finally:
+            for worker in workers:
+                worker.cancel()
+            # 客户端断开时请求已被取消，收尾放到独立的任务里，保证一定执行完
+            await asyncio.shield(asyncio.ensure_future(
+                self._finish(job_id, f, pending, save and task == "chat")
+            ))
+
+        elapsed = time.monotonic() - started
+        logger.info(f"批量任务 {job_id} 完成: {counts}，耗时 {elapsed:.1f}s")
+        yield "done", {"job_id": job_id, **counts, "elapsed": round(elapsed, 3)}
+
+    async def _work(self, queue: asyncio.Queue, results: asyncio.Queue, task: str):
+        while not queue.empty():
+            item = queue.get_nowait()
+            try:
+                with track("batch_item"), span("batch_item", task=task):
+                    results.put_nowait(("result", await self._process(item, task)))
+            except Exception as e:
+                record_error("batch_item")
+                results.put_nowait(("error", {"id": item["id"], "error": str(e)}))
+
+    async def _process(self, item: dict, task: str) -> dict:
+        result = {"id": item["id"], "user_id": item["user_id"], "task": task}
+        if task == "emotion":
+            result["emotion"] = await self.pipeline.analyze_emotion(item["message"])
+            return result
+        emotion, response = await self.pipeline.run(item["message"], item.get("history") or "")
+        if response == FALLBACK_RESPONSE:
+            # 兜底回复不算完成，不写库也不记入日志，重新提交时会再试
+            raise RuntimeError("回复生成失败")
+        result.update(message=item["message"], emotion=emotion, response=response)
+        return result
+
+    async def _finish(self, job_id: str, f, pending: list[dict], save: bool):
+        """保存已经算完但还没提交的结果，再释放任务"""
+        try:
+            if pending:
+                await self._commit(f, pending, save)
+        except Exception as e:
+            logger.error(f"保存批量结果失败 ({job_id}): {e}")
+        finally:
+            f.close()
+            self._jobs.discard(job_id)
+
+    async def _commit(self, f, batch: list[dict], save: bool):
+        """先写库，再记日志"""
+        if save:
+            with track("db_save"):
+                await self.store.save_conversations([
+                    (r["user_id"], r["message"], r["response"], r["emotion"]) for r in batch
+                ])
+        await asyncio.to_thread(BatchJournal.append, f, batch)
@@ -0,0 +1,178 @@
+"""回复缓存
+
+缓存情感分析和回复生成的结果。键由归一化后的消息和影响结果的
+其它输入（情感、prompt版本）组成，同一个prompt只调用一次Gemini。
+情感分析只看消息本身，总是可以缓存；回复只缓存不带对话历史的请求
+（见 ChatPipeline._response_scope）。
+可选按相似度命中近似重复的消息。默认存放在进程内存中（LRU + TTL），
+也可以换成Redis让多个worker共享。
+"""
+import hashlib
+import json
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+_SPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCT = "!！?？.。~～,，、 "
+
+
+def normalize_message(text: str) -> str:
+    """统一全半角、大小写和空白，去掉结尾的标点"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _SPACE_RE.sub(" ", text).strip()
+    return text.rstrip(_TRAILING_PUNCT) or text
+
+
+def _digest(*parts) -> str:
+    raw = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class InMemoryCacheBackend:
+    """进程内LRU缓存，每项带过期时间"""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+
+    async def get(self, key: str):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value, ttl: float):
+        self._items[key] = (time.monotonic() + ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class RedisCacheBackend:
+    """Redis共享缓存，多个worker之间共享命中，需要安装 redis"""
+
+    def __init__(self, url: str, prefix: str = "samantha:cache:"):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key: str):
+        raw = await self.client.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    async def set(self, key: str, value, ttl: float):
+        await self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), ex=int(ttl))
+
+
+class ResponseCache:
+    """带命中统计的结果缓存"""
+
+    def __init__(self, backend, ttl: float = 3600, similarity_threshold: float = None,
+                 embedder=None, max_vectors: int = 2000):
+        self.backend = backend
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.embedder = embedder if similarity_threshold is not None else None
+        self.hits = defaultdict(int)
+        self.near_hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+        # 近似匹配用的向量环形缓冲，scope相同的记录之间才比较
+        if self.embedder is not None:
+            self._vectors = np.zeros((max_vectors, self.embedder.dim), dtype=np.float32)
+            self._vector_scopes = np.full(max_vectors, -1, dtype=np.int64)
+            self._vector_keys = [None] * max_vectors
+            self._next_slot = 0
+
+    @staticmethod
+    def _scope_id(kind: str, scope) -> int:
+        return int(_digest(kind, *scope)[:15], 16)
+
+    async def _embed(self, normalized: str) -> np.ndarray:
+        return (await self.embedder.embed([normalized]))[0]
+
+    async def get(self, kind: str, message: str, *scope):
+        """按 (kind, 消息, scope) 查找，未命中返回None"""
+        normalized = normalize_message(message)
+        value = await self.backend.get(_digest(kind, normalized, *scope))
+        if value is not None:
+            self.hits[kind] += 1
+            record_cache(kind, "hit")
+            return value
+
+        if self.embedder is not None:
+            key = await self._near_key(kind, normalized, scope)
+            if key is not None:
+                value = await self.backend.get(key)
+                if value is not None:
+                    self.near_hits[kind] += 1
+                    record_cache(kind, "near_hit")
+                    return value
+
+        self.misses[kind] += 1
+        record_cache(kind, "miss")
+        return None
+
+    async def _near_key(self, kind: str, normalized: str, scope):
+        mask = self._vector_scopes == self._scope_id(kind, scope)
+        if not mask.any():
+            return None
+        scores = np.where(mask, self._vectors @ await self._embed(normalized), -1.0)
+        best = int(scores.argmax())
+        if scores[best] >= self.similarity_threshold:
+            return self._vector_keys[best]
+        return None
+
+    async def set(self, kind: str, message: str, *scope, value):
+        """写入缓存"""
+        normalized = normalize_message(message)
+        key = _digest(kind, normalized, *scope)
+        await self.backend.set(key, value, self.ttl)
+
+        if self.embedder is not None:
+            slot = self._next_slot
+            self._vectors[slot] = await self._embed(normalized)
+            self._vector_scopes[slot] = self._scope_id(kind, scope)
+            self._vector_keys[slot] = key
+            self._next_slot = (slot + 1) % len(self._vector_keys)
+
+    def stats(self) -> dict:
+        """命中统计"""
+        kinds = set(self.hits) | set(self.near_hits) | set(self.misses)
+        by_kind = {}
+        for kind in sorted(kinds):
+            hits = self.hits[kind] + self.near_hits[kind]
+            total = hits + self.misses[kind]
+            by_kind[kind] = {
+                "hits": self.hits[kind],
+                "near_hits": self.near_hits[kind],
+                "misses": self.misses[kind],
+                "hit_ratio": hits / total if total else 0.0,
+            }
+        hits = sum(self.hits.values()) + sum(self.near_hits.values())
+        total = hits + sum(self.misses.values())
+        return {
+            "hits": hits,
+            "misses": sum(self.misses.values()),
+            "hit_ratio": hits / total if total else 0.0,
+            "by_kind": by_kind,
+        }
+
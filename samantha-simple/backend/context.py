@@ -0,0 +1,103 @@
+"""对话上下文
+
+为每个用户在内存中维护最近几轮对话（环形缓冲），首次访问时从数据库加载。
+拼好的历史文本按token预算裁剪并缓存，新的一轮只追加到末尾，
+超出预算时从头部截掉最旧的几轮，不需要整体重建。
+
+多个worker进程时，每个进程的缓冲看不到其他进程处理的对话，
+这时设置 reload=True，每次请求都从数据库重新加载最近几轮。
+"""
+import logging
+import re
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+_CJK_RE = re.compile(r"[一-鿿　-〿＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中文约每字一个token，其余约每4个字符一个token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def render_turn(message: str, response: str) -> str:
+    return f"用户：{message}\nSamantha：{response}\n"
+
+
+class _UserContext:
+    """单个用户的最近对话及缓存的拼接结果"""
+
+    def __init__(self, max_turns: int):
+        # 每项为 (渲染后的文本, token数)
+        self.turns = deque(maxlen=max_turns)
+        self.text = ""
+        self.tokens = 0
+
+    def append(self, turn: str, token_budget: int):
+        tokens = estimate_tokens(turn)
+        if len(self.turns) == self.turns.maxlen:
+            self._drop_oldest()
+        self.turns.append((turn, tokens))
+        self.text += turn
+        self.tokens += tokens
+        while self.tokens > token_budget and self.turns:
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        turn, tokens = self.turns.popleft()
+        self.text = self.text[len(turn):]
+        self.tokens -= tokens
+
+
+class ContextAssembler:
+    """按用户组装最近的对话历史"""
+
+    def __init__(self, store, max_turns: int = 20, token_budget: int = 800,
+                 max_users: int = 10000, reload: bool = False):
+        self.store = store
+        self.reload = reload
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.max_users = max_users
+        self._users = OrderedDict()
+
+    def _load(self, rows: list[dict]) -> _UserContext:
+        ctx = _UserContext(self.max_turns)
+        for row in reversed(rows):
+            ctx.append(render_turn(row["message"], row["response"]), self.token_budget)
+        return ctx
+
+    async def _get(self, user_id: int) -> _UserContext:
+        if self.reload:
+            # 不缓存：其他进程写入的对话也要看到
+            return self._load(await self.store.get_history(user_id, self.max_turns))
+
+        ctx = self._users.get(user_id)
+        if ctx is not None:
+            self._users.move_to_end(user_id)
+            return ctx
+
+        rows = await self.store.get_history(user_id, self.max_turns)
+        ctx = self._users.get(user_id)
+        if ctx is None:
+            # 并发请求可能已经加载过，只有第一个加载结果生效
+            ctx = self._load(rows)
+            self._users[user_id] = ctx
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return ctx
+
+    async def build(self, user_id: int) -> str:
+        """返回可直接拼入prompt的历史文本，没有历史时返回空字符串"""
+        ctx = await self._get(user_id)
+        if not ctx.text:
+            return ""
+        return f"最近的对话：\n{ctx.text}\n"
+
+    def append(self, user_id: int, message: str, response: str):
+        """记录新的一轮对话；用户不在内存中时跳过，下次访问会从数据库加载"""
+        ctx = self._users.get(user_id)
+        if ctx is not None:
+            ctx.append(render_turn(message, response), self.token_budget)
@@ -0,0 +1,160 @@
+"""本地情感分类器
+
+基于中英文情感词典的打分器，不依赖模型和网络。
+文本先切成英文单词和中文1~4字片段，查表得到词典索引，
+再用一次矩阵乘法算出五种情感的得分。
+"""
+import re
+
+import numpy as np
+
+EMOTIONS = ("happy", "sad", "angry", "calm", "neutral")
+
+# 情感词典：词 -> 情感权重。否定短语给原情感负权重，抵消被包含的正向词
+LEXICON = {
+    "happy": [
+        "开心", "高兴", "快乐", "幸福", "太好了", "哈哈", "嘻嘻", "棒", "喜欢", "爱你",
+        "兴奋", "激动", "满意", "感谢", "谢谢", "好玩", "有趣", "期待", "顺利", "成功",
+        "赞", "耶", "愉快", "美好", "欣喜", "庆祝", "笑",
+        "happy", "glad", "great", "awesome", "love", "excited", "wonderful", "amazing",
+        "thanks", "thank", "fun", "yay", "joy", "fantastic", "good", "nice", "cool", "lol",
+    ],
+    "sad": [
+        "难过", "伤心", "悲伤", "哭", "痛苦", "失望", "孤独", "寂寞", "沮丧", "郁闷",
+        "想念", "失落", "心痛", "绝望", "累", "好累", "崩溃", "委屈", "遗憾", "低落",
+        "不开心", "不高兴", "不快乐", "难受", "心碎", "抑郁",
+        "sad", "unhappy", "cry", "crying", "lonely", "depressed", "miss", "hurt",
+        "tired", "upset", "disappointed", "heartbroken", "sorry", "lost", "alone",
+    ],
+    "angry": [
+        "生气", "愤怒", "气死", "讨厌", "烦", "烦死", "恼火", "可恶", "火大", "受够",
+        "混蛋", "滚", "恨", "气愤", "不爽", "抓狂", "垃圾", "闭嘴", "凭什么",
+        "angry", "mad", "hate", "annoyed", "annoying", "furious", "pissed", "stupid",
+        "sucks", "damn", "terrible", "worst", "ridiculous",
+    ],
+    "calm": [
+        "平静", "安静", "放松", "轻松", "舒服", "舒适", "安心", "宁静", "淡定", "悠闲",
+        "休息", "冷静", "还好", "慢慢", "惬意", "散步",
+        "calm", "relax", "relaxed", "relaxing", "peaceful", "quiet", "chill", "fine",
+        "okay", "ok", "rest", "easy", "serene",
+    ],
+    "neutral": [
+        "请问", "什么", "怎么", "为什么", "哪里", "多少", "是否", "如何", "吗",
+        "what", "how", "why", "where", "when", "which", "who",
+    ],
+}
+# neutral词（疑问词）只说明这是一个问题，不如情感词确定，权重减半
+NEUTRAL_WEIGHT = 0.5
+
+# 否定短语：对被否定的情感给负权重
+NEGATIONS = {
+    "不开心": {"happy": -1.0},
+    "不高兴": {"happy": -1.0},
+    "不快乐": {"happy": -1.0},
+    "不喜欢": {"happy": -1.0, "angry": 0.5},
+    "不生气": {"angry": -1.0, "calm": 0.5},
+    "不难过": {"sad": -1.0, "calm": 0.5},
+    "不平静": {"calm": -1.0},
+    "不轻松": {"calm": -1.0, "sad": 0.5},
+    "不好": {"sad": 0.5},
+}
+
+# 英文否定词：之后 NEGATION_WINDOW 个单词内的情感词视为被否定
+ENGLISH_NEGATORS = frozenset({
+    "not", "no", "never", "nor", "hardly", "cannot", "dont", "doesnt", "didnt", "isnt", "arent",
+    "wasnt", "werent", "cant", "wont", "wouldnt", "shouldnt", "couldnt", "aint",
+})
+NEGATION_WINDOW = 3
+# 被否定的情感词不计入原情感，改为给相反的情感一个较弱的权重（与中文否定短语一致）
+NEGATION_SHIFT = {"happy": "sad", "sad": "calm", "angry": "calm", "calm": "sad"}
+NEGATION_WEIGHT = 0.5
+
+# 词典以外的文本偏向neutral；先验低于任何一个词，没有命中任何词时置信度不足
+NEUTRAL_PRIOR = 0.3
+# softmax前的缩放系数，越大置信度越"尖"
+SCORE_SCALE = 2.0
+MAX_NGRAM = 4
+
+_WORD_RE = re.compile(r"[a-z']+")
+# 否定只在同一个分句内生效
+_CLAUSE_RE = re.compile(r"[.!?,;:。！？，；：\n]+")
+_CJK_RE = re.compile(r"[一-鿿]+")
+
+
+class EmotionClassifier:
+    """词典打分的本地情感分类器"""
+
+    def __init__(self, lexicon=None, negations=None):
+        lexicon = lexicon or LEXICON
+        negations = negations if negations is not None else NEGATIONS
+
+        weights = {}
+        for emotion, terms in lexicon.items():
+            for term in terms:
+                weights.setdefault(term.lower(), {})[emotion] = NEUTRAL_WEIGHT if emotion == "neutral" else 1.0
+        for term, overrides in negations.items():
+            weights.setdefault(term, {}).update(overrides)
+
+        self.vocab = {term: i for i, term in enumerate(weights)}
+        self.weights = np.zeros((len(self.vocab), len(EMOTIONS)), dtype=np.float32)
+        for term, row in weights.items():
+            for emotion, weight in row.items():
+                self.weights[self.vocab[term], EMOTIONS.index(emotion)] = weight
+        # 被否定时每个词的权重：neutral不变，其他情感转给 NEGATION_SHIFT 中的相反情感
+        self.negated_weights = np.zeros_like(self.weights)
+        neutral = EMOTIONS.index("neutral")
+        self.negated_weights[:, neutral] = self.weights[:, neutral]
+        for emotion, opposite in NEGATION_SHIFT.items():
+            column = np.clip(self.weights[:, EMOTIONS.index(emotion)], 0, None)
+            self.negated_weights[:, EMOTIONS.index(opposite)] += NEGATION_WEIGHT * column
+        self.prior = np.zeros(len(EMOTIONS), dtype=np.float32)
+        self.prior[EMOTIONS.index("neutral")] = NEUTRAL_PRIOR
+
+    def _tokens(self, text: str):
+        """产出 (词, 是否被否定)：英文单词 + 中文1~4字片段
+
+        中文的否定由词典里的否定短语处理，英文按否定词之后的窗口处理。
+        """
+        text = text.lower().replace("’", "'")
+        for clause in _CLAUSE_RE.split(text):
+            last_negator = None
+            for i, word in enumerate(_WORD_RE.findall(clause)):
+                word = word.strip("'")
+                if word.replace("'", "") in ENGLISH_NEGATORS:
+                    last_negator = i
+                    continue
+                yield word, last_negator is not None and i - last_negator <= NEGATION_WINDOW
+        for run in _CJK_RE.findall(text):
+            for n in range(1, MAX_NGRAM + 1):
+                for i in range(len(run) - n + 1):
+                    yield run[i:i + n], False
+
+    def scores(self, text: str) -> np.ndarray:
+        """返回五种情感的原始得分"""
+        vocab = self.vocab
+        hits, negated = [], []
+        for token, is_negated in self._tokens(text):
+            index = vocab.get(token)
+            if index is not None:
+                (negated if is_negated else hits).append(index)
+        if not hits and not negated:
+            return self.prior.copy()
+        scores = self.prior.copy()
+        if hits:
+            scores += np.bincount(hits, minlength=len(vocab)).astype(np.float32) @ self.weights
+        if negated:
+            scores += np.bincount(negated, minlength=len(vocab)).astype(np.float32) @ self.negated_weights
+        return scores
+
+    def classify(self, text: str) -> tuple[str, float]:
+        """返回 (情感, 置信度)
+
+        置信度为 1 - 第二高概率 / 最高概率，只取决于前两名的得分差：
+        干净地命中一个情感词（约0.75）或一个疑问词（约0.80）时可以直接用本地结果；
+        一个词也没命中（约0.45）、两种情感冲突或只有被否定的词（约0.33）时偏低，交给Gemini判断。
+        """
+        scores = self.scores(text) * SCORE_SCALE
+        exp = np.exp(scores - scores.max())
+        probs = exp / exp.sum()
+        best, runner_up = np.argsort(-probs)[:2]
+        return EMOTIONS[int(best)], float(1 - probs[runner_up] / probs[best])
@@ -0,0 +1,50 @@
+"""gunicorn配置：gunicorn -c gunicorn.conf.py main:app
+
+可通过环境变量调整：
+- WEB_CONCURRENCY: worker数，默认等于可用CPU核数
+- HOST / PORT: 监听地址
+- GRACEFUL_TIMEOUT: 收到SIGTERM后等待请求结束的秒数
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+# 从任意目录启动时都能导入后端模块
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+from production import default_workers, preload  # noqa: E402
+
+chdir = BACKEND_DIR
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '8000')}"
+# docker-compose 在宿主机未设置时会传入空字符串
+workers = int(os.getenv("WEB_CONCURRENCY") or 0) or default_workers()
+worker_class = "production.SamanthaWorker"
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+# 流式回复可能持续较久，心跳超时比单次请求的上游截止时间宽松
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+accesslog = None
+
+# 多worker时各worker的Prometheus指标写入共享目录，由 /metrics 汇总
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "samantha-metrics"))
+# 多worker时最近对话的进程内缓冲看不到其他worker处理的对话，改为每次从数据库加载
+if workers > 1:
+    os.environ.setdefault("CONTEXT_RELOAD", "true")
+
+
+def on_starting(server):
+    # 清理上次运行留下的指标文件
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+    server.log.info(f"预加载依赖并初始化数据库，worker数: {workers}")
+    preload()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
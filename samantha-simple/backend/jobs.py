@@ -0,0 +1,461 @@
+"""后台任务队列
+
+可以延后的工作（长期记忆写入、情感重新分析等）不在请求里完成：
+请求只提交一个任务，后台worker按自己的节奏处理，失败后按指数退避重试，
+超过最大次数进入死信，保留最后的错误供查看。
+
+broker 负责保存任务，实现相同的接口（init / enqueue / reserve / ack / retry /
+bury / wait / stats / close，均为async）：
+- MemoryBroker 保存在进程内存中，重启后未完成的任务丢失，关闭时会尽量处理完。默认使用。
+- SQLiteBroker 保存在本地SQLite文件，重启后继续处理；多个worker进程共享同一个文件时一起分担。
+领取任务时加租约（visibility timeout），处理任务的进程崩溃后租约到期，任务重新可领取。
+每次领取的尝试次数（attempts）同时是租约的标识：ack / retry / bury 只对当前的租约生效，
+租约过期、任务已被重新领取后，原来的worker迟到的确认不会影响新的一次处理。
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import random
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from metrics import record_job, track
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """待处理的任务数达到上限"""
+
+
+class Job:
+    """一个已领取的任务，attempts 标识这一次租约"""
+
+    __slots__ = ("id", "kind", "payload", "attempts")
+
+    def __init__(self, id, kind: str, payload: dict, attempts: int):
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+
+
+class MemoryBroker:
+    """进程内的任务存储"""
+
+    durable = False
+
+    def __init__(self, max_pending: int = 10000, max_dead: int = 100):
+        self.max_pending = max_pending
+        # (可领取时间, 序号, 任务)
+        self._ready = []
+        # 任务id -> (租约到期时间, 任务)
+        self._leased = {}
+        self._dead = deque(maxlen=max_dead)
+        self._ids = itertools.count(1)
+        self._wakeup = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._ready) + len(self._leased)
+
+    def _event(self) -> asyncio.Event:
+        # 在事件循环里第一次用到时再创建
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    async def init(self):
+        pass
+
+    async def enqueue(self, kind: str, payload: dict, delay: float = 0):
+        if self.pending >= self.max_pending:
+            raise QueueFull(f"后台任务已达上限 {self.max_pending}")
+        job_id = next(self._ids)
+        heapq.heappush(self._ready, (time.monotonic() + delay, job_id, Job(job_id, kind, payload, 0)))
+        self._event().set()
+        return job_id
+
+    async def reserve(self, lease: float):
+        now = time.monotonic()
+        # 租约到期的任务重新可领取
+        for job_id, (expires_at, job) in list(self._leased.items()):
+            if expires_at <= now:
+                del self._leased[job_id]
+                heapq.heappush(self._ready, (now, job_id, job))
+        if not self._ready or self._ready[0][0] > now:
+            return None
+        _, _, job = heapq.heappop(self._ready)
+        # 每次领取都是新的Job：原来持有过期租约的worker手里的对象不受影响
+        job = Job(job.id, job.kind, job.payload, job.attempts + 1)
+        self._leased[job.id] = (now + lease, job)
+        return job
+
+    def _release(self, job: Job) -> bool:
+        """结束job的租约；租约已过期（可能已被重新领取）时返回False"""
+        entry = self._leased.get(job.id)
+        if entry is None or entry[1].attempts != job.attempts:
+            return False
+        del self._leased[job.id]
+        return True
+
+    async def ack(self, job: Job) -> bool:
+        return self._release(job)
+
+    async def retry(self, job: Job, delay: float, error: str) -> bool:
+        if not self._release(job):
+            return False
+        heapq.heappush(self._ready, (time.monotonic() + delay, job.id, job))
+        return True
+
+    async def bury(self, job: Job, error: str) -> bool:
+        if not self._release(job):
+            return False
+        self._dead.append({"id": job.id, "kind": job.kind, "attempts": job.attempts, "error": error})
+        return True
+
+    async def wait(self, timeout: float):
+        """等待新任务或下一个延迟任务到期，最多timeout秒"""
+        if self._ready:
+            timeout = min(timeout, max(self._ready[0][0] - time.monotonic(), 0))
+        event = self._event()
+        event.clear()
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "ready": sum(1 for available_at, _, _ in self._ready if available_at <= now),
+            "delayed": sum(1 for available_at, _, _ in self._ready if available_at > now),
+            "leased": len(self._leased),
+            "dead": len(self._dead),
+            "recent_dead": list(self._dead)[-10:],
+        }
+
+    async def close(self):
+        pass
+
+
+JOBS_SCHEMA = [
+    # status: ready 等待领取（available_at 为可领取时间），leased 处理中（available_at 为租约到期时间），
+    # dead 超过最大重试次数
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'ready',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at REAL NOT NULL,
+        last_error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_jobs_available ON jobs (status, available_at)",
+]
+
+SELECT_AVAILABLE_JOB = """
+    SELECT id, kind, payload, attempts FROM jobs
+    WHERE status IN ('ready', 'leased') AND available_at <= ?
+    ORDER BY available_at
+    LIMIT 1
+"""
+
+# 只对当前租约生效：attempts 在每次领取时加一，租约过期后被重新领取的任务不匹配
+LEASE_MATCH = "id = ? AND status = 'leased' AND attempts = ?"
+
+# 待处理任务数的缓存时间（秒）。上限只是背压用的软限制，不需要每次提交都 count(*)
+PENDING_RECOUNT_INTERVAL = 1.0
+
+
+class SQLiteBroker:
+    """保存在SQLite文件中的任务存储，多个进程可以共享
+
+    时间使用墙上时钟，租约在进程之间也有效。所有操作在单个专用线程中执行。
+    """
+
+    durable = True
+
+    def __init__(self, path: str = "jobs.db", max_pending: int = 100000):
+        self.path = path
+        self.max_pending = max_pending
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs")
+        self._wakeup = None
+        # 待处理任务数：定期从数据库重新统计（包括其他进程的任务），之间按本进程的提交累加
+        self._pending = 0
+        self._pending_counted_at = None
+
+    def _event(self) -> asyncio.Event:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def init(self):
+        def create():
+            # 自动提交模式，领取任务时显式 BEGIN IMMEDIATE
+            self._conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False,
+                                         isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            for statement in JOBS_SCHEMA:
+                self._conn.execute(statement)
+        await self._run(create)
+
+    async def enqueue(self, kind: str, payload: dict, delay: float = 0):
+        def insert():
+            now = time.monotonic()
+            if self._pending_counted_at is None or now - self._pending_counted_at >= PENDING_RECOUNT_INTERVAL:
+                # status是索引的第一列，只扫描索引
+                self._pending = self._conn.execute(
+                    "SELECT count(*) FROM jobs WHERE status IN ('ready', 'leased')"
+                ).fetchone()[0]
+                self._pending_counted_at = now
+            if self._pending >= self.max_pending:
+                raise QueueFull(f"后台任务已达上限 {self.max_pending}")
+            job_id = self._conn.execute(
+                "INSERT INTO jobs (kind, payload, available_at) VALUES (?, ?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False), time.time() + delay),
+            ).lastrowid
+            self._pending += 1
+            return job_id
+        job_id = await self._run(insert)
+        self._event().set()
+        return job_id
+
+    async def reserve(self, lease: float):
+        def take():
+            now = time.time()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(SELECT_AVAILABLE_JOB, (now,)).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'leased', attempts = attempts + 1, available_at = ? WHERE id = ?",
+                        (now + lease, row[0]),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            if row is None:
+                return None
+            return Job(row[0], row[1], json.loads(row[2]), row[3] + 1)
+        return await self._run(take)
+
+    async def _update(self, sql: str, *args) -> bool:
+        """执行只对当前租约生效的语句，租约已过期时返回False"""
+        def execute():
+            return self._conn.execute(sql, args).rowcount > 0
+        return await self._run(execute)
+
+    async def ack(self, job: Job) -> bool:
+        return await self._update(f"DELETE FROM jobs WHERE {LEASE_MATCH}", job.id, job.attempts)
+
+    async def retry(self, job: Job, delay: float, error: str) -> bool:
+        return await self._update(
+            f"UPDATE jobs SET status = 'ready', available_at = ?, last_error = ? WHERE {LEASE_MATCH}",
+            time.time() + delay, error, job.id, job.attempts,
+        )
+
+    async def bury(self, job: Job, error: str) -> bool:
+        return await self._update(
+            f"UPDATE jobs SET status = 'dead', last_error = ? WHERE {LEASE_MATCH}",
+            error, job.id, job.attempts,
+        )
+
+    async def wait(self, timeout: float):
+        """等待本进程提交新任务，其他进程提交的任务靠轮询发现"""
+        event = self._event()
+        event.clear()
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def stats(self) -> dict:
+        def select():
+            now = time.time()
+            counts = dict(self._conn.execute("""
+                SELECT CASE
+                    WHEN status = 'ready' AND available_at > ? THEN 'delayed'
+                    WHEN status = 'leased' AND available_at <= ? THEN 'ready'
+                    ELSE status END AS state, count(*)
+                FROM jobs GROUP BY state
+            """, (now, now)).fetchall())
+            dead = self._conn.execute(
+                "SELECT id, kind, attempts, last_error FROM jobs WHERE status = 'dead' ORDER BY id DESC LIMIT 10"
+            ).fetchall()
+            return {
+                **{state: counts.get(state, 0) for state in ("ready", "delayed", "leased", "dead")},
+                "recent_dead": [
+                    {"id": row[0], "kind": row[1], "attempts": row[2], "error": row[3]}
+                    for row in reversed(dead)
+                ],
+            }
+        return await self._run(select)
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+
+class JobQueue:
+    """按任务类型分发给处理函数的worker池"""
+
+    def __init__(self, broker, workers: int = 2, max_attempts: int = 5,
+                 base_delay: float = 1.0, max_delay: float = 60.0,
+                 visibility_timeout: float = 60.0, poll_interval: float = 0.5):
+        self.broker = broker
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # 单个任务的最长处理时间，也是租约时长
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self._handlers = {}
+        self._tasks = []
+        self._stopping = False
+        self.counts = {}
+
+    def register(self, kind: str, handler):
+        """注册处理函数：async handler(**payload)"""
+        self._handlers[kind] = handler
+
+    async def submit(self, kind: str, delay: float = 0, **payload):
+        """提交一个任务，返回任务id；payload需要能序列化为JSON"""
+        if kind not in self._handlers:
+            raise ValueError(f"未注册的任务类型: {kind}")
+        job_id = await self.broker.enqueue(kind, payload, delay)
+        self._count(kind, "enqueued")
+        return job_id
+
+    async def start(self):
+        """初始化broker并启动worker"""
+        await self.broker.init()
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        """停止worker
+
+        不持久化的broker先尽量把剩下的任务处理完，最多等timeout秒；
+        超时后取消进行中的任务（持久化的broker里，这些任务在租约到期后重新处理）。
+        """
+        if not self._tasks:
+            return
+        self._stopping = True
+        _, running = await asyncio.wait(self._tasks, timeout=timeout)
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        self._tasks = []
+        stats = await self.broker.stats()
+        if not self.broker.durable and stats["ready"] + stats["delayed"] + stats["leased"]:
+            logger.warning(f"后台任务队列关闭时仍有未处理的任务: {stats}")
+        await self.broker.close()
+
+    async def _work(self):
+        while True:
+            try:
+                job = await self.broker.reserve(self.visibility_timeout)
+            except Exception as e:
+                logger.error(f"领取后台任务失败: {e}")
+                job = None
+            if job is not None:
+                await self._run(job)
+                continue
+            # 持久化的broker关闭时不需要等队列清空
+            if self._stopping and (self.broker.durable or not self.broker.pending):
+                return
+            await self.broker.wait(self.poll_interval)
+
+    async def _run(self, job: Job):
+        handler = self._handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise LookupError(f"未注册的任务类型: {job.kind}")
+            with track("job"), span("job", kind=job.kind, attempt=job.attempts):
+                await asyncio.wait_for(handler(**job.payload), self.visibility_timeout)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            try:
+                if handler is None or job.attempts >= self.max_attempts:
+                    if await self.broker.bury(job, error):
+                        logger.error(f"后台任务 {job.kind}#{job.id} 第 {job.attempts} 次失败，放弃: {error}")
+                        self._count(job.kind, "dead")
+                    else:
+                        self._expired(job)
+                else:
+                    # full jitter 指数退避
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (job.attempts - 1)))
+                    if await self.broker.retry(job, delay, error):
+                        logger.warning(f"后台任务 {job.kind}#{job.id} 第 {job.attempts} 次失败，{delay:.1f}s 后重试: {error}")
+                        self._count(job.kind, "retried")
+                    else:
+                        self._expired(job)
+            except Exception as e:
+                logger.error(f"更新后台任务 {job.kind}#{job.id} 状态失败: {e}")
+            return
+        try:
+            if await self.broker.ack(job):
+                self._count(job.kind, "succeeded")
+            else:
+                self._expired(job)
+        except Exception as e:
+            logger.error(f"确认后台任务 {job.kind}#{job.id} 失败: {e}")
+
+    def _expired(self, job: Job):
+        """处理超过了租约时间，任务已经（或将会）被重新处理，这次的结果不计入"""
+        logger.warning(f"后台任务 {job.kind}#{job.id} 第 {job.attempts} 次处理时租约已过期")
+        self._count(job.kind, "expired")
+
+    def _count(self, kind: str, outcome: str):
+        counts = self.counts.setdefault(kind, {})
+        counts[outcome] = counts.get(outcome, 0) + 1
+        record_job(kind, outcome)
+
+    async def stats(self) -> dict:
+        return {
+            "broker": type(self.broker).__name__,
+            "workers": self.workers,
+            "kinds": sorted(self._handlers),
+            "jobs": self.counts,
+            **await self.broker.stats(),
+        }
+
+
+def create_queue() -> JobQueue:
+    """按配置创建后台任务队列"""
+    if config.JOBS_BROKER == "sqlite":
+        broker = SQLiteBroker(config.JOBS_DB_PATH, max_pending=config.JOBS_MAX_PENDING)
+    elif config.JOBS_BROKER == "memory":
+        broker = MemoryBroker(max_pending=config.JOBS_MAX_PENDING)
+    else:
+        raise ValueError(f"未知的任务队列后端: {config.JOBS_BROKER}")
+    return JobQueue(
+        broker,
+        workers=config.JOBS_WORKERS,
+        max_attempts=config.JOBS_MAX_ATTEMPTS,
+        base_delay=config.JOBS_RETRY_BASE_DELAY,
+        max_delay=config.JOBS_RETRY_MAX_DELAY,
+        visibility_timeout=config.JOBS_VISIBILITY_TIMEOUT,
+        poll_interval=config.JOBS_POLL_INTERVAL,
+    )
@@ -0,0 +1,297 @@
+"""Gemini调用封装
+
+所有LLM请求都经过这里，避免在async处理函数中直接调用同步SDK阻塞事件循环。
+"""
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import google.genai as genai
+from google.genai import types
+
+import config
+from metrics import record_usage, track
+from resilience import AIMDLimiter, CircuitBreaker, ResilienceGuard, TokenBucket
+from tracing import set_usage, span
+from transport import LLMTransport
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    """一个进行中的上游请求及等待它的调用方数量"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """合并相同键的并发调用：同一时刻只发出一个请求，结果共享给所有等待者
+
+    单个等待者被取消不会影响其他人；最后一个等待者离开时才取消上游请求。
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.started = 0
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key, fn):
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+                self._forget(key, call)
+
+    def _forget(self, key, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self) -> dict:
+        return {"in_flight": self.in_flight, "started": self.started, "coalesced": self.coalesced}
+
+
+def _request_key(model: str, prompt, generation_config) -> tuple:
+    if generation_config is None:
+        config_key = None
+    elif hasattr(generation_config, "model_dump_json"):
+        config_key = generation_config.model_dump_json(exclude_none=True)
+    else:
+        config_key = repr(generation_config)
+    prompt_key = prompt if isinstance(prompt, str) else repr(prompt)
+    return model, prompt_key, config_key
+
+
+class LLMClient:
+    """Gemini异步客户端
+
+    mode="async" 使用google-genai自带的异步客户端(client.aio)；
+    mode="thread" 在有界线程池中运行同步客户端，线程数即最大并发数。
+    """
+
+    def __init__(self, api_key: str, mode: str = "async", max_workers: int = 16,
+                 coalesce: bool = True, guard=None, base_url: str = None,
+                 transport: LLMTransport = None):
+        if mode not in ("async", "thread"):
+            raise ValueError(f"未知的LLM调用方式: {mode}")
+        self.base_url = base_url
+        # 共享的连接池（见 transport.py），不传时使用SDK默认的连接设置
+        self.transport = transport
+        http_options = None
+        if base_url or transport is not None:
+            client_args, async_client_args = transport.client_args() if transport else (None, None)
+            http_options = types.HttpOptions(
+                base_url=base_url,
+                client_args=client_args,
+                async_client_args=async_client_args,
+            )
+        self.client = genai.Client(api_key=api_key, http_options=http_options)
+        self.mode = mode
+        # 相同模型和prompt的并发请求共享一次上游调用
+        self.flight = SingleFlight() if coalesce else None
+        # 限流、自适应并发、重试和熔断（见 resilience.py）
+        self.guard = guard
+        self._executor = None
+        if mode == "thread":
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="gemini"
+            )
+
+    async def generate(self, prompt, model: str = None, generation_config=None):
+        """发送一次generate_content请求，返回SDK的原始响应"""
+        model = model or config.GEMINI_MODEL
+        if self.flight is None:
+            return await self._guarded_generate(prompt, model, generation_config)
+        return await self.flight.do(
+            _request_key(model, prompt, generation_config),
+            lambda: self._guarded_generate(prompt, model, generation_config),
+        )
+
+    async def _guarded_generate(self, prompt, model: str, generation_config):
+        if self.guard is None:
+            return await self._generate(prompt, model, generation_config)
+        return await self.guard.call(lambda: self._generate(prompt, model, generation_config))
+
+    async def _generate(self, prompt, model: str, generation_config):
+        with track("llm"), span("gemini.generate_content") as current:
+            if self.mode == "thread":
+                loop = asyncio.get_running_loop()
+                call = functools.partial(
+                    self.client.models.generate_content,
+                    model=model,
+                    contents=prompt,
+                    config=generation_config,
+                )
+                response = await loop.run_in_executor(self._executor, call)
+            else:
+                response = await self.client.aio.models.generate_content(
+                    model=model,
+                    contents=prompt,
+                    config=generation_config,
+                )
+            set_usage(current, model, response)
+        record_usage(model, response)
+        return response
+
+    async def stream(self, prompt, model: str = None, generation_config=None):
+        """流式生成，逐段产出文本"""
+        model = model or config.GEMINI_MODEL
+        if self.guard is None:
+            chunks = self._stream(prompt, model, generation_config)
+        else:
+            chunks = self.guard.stream(lambda: self._stream(prompt, model, generation_config))
+        async for chunk in chunks:
+            yield chunk
+
+    async def _stream(self, prompt, model: str, generation_config):
+        if self.mode == "thread":
+            async for chunk in self._stream_in_thread(prompt, model, generation_config):
+                yield chunk
+            return
+
+        last = None
+        with track("llm"), span("gemini.generate_content_stream") as current:
+            stream = await self.client.aio.models.generate_content_stream(
+                model=model,
+                contents=prompt,
+                config=generation_config,
+            )
+            async for chunk in stream:
+                last = chunk
+                if chunk.text:
+                    yield chunk.text
+            # token用量在最后一段的usage_metadata里
+            set_usage(current, model, last)
+        record_usage(model, last)
+
+    async def _stream_in_thread(self, prompt, model, generation_config):
+        """在线程池中迭代同步流，通过队列把分段交回事件循环"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+        stop = threading.Event()
+
+        def produce():
+            try:
+                last = None
+                with track("llm"):
+                    for chunk in self.client.models.generate_content_stream(
+                        model=model, contents=prompt, config=generation_config
+                    ):
+                        if stop.is_set():
+                            break
+                        last = chunk
+                        if chunk.text:
+                            loop.call_soon_threadsafe(queue.put_nowait, chunk.text)
+                record_usage(model, last)
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+
+        loop.run_in_executor(self._executor, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # 客户端断开时通知生产线程尽快退出
+            stop.set()
+
+    async def create_cache(self, model: str, system_instruction: str, ttl: float) -> str:
+        """把静态的system instruction存入Gemini上下文缓存，返回缓存名"""
+        cache_config = types.CreateCachedContentConfig(
+            system_instruction=system_instruction,
+            ttl=f"{int(ttl)}s",
+        )
+        if self.mode == "thread":
+            loop = asyncio.get_running_loop()
+            call = functools.partial(self.client.caches.create, model=model, config=cache_config)
+            cached = await loop.run_in_executor(self._executor, call)
+        else:
+            cached = await self.client.aio.caches.create(model=model, config=cache_config)
+        return cached.name
+
+    async def prewarm(self, connections: int = 1):
+        """预先建立到Gemini的连接"""
+        if self.transport is not None:
+            await self.transport.prewarm(self.base_url, connections)
+
+    def stats(self) -> dict:
+        """连接池状态"""
+        if self.transport is None:
+            return {}
+        return self.transport.stats()
+
+    async def close(self):
+        """释放线程池和连接"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self.transport is not None:
+            await self.transport.close()
+
+
+def create_guard() -> ResilienceGuard:
+    """按配置创建限流、并发、重试和熔断策略"""
+    bucket = None
+    if config.LLM_RATE_LIMIT_RPM > 0:
+        bucket = TokenBucket(config.LLM_RATE_LIMIT_RPM / 60, config.LLM_RATE_LIMIT_BURST)
+    return ResilienceGuard(
+        limiter=AIMDLimiter(
+            initial=config.LLM_INITIAL_CONCURRENCY,
+            min_limit=config.LLM_MIN_CONCURRENCY,
+            max_limit=config.LLM_MAX_CONCURRENCY,
+        ),
+        breaker=CircuitBreaker(
+            failure_threshold=config.LLM_BREAKER_FAILURES,
+            reset_timeout=config.LLM_BREAKER_RESET_SECONDS,
+        ),
+        bucket=bucket,
+        max_retries=config.LLM_MAX_RETRIES,
+        base_delay=config.LLM_RETRY_BASE_DELAY,
+        max_delay=config.LLM_RETRY_MAX_DELAY,
+        attempt_timeout=config.LLM_ATTEMPT_TIMEOUT,
+        deadline=config.LLM_DEADLINE,
+    )
+
+
+def create_client() -> LLMClient:
+    """按配置创建LLM客户端"""
+    logger.info(f"LLM调用方式: {config.LLM_MODE}")
+    return LLMClient(
+        api_key=config.GEMINI_API_KEY,
+        mode=config.LLM_MODE,
+        max_workers=config.LLM_THREAD_POOL_SIZE,
+        coalesce=config.LLM_COALESCE,
+        guard=create_guard(),
+        base_url=config.GEMINI_BASE_URL or None,
+        transport=LLMTransport(
+            http2=config.LLM_HTTP2,
+            max_connections=config.LLM_MAX_CONNECTIONS,
+            max_keepalive=config.LLM_MAX_KEEPALIVE,
+            keepalive_expiry=config.LLM_KEEPALIVE_EXPIRY,
+        ),
+    )
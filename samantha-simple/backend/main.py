@@ -1,11 +1,31 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response as RawResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-import google.genai as genai
-import sqlite3
 from datetime import datetime
-import os
+from typing import Optional
+import uuid
+import json
 import logging
+import asyncio
+
+import config
+from admission import AdmissionController, AdmissionRejected
+from batcher import EmotionBatcher
+from bulk import BATCH_TASKS, BatchJournal, BatchRunner, JobBusy
+from cache import InMemoryCacheBackend, RedisCacheBackend, ResponseCache
+from context import ContextAssembler
+from jobs import create_queue
+from llm import create_client
+import metrics
+from memory import GeminiEmbedder, HashingEmbedder, LongTermMemory
+from pipeline import ChatPipeline
+from prompts import create_registry
+from storage import create_store
+from summary import ConversationSummarizer
+import tracing
+from writer import ConversationWriter
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -20,10 +40,159 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Trace-Id", "X-Job-Id"],
 )
 
-# Gemini客户端
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY", "your-gemini-api-key-here"))
+# 请求追踪：按采样率记录请求内各阶段的span
+if config.TRACING_ENABLED:
+    tracing.configure(sample_rate=config.TRACE_SAMPLE_RATE, max_spans=config.TRACE_BUFFER_SIZE)
+    app.add_middleware(tracing.TracingMiddleware)
+else:
+    tracing.configure(sample_rate=0.0, max_spans=1)
+
+# Gemini客户端（异步调用，不阻塞事件循环）
+llm = create_client()
+
+# 版本化的prompt模板，静态前缀可放入Gemini上下文缓存
+prompts = create_registry(llm)
+
+# 回复缓存
+cache = None
+if config.CACHE_ENABLED:
+    if config.CACHE_BACKEND == "redis":
+        cache_backend = RedisCacheBackend(config.REDIS_URL)
+    else:
+        cache_backend = InMemoryCacheBackend(max_entries=config.CACHE_MAX_ENTRIES)
+    cache = ResponseCache(
+        cache_backend,
+        ttl=config.CACHE_TTL,
+        similarity_threshold=config.CACHE_SIMILARITY_THRESHOLD,
+        embedder=HashingEmbedder(),
+    )
+
+# 情感分析微批处理
+batcher = None
+if config.EMOTION_BATCH_ENABLED:
+    batcher = EmotionBatcher(
+        llm,
+        max_batch=config.EMOTION_BATCH_MAX_SIZE,
+        max_wait=config.EMOTION_BATCH_MAX_WAIT_MS / 1000,
+        prompts=prompts,
+    )
+
+pipeline = ChatPipeline(
+    llm,
+    mode=config.PIPELINE_MODE,
+    emotion_backend=config.EMOTION_BACKEND,
+    confidence_threshold=config.EMOTION_CONFIDENCE_THRESHOLD,
+    cache=cache,
+    batcher=batcher,
+    prompts=prompts,
+)
+
+# 对话存储（SQLite连接池 + WAL，或共享的PostgreSQL）
+store = create_store()
+
+# 批量处理：有限并发 + 批量写库 + 可续跑的进度日志
+bulk = BatchRunner(
+    pipeline,
+    store,
+    BatchJournal(config.BATCH_DIR),
+    concurrency=config.BATCH_CONCURRENCY,
+    flush_size=config.BATCH_FLUSH_SIZE,
+    flush_interval=config.BATCH_FLUSH_INTERVAL,
+)
+
+writer = None
+if config.WRITE_BEHIND_ENABLED:
+    writer = ConversationWriter(
+        store,
+        batch_size=config.WRITE_BATCH_SIZE,
+        flush_interval=config.WRITE_FLUSH_INTERVAL,
+        max_pending=config.WRITE_MAX_PENDING,
+    )
+
+# 最近对话上下文
+context = None
+if config.CONTEXT_ENABLED:
+    context = ContextAssembler(
+        store,
+        max_turns=config.CONTEXT_MAX_TURNS,
+        token_budget=config.CONTEXT_TOKEN_BUDGET,
+        max_users=config.CONTEXT_MAX_USERS,
+        reload=config.CONTEXT_RELOAD,
+    )
+
+# 长期记忆
+memory = None
+if config.MEMORY_ENABLED:
+    if config.MEMORY_EMBEDDER == "gemini":
+        embedder = GeminiEmbedder(llm)
+    else:
+        embedder = HashingEmbedder(dim=config.MEMORY_DIM)
+    memory = LongTermMemory(
+        embedder,
+        directory=config.MEMORY_DIR,
+        top_k=config.MEMORY_TOP_K,
+        min_score=config.MEMORY_MIN_SCORE,
+    )
+
+# 后台任务：请求里只提交任务，由后台worker处理并在失败时重试
+jobs = None
+if config.JOBS_ENABLED:
+    jobs = create_queue()
+
+async def remember_job(user_id: int, message: str, response: str):
+    """写入长期记忆（生成向量）"""
+    await memory.remember(user_id, message, response)
+
+async def reanalyze_job(user_id: int, limit: int = 50, before_id: Optional[int] = None):
+    """用Gemini重新分析一页历史对话的情感，只更新结果有变化的记录"""
+    rows = await store.get_history(user_id, limit, before_id=before_id)
+    emotions = await asyncio.gather(*(pipeline.reanalyze_emotion(row["message"]) for row in rows))
+    changed = [(emotion, row["id"]) for row, emotion in zip(rows, emotions) if emotion != row["emotion"]]
+    if changed:
+        await store.update_emotions(changed)
+    logger.info(f"用户 {user_id} 的 {len(rows)} 条记录已重新分析，{len(changed)} 条情感有变化")
+
+# 滚动对话摘要：较早的对话在后台并入摘要，prompt长度不随对话总数增长
+summarizer = None
+if config.SUMMARY_ENABLED and jobs is not None:
+    summarizer = ConversationSummarizer(
+        llm,
+        store,
+        prompts,
+        every=config.SUMMARY_EVERY,
+        keep_recent=config.SUMMARY_KEEP_RECENT,
+        max_chars=config.SUMMARY_MAX_CHARS,
+        fold_limit=config.SUMMARY_FOLD_LIMIT,
+        max_users=config.CONTEXT_MAX_USERS,
+    )
+
+async def summarize_job(user_id: int):
+    """把积压的较早对话并入摘要，一次合并不完时再提交一个任务"""
+    if await summarizer.fold(user_id):
+        await jobs.submit("summarize", user_id=user_id)
+
+if jobs is not None:
+    if memory is not None:
+        jobs.register("remember", remember_job)
+    jobs.register("reanalyze_emotions", reanalyze_job)
+    if summarizer is not None:
+        jobs.register("summarize", summarize_job)
+
+# 准入控制：按用户限速、全局并发上限和排队
+admission = None
+if config.ADMISSION_ENABLED:
+    admission = AdmissionController(
+        user_rate_per_minute=config.USER_RATE_PER_MINUTE,
+        user_burst=config.USER_BURST,
+        max_concurrent=config.MAX_CONCURRENT_CHATS,
+        max_queue=config.MAX_QUEUED_CHATS,
+        max_wait=config.MAX_QUEUE_WAIT,
+        fast_concurrent=config.FAST_LANE_CONCURRENCY,
+        fast_max_chars=config.FAST_LANE_MAX_CHARS,
+    )
 
 # 数据模型
 class ChatRequest(BaseModel):
@@ -34,162 +203,262 @@ class ChatResponse(BaseModel):
     response: str
     emotion: str
 
+class BatchItem(BaseModel):
+    message: str
+    user_id: int = 1
+    id: Optional[str] = None
+    # 重放时可带上原来的对话历史，不读取数据库里的上下文
+    history: str = ""
+
+class BatchRequest(BaseModel):
+    items: list[BatchItem]
+    job_id: Optional[str] = None
+    task: str = "chat"
+    save: bool = True
+    concurrency: Optional[int] = None
+
+class ReanalyzeRequest(BaseModel):
+    user_id: int = 1
+    limit: int = 50
+    before_id: Optional[int] = None
+
 class HistoryResponse(BaseModel):
+    id: int
     message: str
     response: str
     emotion: str
     created_at: str
 
 # 数据库初始化
-def init_db():
-    """初始化SQLite数据库"""
+async def init_db():
+    """初始化数据库"""
     try:
-        conn = sqlite3.connect("samantha.db")
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                message TEXT,
-                response TEXT,
-                emotion TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                name TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # 创建默认用户
-        cursor.execute("""
-            INSERT OR IGNORE INTO users (id, name) VALUES (1, 'Default User')
-        """)
-
-        conn.commit()
-        conn.close()
-        logger.info("数据库初始化完成")
+        await store.init_schema()
     except Exception as e:
         logger.error(f"数据库初始化失败: {e}")
 
-# 情感分析
-def analyze_emotion(text: str) -> str:
-    """分析文本情感"""
-    try:
-        prompt = f"分析以下文本的情感，只返回：happy, sad, angry, calm, neutral\n\n文本：{text}"
-
-        response = client.models.generate_content(
-            model="gemini-1.5-flash",
-            contents=prompt
-        )
-        emotion = response.text.strip().lower()
-        logger.info(f"情感分析结果: {emotion}")
-        return emotion
-    except Exception as e:
-        logger.error(f"情感分析失败: {e}")
-        return "neutral"
-
-# 生成回复
-def generate_response(message: str, emotion: str) -> str:
-    """生成AI回复"""
-    try:
-        prompt = f"""
-你是Samantha，一个智能、温暖的AI助手。
-用户当前情感状态：{emotion}
-
-请根据用户的情感状态提供合适的回应：
-- 如果用户情绪低落，提供温暖和支持
-- 如果用户情绪积极，分享快乐
-- 如果用户情绪愤怒，保持冷静和理解
-- 始终保持友好、有帮助的态度
-
-回复要简洁、自然，不超过100字。
-
-用户消息：{message}
-"""
-
-        response = client.models.generate_content(
-            model="gemini-1.5-flash",
-            contents=prompt
-        )
-        ai_response = response.text.strip()
-        logger.info(f"AI回复生成成功: {ai_response[:50]}...")
-        return ai_response
-    except Exception as e:
-        logger.error(f"AI回复生成失败: {e}")
-        return f"抱歉，我现在无法回应。请稍后再试。"
+# 对话历史
+async def load_context(user_id: int, message: str) -> str:
+    """获取拼入prompt的对话摘要、相关记忆和最近对话，失败时不带历史"""
+    summary = ""
+    if summarizer is not None:
+        try:
+            summary = await summarizer.get(user_id)
+        except Exception as e:
+            logger.error(f"读取对话摘要失败: {e}")
+    if summary:
+        summary = f"之前对话的摘要：\n{summary}\n\n"
+
+    recent = ""
+    if context is not None:
+        try:
+            recent = await context.build(user_id)
+        except Exception as e:
+            logger.error(f"加载对话上下文失败: {e}")
+
+    memories = []
+    if memory is not None:
+        try:
+            # 已经在最近对话里的记录不再重复
+            memories = [m for m in await memory.recall(user_id, message) if m not in recent]
+        except Exception as e:
+            logger.error(f"检索长期记忆失败: {e}")
+
+    if not memories:
+        return summary + recent
+    return summary + "相关的往事：\n" + "\n".join(memories) + "\n\n" + recent
 
 # 保存对话
-def save_conversation(user_id: int, message: str, response: str, emotion: str):
+async def save_conversation(user_id: int, message: str, response: str, emotion: str):
     """保存对话到数据库"""
+    with tracing.span("save_conversation", user_id=user_id, write_behind=writer is not None):
+        await _save_conversation(user_id, message, response, emotion)
+
+async def _save_conversation(user_id: int, message: str, response: str, emotion: str):
+    if context is not None:
+        context.append(user_id, message, response)
+    if summarizer is not None and summarizer.record_turn(user_id):
+        try:
+            await jobs.submit("summarize", user_id=user_id)
+        except Exception as e:
+            logger.error(f"提交摘要任务失败: {e}")
+    if memory is not None:
+        try:
+            if jobs is not None:
+                # 生成向量放到后台任务里，不占用请求时间
+                await jobs.submit("remember", user_id=user_id, message=message, response=response)
+            else:
+                await memory.remember(user_id, message, response)
+        except Exception as e:
+            logger.error(f"写入长期记忆失败: {e}")
     try:
-        conn = sqlite3.connect("samantha.db")
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            INSERT INTO conversations (user_id, message, response, emotion)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, message, response, emotion))
-
-        conn.commit()
-        conn.close()
+        with metrics.track("db_save"):
+            if writer is not None:
+                # 放入写入缓冲，由后台任务批量提交
+                await writer.submit(user_id, message, response, emotion)
+                return
+            await store.save_conversation(user_id, message, response, emotion)
         logger.info(f"对话已保存到数据库")
     except Exception as e:
         logger.error(f"保存对话失败: {e}")
 
+# 准入
+async def admit(request: ChatRequest):
+    """申请处理名额，被拒绝时返回429/503和Retry-After"""
+    if admission is None:
+        return None
+    try:
+        return await admission.acquire(request.user_id, request.message)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=e.detail,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
 # API端点
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """处理聊天请求"""
+    ticket = await admit(request)
     try:
         logger.info(f"收到聊天请求: {request.message[:50]}...")
 
-        # 情感分析
-        emotion = analyze_emotion(request.message)
-
-        # 生成回复
-        response = generate_response(request.message, emotion)
+        # 情感分析 + 生成回复
+        history = await load_context(request.user_id, request.message)
+        emotion, response = await pipeline.run(request.message, history)
 
         # 保存对话
-        save_conversation(request.user_id, request.message, response, emotion)
+        await save_conversation(request.user_id, request.message, response, emotion)
 
         return ChatResponse(response=response, emotion=emotion)
     except Exception as e:
         logger.error(f"处理聊天请求失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _ndjson_event(event: str, data: dict) -> str:
+    return json.dumps({"event": event, **data}, ensure_ascii=False) + "\n"
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, format: str = "sse"):
+    """流式聊天：先返回情感，再逐段返回回复
+
+    format=sse 返回server-sent events；format=ndjson 以分块传输逐行返回JSON。
+    """
+    if format == "sse":
+        encode, media_type = _sse_event, "text/event-stream"
+    elif format == "ndjson":
+        encode, media_type = _ndjson_event, "application/x-ndjson"
+    else:
+        raise HTTPException(status_code=400, detail=f"不支持的格式: {format}")
+
+    ticket = await admit(request)
+    logger.info(f"收到流式聊天请求: {request.message[:50]}...")
+
+    async def events():
+        emotion = "neutral"
+        try:
+            history = await load_context(request.user_id, request.message)
+            async for kind, value in pipeline.stream(request.message, history):
+                if kind == "emotion":
+                    emotion = value
+                    yield encode("emotion", {"emotion": value})
+                elif kind == "delta":
+                    yield encode("delta", {"text": value})
+                else:
+                    # 流结束后再保存对话
+                    await save_conversation(request.user_id, request.message, value, emotion)
+                    yield encode("done", {"response": value, "emotion": emotion})
+        finally:
+            # 名额在整个流结束后才释放
+            if ticket is not None:
+                ticket.release()
+
+    return StreamingResponse(
+        events(),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # 流未开始就断开时生成器不会执行finally，由后台任务兜底释放
+        background=BackgroundTask(ticket.release) if ticket is not None else None,
+    )
+
+@app.post("/chat/batch")
+async def chat_batch(request: BatchRequest):
+    """批量处理消息，以NDJSON逐行返回结果
+
+    task=chat 生成回复（save=true 时批量写入数据库），task=emotion 只做情感分析。
+    第一行是 start 事件，之后的结果按完成顺序返回，每行带上条目的id（未提供时为序号）。
+    用同一个job_id重新提交时，已完成的条目直接返回（resumed=true），不再重复处理。
+    最后一行是 done 事件，包含完成、续跑和失败的数量；响应头 X-Job-Id 给出任务id。
+    """
+    if len(request.items) > config.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"单次最多 {config.BATCH_MAX_ITEMS} 条")
+    if request.task not in BATCH_TASKS:
+        raise HTTPException(status_code=400, detail=f"不支持的任务: {request.task}")
+    if request.concurrency is not None and not 1 <= request.concurrency <= config.BATCH_CONCURRENCY:
+        raise HTTPException(status_code=400, detail=f"concurrency 需在 1~{config.BATCH_CONCURRENCY} 之间")
+
+    job_id = request.job_id or uuid.uuid4().hex
+    items = [
+        {"id": item.id if item.id is not None else str(i), "message": item.message,
+         "user_id": item.user_id, "history": item.history}
+        for i, item in enumerate(request.items)
+    ]
+    if len({item["id"] for item in items}) != len(items):
+        raise HTTPException(status_code=400, detail="条目id不能重复")
+    logger.info(f"收到批量请求 {job_id}: {len(items)} 条, task={request.task}")
+
+    results = bulk.run(job_id, items, task=request.task, save=request.save,
+                       concurrency=request.concurrency)
+    # 先取start事件，让job_id无效或任务正在运行时直接返回错误状态码
+    try:
+        first = await results.__anext__()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except JobBusy:
+        raise HTTPException(status_code=409, detail=f"批量任务 {job_id} 正在处理中")
+
+    async def lines():
+        yield _ndjson_event(*first)
+        async for event, data in results:
+            yield _ndjson_event(event, data)
+
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"X-Job-Id": job_id, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # 客户端提前断开时关闭生成器：保存已算完的结果并释放任务锁
+        background=BackgroundTask(results.aclose),
+    )
 
 @app.get("/history/{user_id}", response_model=list[HistoryResponse])
-async def get_history(user_id: int, limit: int = 50):
-    """获取对话历史"""
+async def get_history(user_id: int, response: Response, limit: int = 50,
+                      before_id: Optional[int] = None, after_id: Optional[int] = None):
+    """获取对话历史
+
+    按时间倒序返回。用 before_id 向更早翻页、after_id 获取更新的记录；
+    还有下一页时，响应头 X-Next-Cursor 给出下一次请求要传的id。
+    """
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="before_id 和 after_id 不能同时使用")
+
     try:
-        conn = sqlite3.connect("samantha.db")
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            SELECT message, response, emotion, created_at
-            FROM conversations
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-            LIMIT ?
-        """, (user_id, limit))
-
-        results = cursor.fetchall()
-        conn.close()
-
-        history = [
-            HistoryResponse(
-                message=row[0],
-                response=row[1],
-                emotion=row[2],
-                created_at=row[3]
-            )
-            for row in results
-        ]
+        with metrics.track("history"), tracing.span("get_history", user_id=user_id, limit=limit) as current:
+            results = await store.get_history(user_id, limit, before_id=before_id, after_id=after_id)
+            current.set_attribute("rows", len(results))
+
+        history = [HistoryResponse(**row) for row in results]
+
+        if history and len(history) == limit:
+            # 向更早翻页时游标是本页最旧的一条，获取更新记录时是本页最新的一条
+            cursor = history[0].id if after_id is not None else history[-1].id
+            response.headers["X-Next-Cursor"] = str(cursor)
 
         logger.info(f"获取用户 {user_id} 的历史记录: {len(history)} 条")
         return history
@@ -197,6 +466,69 @@ async def get_history(user_id: int, limit: int = 50):
         logger.error(f"获取历史记录失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/jobs/reanalyze", status_code=202)
+async def reanalyze_emotions(request: ReanalyzeRequest):
+    """提交后台任务，用Gemini重新分析一页历史对话的情感（分页参数同 /history）"""
+    if jobs is None:
+        raise HTTPException(status_code=503, detail="后台任务未启用")
+    try:
+        job_id = await jobs.submit(
+            "reanalyze_emotions",
+            user_id=request.user_id, limit=request.limit, before_id=request.before_id,
+        )
+    except Exception as e:
+        logger.error(f"提交后台任务失败: {e}")
+        raise HTTPException(status_code=503, detail=str(e))
+    return {"job_id": job_id}
+
+@app.get("/jobs/stats")
+async def jobs_stats():
+    """后台任务统计：各状态的任务数、按类型的处理结果、最近的死信和摘要合并情况"""
+    if jobs is None:
+        return {"enabled": False}
+    stats = {"enabled": True, **await jobs.stats()}
+    if summarizer is not None:
+        stats["summaries"] = summarizer.stats()
+    return stats
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """回复缓存命中统计"""
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+@app.get("/llm/stats")
+async def llm_stats():
+    """Gemini调用统计：连接池、prompt缓存、并发上限、熔断状态、重试、请求合并和批处理"""
+    stats = {"prompts": prompts.stats()}
+    if llm.transport is not None:
+        stats["transport"] = llm.stats()
+    if llm.guard is not None:
+        stats["guard"] = llm.guard.stats()
+    if llm.flight is not None:
+        stats["coalescing"] = llm.flight.stats()
+    if batcher is not None:
+        stats["emotion_batching"] = batcher.stats()
+    if admission is not None:
+        stats["admission"] = admission.stats()
+    return stats
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus指标"""
+    body, content_type = metrics.render()
+    return RawResponse(content=body, media_type=content_type)
+
+@app.get("/debug/traces")
+async def debug_traces(limit: int = 20, trace_id: Optional[str] = None):
+    """最近被采样的trace，每个trace包含按开始时间排序的span"""
+    return {
+        "enabled": config.TRACING_ENABLED,
+        "sample_rate": tracing.tracer.sample_rate,
+        "traces": tracing.tracer.exporter.traces(limit=limit, trace_id=trace_id),
+    }
+
 @app.get("/health")
 async def health_check():
     """健康检查"""
@@ -216,9 +548,28 @@ async def root():
 async def startup_event():
     """应用启动时执行"""
     logger.info("Samantha AI API 启动中...")
-    init_db()
+    await init_db()
+    if config.LLM_PREWARM_CONNECTIONS > 0:
+        await llm.prewarm(config.LLM_PREWARM_CONNECTIONS)
+    if writer is not None:
+        writer.start()
+    if jobs is not None:
+        await jobs.start()
+    metrics.bind_runtime(llm=llm, writer=writer, admission=admission)
     logger.info("Samantha AI API 启动完成")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用关闭时执行"""
+    if writer is not None:
+        await writer.stop()
+    if jobs is not None:
+        await jobs.stop(timeout=config.JOBS_DRAIN_TIMEOUT)
+    await llm.close()
+    await store.close()
+    if memory is not None:
+        memory.close()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,250 @@
+"""长期记忆
+
+每轮对话生成一个向量，追加到该用户的内存映射向量文件中，
+对应的文本逐行写入同名的 .jsonl 文件。生成回复前按余弦相似度
+取回最相关的几条过往对话。
+
+向量文件 {user_id}.f32 是 (容量, 维度) 的float32矩阵，容量满时翻倍；
+有效条数以 .jsonl 的行数为准，向量总是先于文本写入。
+多个worker进程共享同一个目录：写入时加文件锁，检索前读入其他进程追加的记录。
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows：不做跨进程互斥
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"[a-z0-9']+")
+_CJK_RE = re.compile(r"[一-鿿]+")
+
+
+class HashingEmbedder:
+    """确定性的本地哈希向量，不依赖模型和网络
+
+    英文单词和中文单字、双字片段经crc32哈希到固定维度并带符号累加，
+    再做L2归一化。
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _features(self, text: str) -> list[str]:
+        text = text.lower()
+        features = _WORD_RE.findall(text)
+        for run in _CJK_RE.findall(text):
+            features.extend(run)
+            features.extend(run[i:i + 2] for i in range(len(run) - 1))
+        return features
+
+    def _embed_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        hashes = np.fromiter(
+            (zlib.crc32(f.encode("utf-8")) for f in self._features(text)),
+            dtype=np.uint32,
+        )
+        if hashes.size:
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+            np.add.at(vector, hashes % self.dim, signs)
+            norm = np.linalg.norm(vector)
+            if norm > 0:
+                vector /= norm
+        return vector
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        return np.stack([self._embed_one(text) for text in texts])
+
+
+class GeminiEmbedder:
+    """使用Gemini embedding模型生成向量"""
+
+    def __init__(self, llm, model: str = "text-embedding-004", dim: int = 768):
+        self.llm = llm
+        self.model = model
+        self.dim = dim
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        result = await self.llm.client.aio.models.embed_content(model=self.model, contents=texts)
+        vectors = np.array([e.values for e in result.embeddings], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorIndex:
+    """单个用户的内存映射向量索引
+
+    多个进程可以同时打开同一个用户的索引：写入时持有文件锁，
+    并先读入其他进程追加的记录，再写到当前的末尾。
+    """
+
+    def __init__(self, path: str, dim: int, initial_capacity: int = 256):
+        self.vector_path = path + ".f32"
+        self.text_path = path + ".jsonl"
+        self.lock_path = path + ".lock"
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self.initial_capacity = initial_capacity
+
+        self.texts = []
+        # 已读入的 .jsonl 字节数
+        self._text_offset = 0
+        self.vectors = None
+        # add和search都在线程池里执行
+        self._lock = threading.Lock()
+        self._sync()
+
+    @property
+    def count(self) -> int:
+        return len(self.texts)
+
+    def _open(self, capacity: int):
+        with open(self.vector_path, "ab") as f:
+            if f.tell() < capacity * self.row_bytes:
+                f.truncate(capacity * self.row_bytes)
+        self.vectors = np.memmap(self.vector_path, dtype=np.float32, mode="r+",
+                                 shape=(capacity, self.dim))
+
+    def _sync(self):
+        """读入其他进程追加的文本，向量文件被扩容过时重新映射"""
+        if os.path.exists(self.text_path):
+            with open(self.text_path, "rb") as f:
+                f.seek(self._text_offset)
+                data = f.read()
+            # 只取完整的行，正在写入的最后一行留到下次
+            end = data.rfind(b"\n") + 1
+            if end:
+                self.texts.extend(
+                    json.loads(line) for line in data[:end].decode("utf-8").splitlines() if line.strip()
+                )
+                self._text_offset += end
+
+        size = os.path.getsize(self.vector_path) if os.path.exists(self.vector_path) else 0
+        capacity = max(size // self.row_bytes, self.initial_capacity, self.count)
+        if self.vectors is None or len(self.vectors) < capacity:
+            if self.vectors is not None:
+                self.vectors.flush()
+            self._open(capacity)
+
+    def add(self, vector: np.ndarray, text: str):
+        with self._lock, _FileLock(self.lock_path):
+            self._sync()
+            if self.count == len(self.vectors):
+                self.vectors.flush()
+                self._open(len(self.vectors) * 2)
+            # 向量先于文本写入：其他进程看到文本时，对应的向量已经在共享映射里
+            self.vectors[self.count] = vector
+            line = (json.dumps(text, ensure_ascii=False) + "\n").encode("utf-8")
+            with open(self.text_path, "ab") as f:
+                f.write(line)
+            self.texts.append(text)
+            self._text_offset += len(line)
+
+    def search(self, query: np.ndarray, top_k: int) -> list[tuple[float, str]]:
+        """返回余弦相似度最高的 top_k 条 (得分, 文本)"""
+        with self._lock:
+            self._sync()
+            count = self.count
+            if count == 0:
+                return []
+            scores = self.vectors[:count] @ query
+        k = min(top_k, count)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), self.texts[i]) for i in best]
+
+    def close(self):
+        """释放映射；被淘汰时可能还有请求在用，下次读写时会重新映射"""
+        with self._lock:
+            if self.vectors is not None:
+                self.vectors.flush()
+                self.vectors = None
+
+
+class _FileLock:
+    """跨进程的排他文件锁（没有fcntl的平台上不加锁）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, "a")
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        return False
+
+
+class LongTermMemory:
+    """按用户存取长期记忆"""
+
+    def __init__(self, embedder, directory: str = "memory", top_k: int = 3,
+                 min_score: float = 0.1, max_open: int = 256):
+        self.embedder = embedder
+        self.directory = directory
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_open = max_open
+        self._indexes = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, user_id: int) -> str:
+        return os.path.join(self.directory, str(user_id))
+
+    async def _index(self, user_id: int) -> VectorIndex:
+        index = self._indexes.get(user_id)
+        if index is not None:
+            self._indexes.move_to_end(user_id)
+            return index
+        # 打开索引要读入整个 .jsonl，放到线程池里，不阻塞事件循环
+        index = await asyncio.to_thread(VectorIndex, self._path(user_id), self.embedder.dim)
+        existing = self._indexes.get(user_id)
+        if existing is not None:
+            # 等待期间另一个请求已经打开了同一个索引
+            await asyncio.to_thread(index.close)
+            return existing
+        self._indexes[user_id] = index
+        while len(self._indexes) > self.max_open:
+            _, oldest = self._indexes.popitem(last=False)
+            await asyncio.to_thread(oldest.close)
+        return index
+
+    async def remember(self, user_id: int, message: str, response: str):
+        """把一轮对话写入长期记忆"""
+        # 只对对话内容生成向量，角色前缀对每条记录都一样，只会拉近所有记录
+        vector = (await self.embedder.embed([f"{message}\n{response}"]))[0]
+        index = await self._index(user_id)
+        # add要等文件锁（可能被其他worker持有）并写文件，放到线程池里
+        await asyncio.to_thread(index.add, vector, f"用户：{message}\nSamantha：{response}")
+
+    async def recall(self, user_id: int, query: str) -> list[str]:
+        """取回与query最相关的过往对话"""
+        # 其他worker可能已经写入过，所以看文件而不是内存里的条数；
+        # 没有记忆的用户不打开索引，避免为每个用户创建向量文件
+        if not os.path.exists(self._path(user_id) + ".jsonl"):
+            return []
+        index = await self._index(user_id)
+        vector = (await self.embedder.embed([query]))[0]
+        results = await asyncio.to_thread(index.search, vector, self.top_k)
+        return [text for score, text in results if score >= self.min_score]
+
+    def close(self):
+        for index in self._indexes.values():
+            index.close()
+        self._indexes.clear()
@@ -0,0 +1,186 @@
+"""Prometheus指标
+
+按阶段记录耗时直方图、进行中的请求数和错误数，另外记录上游token用量、
+缓存命中和各组件的运行状态。热路径上每次记录只有几微秒的开销。
+
+多worker部署时设置 PROMETHEUS_MULTIPROC_DIR（gunicorn.conf.py 会自动设置），
+各worker把指标写入共享目录，/metrics 汇总所有worker的数据。
+"""
+import asyncio
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+# 多进程模式下运行状态类指标的写入间隔（秒）
+RUNTIME_REFRESH_INTERVAL = 1.0
+
+# 阶段：emotion 情感分析，generate 回复生成，fused 合并调用，llm 单次上游请求，
+# db_save 保存对话，db_flush 批量写入，history 历史查询，batch_item 批量处理的单条，job 后台任务，
+# summarize 摘要合并
+STAGE_SECONDS = Histogram(
+    "samantha_stage_duration_seconds",
+    "聊天流程各阶段耗时",
+    ["stage"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+STAGE_IN_FLIGHT = Gauge("samantha_stage_in_flight", "各阶段进行中的数量", ["stage"],
+                        multiprocess_mode="livesum")
+STAGE_ERRORS = Counter("samantha_stage_errors_total", "各阶段的错误数", ["stage"])
+
+LLM_TOKENS = Counter("samantha_llm_tokens_total", "Gemini token用量", ["model", "kind"])
+CACHE_REQUESTS = Counter("samantha_cache_requests_total", "回复缓存查询", ["kind", "result"])
+# event: connections 新建TCP连接，tls_handshakes TLS握手
+LLM_CONNECTIONS = Counter("samantha_llm_connections_total", "新建的Gemini连接", ["event"])
+# outcome: enqueued 提交，succeeded 成功，retried 失败后重试，dead 超过重试次数
+JOBS = Counter("samantha_jobs_total", "后台任务", ["kind", "outcome"])
+
+# 多进程模式下，数量类指标取所有存活worker之和，熔断状态取最大值
+LLM_CONCURRENCY_LIMIT = Gauge("samantha_llm_concurrency_limit", "Gemini自适应并发上限",
+                              multiprocess_mode="livesum")
+LLM_IN_FLIGHT = Gauge("samantha_llm_in_flight", "进行中的Gemini请求", multiprocess_mode="livesum")
+LLM_BREAKER_OPEN = Gauge("samantha_llm_breaker_open", "熔断器状态（0关闭，0.5探测中，1打开）",
+                         multiprocess_mode="livemax")
+WRITE_PENDING = Gauge("samantha_write_pending", "写入缓冲中尚未落盘的对话数", multiprocess_mode="livesum")
+LLM_POOL_CONNECTIONS = Gauge("samantha_llm_pool_connections", "Gemini连接池中的连接", ["state"],
+                             multiprocess_mode="livesum")
+LLM_POOL_QUEUED = Gauge("samantha_llm_pool_queued", "等待Gemini空闲连接的请求", multiprocess_mode="livesum")
+ADMISSION_QUEUED = Gauge("samantha_admission_queued", "排队等待准入的请求", ["lane"],
+                         multiprocess_mode="livesum")
+ADMISSION_IN_FLIGHT = Gauge("samantha_admission_in_flight", "已准入处理中的请求", ["lane"],
+                            multiprocess_mode="livesum")
+
+_BREAKER_VALUES = {"closed": 0.0, "half_open": 0.5, "open": 1.0}
+
+# 多进程模式下需要定期写入的 (gauge, 取值函数)
+_runtime = []
+_refresh_task = None
+
+
+class track:
+    """记录一个阶段的耗时、进行中数量和异常
+
+    with track("emotion"):
+        ...
+    """
+
+    __slots__ = ("_histogram", "_in_flight", "_errors", "_start")
+
+    _children = {}
+
+    def __init__(self, stage: str):
+        children = self._children.get(stage)
+        if children is None:
+            children = (
+                STAGE_SECONDS.labels(stage),
+                STAGE_IN_FLIGHT.labels(stage),
+                STAGE_ERRORS.labels(stage),
+            )
+            self._children[stage] = children
+        self._histogram, self._in_flight, self._errors = children
+
+    def __enter__(self):
+        self._in_flight.inc()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start)
+        self._in_flight.dec()
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            self._errors.inc()
+        return False
+
+
+def record_error(stage: str):
+    """记录被内部捕获、没有抛出的错误（例如返回了兜底结果）"""
+    STAGE_ERRORS.labels(stage).inc()
+
+
+def record_usage(model: str, response):
+    """从Gemini响应的usage_metadata累加token用量"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    if usage.prompt_token_count:
+        LLM_TOKENS.labels(model, "prompt").inc(usage.prompt_token_count)
+    if usage.candidates_token_count:
+        LLM_TOKENS.labels(model, "response").inc(usage.candidates_token_count)
+    if getattr(usage, "cached_content_token_count", None):
+        LLM_TOKENS.labels(model, "cached").inc(usage.cached_content_token_count)
+
+
+def record_cache(kind: str, result: str):
+    """result: hit / near_hit / miss"""
+    CACHE_REQUESTS.labels(kind, result).inc()
+
+
+def record_connection(event: str):
+    """event: connections / tls_handshakes"""
+    LLM_CONNECTIONS.labels(event).inc()
+
+
+def record_job(kind: str, outcome: str):
+    """outcome: enqueued / succeeded / retried / dead / expired（租约过期后才处理完）"""
+    JOBS.labels(kind, outcome).inc()
+
+
+def _bind(gauge, fn):
+    if MULTIPROCESS:
+        # 共享文件里的值不会回调set_function，改为定期写入
+        _runtime.append((gauge, fn))
+    else:
+        gauge.set_function(fn)
+
+
+def _refresh_runtime():
+    for gauge, fn in _runtime:
+        gauge.set(fn())
+
+
+async def _refresh_runtime_forever():
+    while True:
+        _refresh_runtime()
+        await asyncio.sleep(RUNTIME_REFRESH_INTERVAL)
+
+
+def bind_runtime(llm=None, writer=None, admission=None):
+    """运行状态类指标在抓取时读取，不占用请求路径（在事件循环中调用）"""
+    global _refresh_task
+    if llm is not None and llm.guard is not None:
+        guard = llm.guard
+        _bind(LLM_CONCURRENCY_LIMIT, lambda: guard.limiter.limit)
+        _bind(LLM_IN_FLIGHT, lambda: guard.limiter.in_flight)
+        _bind(LLM_BREAKER_OPEN, lambda: _BREAKER_VALUES[guard.breaker.state])
+    if llm is not None and llm.transport is not None:
+        transport, sync = llm.transport, llm.mode == "thread"
+        _bind(LLM_POOL_CONNECTIONS.labels("active"), lambda: transport.pool_stats(sync)["active"])
+        _bind(LLM_POOL_CONNECTIONS.labels("idle"), lambda: transport.pool_stats(sync)["idle"])
+        _bind(LLM_POOL_QUEUED, lambda: transport.pool_stats(sync)["queued"])
+    if writer is not None:
+        _bind(WRITE_PENDING, lambda: writer.pending)
+    if admission is not None:
+        for name, lane in admission.lanes.items():
+            _bind(ADMISSION_QUEUED.labels(name), lambda lane=lane: lane.queued)
+            _bind(ADMISSION_IN_FLIGHT.labels(name), lambda lane=lane: lane.in_flight)
+    if _runtime and _refresh_task is None:
+        _refresh_task = asyncio.get_running_loop().create_task(_refresh_runtime_forever())
+
+
+def render() -> tuple[bytes, str]:
+    """返回 (指标文本, Content-Type)"""
+    if not MULTIPROCESS:
+        return generate_latest(), CONTENT_TYPE_LATEST
+    _refresh_runtime()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
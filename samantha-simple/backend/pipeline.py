@@ -0,0 +1,277 @@
+"""聊天处理流程
+
+负责情感分析和回复生成，支持三种模式：
+- sequential: 先情感分析，再生成回复（两次串行调用）
+- fused: 一次结构化输出调用同时返回情感和回复
+- speculative: 按本地分类器猜测的情感提前生成回复，与情感分析并行，完成后再核对
+"""
+import asyncio
+import json
+import logging
+
+from emotion import EMOTIONS, EmotionClassifier
+from metrics import record_error, track
+from prompts import PromptRegistry
+from tracing import current_span, set_usage, span
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_MODES = ("sequential", "fused", "speculative")
+# 情感分析后端：llm 每次调用Gemini；local 只用本地分类器；hybrid 本地置信度不足时再调用Gemini
+EMOTION_BACKENDS = ("llm", "local", "hybrid")
+
+FALLBACK_RESPONSE = "抱歉，我现在无法回应。请稍后再试。"
+
+
+def normalize_emotion(text: str) -> str:
+    """把模型返回的情感文本归一化为EMOTIONS中的标签"""
+    label = (text or "").strip().lower()
+    if label in EMOTIONS:
+        return label
+    for emotion in EMOTIONS:
+        if emotion in label:
+            return emotion
+    return "neutral"
+
+
+class ChatPipeline:
+    """情感分析 + 回复生成"""
+
+    def __init__(self, llm, mode: str = "sequential", emotion_backend: str = "llm",
+                 confidence_threshold: float = 0.5, classifier: EmotionClassifier = None,
+                 cache=None, batcher=None, prompts: PromptRegistry = None):
+        if mode not in PIPELINE_MODES:
+            raise ValueError(f"未知的处理模式: {mode}")
+        if emotion_backend not in EMOTION_BACKENDS:
+            raise ValueError(f"未知的情感分析后端: {emotion_backend}")
+        self.llm = llm
+        self.mode = mode
+        self.emotion_backend = emotion_backend
+        self.confidence_threshold = confidence_threshold
+        self.classifier = classifier or EmotionClassifier()
+        self.cache = cache
+        self.batcher = batcher
+        # prompt模板（见 prompts.py），模板版本参与回复缓存的键
+        self.prompts = prompts if prompts is not None else PromptRegistry()
+
+    async def analyze_emotion(self, text: str) -> str:
+        """分析文本情感"""
+        with track("emotion"), span("analyze_emotion", backend=self.emotion_backend) as current:
+            emotion = await self._analyze_emotion(text)
+            current.set_attribute("emotion", emotion)
+            return emotion
+
+    async def _analyze_emotion(self, text: str) -> str:
+        if self.emotion_backend != "llm":
+            emotion, confidence = self.classifier.classify(text)
+            if self.emotion_backend == "local" or confidence >= self.confidence_threshold:
+                logger.info(f"情感分析结果: {emotion} (本地, 置信度 {confidence:.2f})")
+                current_span().set_attribute("emotion.source", "local")
+                return emotion
+        return await self._analyze_emotion_llm(text)
+
+    async def reanalyze_emotion(self, text: str) -> str:
+        """不经过本地分类器，直接用Gemini分析情感，失败时抛出异常（供后台任务重试）"""
+        with track("emotion"), span("analyze_emotion", backend="llm") as current:
+            emotion = await self._classify_llm(text)
+            current.set_attribute("emotion", emotion)
+            return emotion
+
+    async def _classify_llm(self, text: str) -> str:
+        scope = (self.prompts.get("emotion").version,)
+        emotion = await self._cache_get("emotion", text, *scope)
+        if emotion is not None:
+            logger.info(f"情感分析结果: {emotion} (缓存)")
+            current_span().set_attribute("emotion.source", "cache")
+            return emotion
+        if self.batcher is not None:
+            emotion = normalize_emotion(await self.batcher.classify(text))
+            current_span().set_attribute("emotion.source", "batch")
+        else:
+            contents, gen_config = await self.prompts.build("emotion", text=text)
+            response = await self.llm.generate(contents, generation_config=gen_config)
+            emotion = normalize_emotion(response.text)
+            current_span().set_attribute("emotion.source", "llm")
+            set_usage(current_span(), None, response)
+        await self._cache_set("emotion", text, *scope, value=emotion)
+        logger.info(f"情感分析结果: {emotion}")
+        return emotion
+
+    async def _analyze_emotion_llm(self, text: str) -> str:
+        try:
+            return await self._classify_llm(text)
+        except Exception as e:
+            # 上游不可用时用本地分类结果兜底
+            record_error("emotion")
+            emotion, _ = self.classifier.classify(text)
+            current_span().set_attribute("emotion.source", "fallback")
+            logger.error(f"情感分析失败，使用本地结果 {emotion}: {e}")
+            return emotion
+
+    async def generate_response(self, message: str, emotion: str, history: str = "") -> str:
+        """生成AI回复，history为最近的对话历史"""
+        with track("generate"), span("generate_response", emotion=emotion):
+            return await self._generate_response(message, emotion, history)
+
+    async def _generate_response(self, message: str, emotion: str, history: str) -> str:
+        scope = self._response_scope("persona", history, emotion)
+        try:
+            ai_response = None if scope is None else await self._cache_get("response", message, *scope)
+            if ai_response is not None:
+                logger.info(f"AI回复命中缓存: {ai_response[:50]}...")
+                current_span().set_attribute("cache_hit", True)
+                return ai_response
+            contents, gen_config = await self.prompts.build(
+                "persona", emotion=emotion, history=history, message=message
+            )
+            response = await self.llm.generate(contents, generation_config=gen_config)
+            set_usage(current_span(), None, response)
+            ai_response = response.text.strip()
+            if scope is not None:
+                await self._cache_set("response", message, *scope, value=ai_response)
+            logger.info(f"AI回复生成成功: {ai_response[:50]}...")
+            return ai_response
+        except Exception as e:
+            record_error("generate")
+            current_span().set_attribute("fallback", True)
+            logger.error(f"AI回复生成失败: {e}")
+            return FALLBACK_RESPONSE
+
+    async def run(self, message: str, history: str = "") -> tuple[str, str]:
+        """处理一条消息，返回 (emotion, response)"""
+        if self.mode == "fused":
+            with track("fused"), span("fused_response"):
+                return await self._run_fused(message, history)
+        if self.mode == "speculative":
+            return await self._run_speculative(message, history)
+        return await self._run_sequential(message, history)
+
+    async def stream(self, message: str, history: str = ""):
+        """流式处理一条消息
+
+        先产出 ("emotion", 情感)，再逐段产出 ("delta", 文本)，
+        最后产出 ("done", 完整回复)。结构化输出无法流式返回，
+        fused 模式下同样先分析情感再流式生成。
+        """
+        emotion = await self.analyze_emotion(message)
+        yield "emotion", emotion
+
+        scope = self._response_scope("persona", history, emotion)
+        cached = None if scope is None else await self._cache_get("response", message, *scope)
+        if cached is not None:
+            logger.info(f"AI回复命中缓存: {cached[:50]}...")
+            yield "delta", cached
+            yield "done", cached
+            return
+
+        with track("generate"), span("generate_response", emotion=emotion, stream=True):
+            parts = []
+            completed = False
+            try:
+                contents, gen_config = await self.prompts.build(
+                    "persona", emotion=emotion, history=history, message=message
+                )
+                async for text in self.llm.stream(contents, generation_config=gen_config):
+                    if not parts:
+                        text = text.lstrip()
+                    parts.append(text)
+                    yield "delta", text
+                completed = True
+            except Exception as e:
+                record_error("generate")
+                logger.error(f"AI回复生成失败: {e}")
+
+            ai_response = "".join(parts).strip()
+            if completed and ai_response and scope is not None:
+                await self._cache_set("response", message, *scope, value=ai_response)
+        if not ai_response:
+            ai_response = FALLBACK_RESPONSE
+            yield "delta", ai_response
+        logger.info(f"AI回复生成成功: {ai_response[:50]}...")
+        yield "done", ai_response
+
+    async def _run_sequential(self, message: str, history: str) -> tuple[str, str]:
+        emotion = await self.analyze_emotion(message)
+        response = await self.generate_response(message, emotion, history)
+        return emotion, response
+
+    async def _run_fused(self, message: str, history: str) -> tuple[str, str]:
+        scope = self._response_scope("fused", history)
+        cached = None if scope is None else await self._cache_get("fused", message, *scope)
+        if cached is not None:
+            logger.info(f"AI回复命中缓存: {cached[1][:50]}...")
+            current_span().set_attribute("cache_hit", True)
+            return cached[0], cached[1]
+
+        try:
+            contents, gen_config = await self.prompts.build("fused", history=history, message=message)
+            result = await self.llm.generate(contents, generation_config=gen_config)
+        except Exception as e:
+            record_error("fused")
+            current_span().set_attribute("fallback", True)
+            logger.error(f"AI回复生成失败: {e}")
+            return "neutral", FALLBACK_RESPONSE
+        set_usage(current_span(), None, result)
+
+        try:
+            data = json.loads(result.text)
+            emotion = normalize_emotion(data.get("emotion"))
+            response = str(data.get("response") or "").strip()
+            if response and scope is not None:
+                await self._cache_set("fused", message, *scope, value=[emotion, response])
+        except (ValueError, AttributeError) as e:
+            # 结构化输出解析失败时把原文当作回复，不写入缓存
+            logger.warning(f"结构化输出解析失败: {e}")
+            emotion, response = "neutral", (result.text or "").strip()
+
+        if not response:
+            response = FALLBACK_RESPONSE
+        logger.info(f"情感分析结果: {emotion}")
+        logger.info(f"AI回复生成成功: {response[:50]}...")
+        return emotion, response
+
+    async def _run_speculative(self, message: str, history: str) -> tuple[str, str]:
+        guess, _ = self.classifier.classify(message)
+        reply_task = asyncio.create_task(self.generate_response(message, guess, history))
+        try:
+            emotion = await self.analyze_emotion(message)
+        except BaseException:
+            reply_task.cancel()
+            raise
+
+        if emotion == guess:
+            return emotion, await reply_task
+
+        # 猜错了：丢弃提前生成的回复，按真实情感重新生成
+        logger.info(f"推测情感 {guess} 与实际 {emotion} 不符，重新生成回复")
+        reply_task.cancel()
+        return emotion, await self.generate_response(message, emotion, history)
+
+    def _response_scope(self, template: str, history: str, *parts):
+        """回复缓存的scope，不缓存时返回None
+
+        带对话历史的回复取决于整个上下文（最近对话、摘要、相关记忆），
+        而历史每轮都在变，同一条消息几乎不可能再次命中，所以不查也不写缓存。
+        只缓存不带历史的请求：新用户的第一条消息、批量回放、关闭上下文的部署。
+        """
+        if history:
+            return None
+        return (*parts, self.prompts.get(template).version)
+
+    async def _cache_get(self, kind: str, message: str, *scope):
+        if self.cache is None:
+            return None
+        try:
+            return await self.cache.get(kind, message, *scope)
+        except Exception as e:
+            # 缓存故障不影响正常回复
+            logger.warning(f"读取缓存失败: {e}")
+            return None
+
+    async def _cache_set(self, kind: str, message: str, *scope, value):
+        if self.cache is None:
+            return
+        try:
+            await self.cache.set(kind, message, *scope, value=value)
+        except Exception as e:
+            logger.warning(f"写入缓存失败: {e}")
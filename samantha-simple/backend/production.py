@@ -0,0 +1,68 @@
+"""生产环境多worker运行
+
+配合 gunicorn.conf.py 使用：gunicorn主进程先导入耗时的依赖并完成建表，
+再fork出多个uvicorn worker。每个worker在开始接收请求前导入main，
+创建自己的Gemini客户端、数据库连接池和后台任务（这些资源不能跨fork共享）。
+"""
+import asyncio
+import importlib
+import logging
+import os
+
+from uvicorn.workers import UvicornWorker
+
+logger = logging.getLogger(__name__)
+
+# 主进程预先导入，worker通过fork共享已加载的模块（copy-on-write）
+PRELOAD_MODULES = (
+    "google.genai",
+    "google.genai.types",
+    "numpy",
+    "fastapi",
+    "pydantic",
+    "httpx",
+    "prometheus_client",
+)
+
+# 留给应用关闭（清空写入缓冲、关闭连接池）的时间（秒）
+SHUTDOWN_RESERVE = 5
+
+
+def default_workers() -> int:
+    """按当前进程可用的CPU核数决定worker数"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def preload():
+    """在主进程中导入依赖并建表，worker启动时不再重复"""
+    for module in PRELOAD_MODULES:
+        importlib.import_module(module)
+
+    from storage import create_store
+
+    async def init_schema():
+        store = create_store()
+        try:
+            await store.init_schema()
+        finally:
+            await store.close()
+
+    asyncio.run(init_schema())
+
+
+class SamanthaWorker(UvicornWorker):
+    """uvicorn worker：有uvloop和httptools时使用，收到SIGTERM后在限定时间内排空请求
+
+    uvicorn默认会无限期等待未结束的连接（例如流式响应），超过gunicorn的
+    graceful_timeout后worker会被直接杀掉，应用的shutdown不会执行，写入缓冲里的
+    对话就会丢失。这里让uvicorn提前结束等待，留出时间执行shutdown。
+    """
+
+    CONFIG_KWARGS = {"loop": "auto", "http": "auto"}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config.timeout_graceful_shutdown = max(self.cfg.graceful_timeout - SHUTDOWN_RESERVE, 1)
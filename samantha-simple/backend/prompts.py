@@ -0,0 +1,242 @@
+"""Prompt模板注册表
+
+模板在导入时编译一次：静态的人设和指令作为system instruction，
+每轮变化的部分（情感、历史、用户消息）才在请求时填充。
+模板带版本号，修改模板时递增，回复缓存的键里包含版本，旧结果自动失效。
+
+静态部分足够长（达到 min_cache_tokens）时，用Gemini上下文缓存保存system instruction，
+请求只引用缓存名，只有每轮的后缀按完整价格计费和预填充。
+缓存不可用（模型不支持、内容太短、创建失败）时退回普通的system instruction。
+"""
+import asyncio
+import logging
+import string
+import time
+
+from google.genai import types
+
+import config
+from context import estimate_tokens
+from emotion import EMOTIONS
+
+logger = logging.getLogger(__name__)
+
+# 上下文缓存创建失败后，多久再重试（秒）
+CACHE_RETRY_AFTER = 600
+# 缓存到期前多久重新创建（秒）
+CACHE_REFRESH_MARGIN = 60
+
+
+class PromptTemplate:
+    """编译后的prompt模板：system instruction + 每轮填充的后缀"""
+
+    def __init__(self, name: str, version: str, system: str, template: str,
+                 generation_config: types.GenerateContentConfig = None):
+        self.name = name
+        self.version = version
+        self.system = system.strip()
+        self.template = template
+        self.fields = frozenset(
+            field for _, field, _, _ in string.Formatter().parse(template) if field
+        )
+        self.system_tokens = estimate_tokens(self.system)
+        self._base = generation_config.model_dump(exclude_none=True) if generation_config else {}
+        self.config = types.GenerateContentConfig(**self._base, system_instruction=self.system)
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}@{self.version}"
+
+    def render(self, **values) -> str:
+        """填充每轮变化的部分"""
+        missing = self.fields - values.keys()
+        if missing:
+            raise KeyError(f"模板 {self.key} 缺少参数: {', '.join(sorted(missing))}")
+        return self.template.format_map(values)
+
+    def cached_config(self, cache_name: str) -> types.GenerateContentConfig:
+        """引用上下文缓存的请求配置（system instruction已在缓存里）"""
+        return types.GenerateContentConfig(**self._base, cached_content=cache_name)
+
+
+class _CachedPrefix:
+    __slots__ = ("name", "expires_at", "config")
+
+    def __init__(self, name: str, expires_at: float, config: types.GenerateContentConfig):
+        self.name = name
+        self.expires_at = expires_at
+        self.config = config
+
+
+EMOTION = PromptTemplate(
+    "emotion", "2",
+    system="分析文本的情感，只返回：happy, sad, angry, calm, neutral",
+    template="文本：{text}",
+)
+
+PERSONA = PromptTemplate(
+    "persona", "2",
+    system="""
+你是Samantha，一个智能、温暖的AI助手。
+
+请根据用户的情感状态提供合适的回应：
+- 如果用户情绪低落，提供温暖和支持
+- 如果用户情绪积极，分享快乐
+- 如果用户情绪愤怒，保持冷静和理解
+- 始终保持友好、有帮助的态度
+
+回复要简洁、自然，不超过100字。
+""",
+    template="用户当前情感状态：{emotion}\n\n{history}用户消息：{message}",
+)
+
+FUSED = PromptTemplate(
+    "fused", "2",
+    system="""
+你是Samantha，一个智能、温暖的AI助手。
+
+先判断用户消息的情感，只能是：happy, sad, angry, calm, neutral 之一。
+再根据用户的情感状态提供合适的回应：
+- 如果用户情绪低落，提供温暖和支持
+- 如果用户情绪积极，分享快乐
+- 如果用户情绪愤怒，保持冷静和理解
+- 始终保持友好、有帮助的态度
+
+回复要简洁、自然，不超过100字。
+以JSON返回，emotion为情感，response为回复。
+""",
+    template="{history}用户消息：{message}",
+    generation_config=types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=types.Schema(
+            type=types.Type.OBJECT,
+            properties={
+                "emotion": types.Schema(type=types.Type.STRING, enum=list(EMOTIONS)),
+                "response": types.Schema(type=types.Type.STRING),
+            },
+            required=["emotion", "response"],
+        ),
+    ),
+)
+
+EMOTION_BATCH = PromptTemplate(
+    "emotion_batch", "2",
+    system="""
+分析下面JSON数组中每条文本的情感，每条只能是：happy, sad, angry, calm, neutral 之一。
+按原顺序返回一个JSON数组，数组长度与输入相同。
+""",
+    template="文本：{texts}",
+    generation_config=types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=types.Schema(
+            type=types.Type.ARRAY,
+            items=types.Schema(type=types.Type.STRING, enum=list(EMOTIONS)),
+        ),
+    ),
+)
+
+SUMMARY = PromptTemplate(
+    "summary", "1",
+    system="""
+你负责维护Samantha和用户之间的长期对话摘要。
+把已有的摘要和新的对话合并成一份新的摘要：保留用户的身份、偏好、重要经历、
+情绪变化和还没聊完的话题，删去寒暄和重复的内容。
+用第三人称描述用户，只返回摘要本身。
+""",
+    template="摘要不超过{max_chars}字。\n\n已有的摘要：\n{summary}\n\n新的对话：\n{turns}",
+)
+
+BUILTIN_TEMPLATES = (EMOTION, PERSONA, FUSED, EMOTION_BATCH, SUMMARY)
+
+
+class PromptRegistry:
+    """按名称和版本管理模板，并维护静态前缀的上下文缓存"""
+
+    def __init__(self, templates=BUILTIN_TEMPLATES, llm=None, cache_enabled: bool = False,
+                 cache_ttl: float = 3600, min_cache_tokens: int = 1024):
+        self._templates = {}
+        self._latest = {}
+        for template in templates:
+            self.register(template)
+        self.llm = llm
+        self.cache_enabled = cache_enabled and llm is not None
+        self.cache_ttl = cache_ttl
+        self.min_cache_tokens = min_cache_tokens
+        # (模板key, 模型) -> _CachedPrefix；创建失败时记录下次重试的时间
+        self._caches = {}
+        self._failed_until = {}
+        self._creating = {}
+
+    def register(self, template: PromptTemplate, latest: bool = True):
+        """注册模板；latest=True 时作为该名称的默认版本"""
+        self._templates[(template.name, template.version)] = template
+        if latest or template.name not in self._latest:
+            self._latest[template.name] = template
+
+    def get(self, name: str, version: str = None) -> PromptTemplate:
+        if version is None:
+            return self._latest[name]
+        return self._templates[(name, version)]
+
+    async def build(self, name: str, model: str = None, version: str = None,
+                    **values) -> tuple[str, types.GenerateContentConfig]:
+        """返回 (本轮的contents, 请求配置)"""
+        template = self.get(name, version)
+        contents = template.render(**values)
+        if not self.cache_enabled or template.system_tokens < self.min_cache_tokens:
+            return contents, template.config
+        cached = await self._cached_prefix(template, model or config.GEMINI_MODEL)
+        return contents, cached.config if cached is not None else template.config
+
+    async def _cached_prefix(self, template: PromptTemplate, model: str):
+        key = (template.key, model)
+        now = time.monotonic()
+        cached = self._caches.get(key)
+        if cached is not None and cached.expires_at - CACHE_REFRESH_MARGIN > now:
+            return cached
+        if self._failed_until.get(key, 0) > now:
+            return None
+
+        # 同一个前缀只创建一次缓存，并发请求等待同一个结果
+        creating = self._creating.get(key)
+        if creating is None:
+            creating = asyncio.ensure_future(self._create(template, model))
+            self._creating[key] = creating
+            creating.add_done_callback(lambda _: self._creating.pop(key, None))
+        return await asyncio.shield(creating)
+
+    async def _create(self, template: PromptTemplate, model: str):
+        key = (template.key, model)
+        try:
+            name = await self.llm.create_cache(model, template.system, self.cache_ttl)
+        except Exception as e:
+            logger.warning(f"创建上下文缓存失败 ({template.key}, {model})，使用普通system instruction: {e}")
+            self._failed_until[key] = time.monotonic() + CACHE_RETRY_AFTER
+            self._caches.pop(key, None)
+            return None
+        cached = _CachedPrefix(name, time.monotonic() + self.cache_ttl, template.cached_config(name))
+        self._caches[key] = cached
+        logger.info(f"已创建上下文缓存 {name} ({template.key}, {model})")
+        return cached
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "templates": {name: template.version for name, template in self._latest.items()},
+            "context_cache": self.cache_enabled,
+            "cached_prefixes": [
+                {"template": key[0], "model": key[1], "name": cached.name,
+                 "expires_in": round(cached.expires_at - now)}
+                for key, cached in self._caches.items()
+            ],
+        }
+
+
+def create_registry(llm) -> PromptRegistry:
+    """按配置创建模板注册表"""
+    return PromptRegistry(
+        llm=llm,
+        cache_enabled=config.PROMPT_CACHE_ENABLED,
+        cache_ttl=config.PROMPT_CACHE_TTL,
+        min_cache_tokens=config.PROMPT_CACHE_MIN_TOKENS,
+    )
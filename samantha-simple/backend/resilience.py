@@ -0,0 +1,332 @@
+"""LLM调用的弹性控制
+
+- TokenBucket: 令牌桶限流，与Gemini配额匹配
+- AIMDLimiter: 加性增、乘性减的自适应并发上限
+- CircuitBreaker: 连续失败后熔断，熔断期间直接失败，由调用方返回兜底结果
+- ResilienceGuard: 组合以上三者，并提供带抖动的重试和总截止时间
+"""
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+from google.genai import errors as genai_errors
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# 表示上游过载的状态码，会让并发上限减半
+OVERLOAD_STATUS = {429, 503}
+
+
+class LLMUnavailableError(Exception):
+    """上游暂不可用，调用方应直接返回兜底结果"""
+
+
+class CircuitOpenError(LLMUnavailableError):
+    """熔断器处于打开状态"""
+
+
+class RateLimitedError(LLMUnavailableError):
+    """截止时间内拿不到限流令牌或并发槽位"""
+
+
+def _status_code(error: Exception):
+    if isinstance(error, genai_errors.APIError):
+        return error.code
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError, ConnectionError)):
+        return True
+    return _status_code(error) in RETRYABLE_STATUS
+
+
+def is_overload(error: Exception) -> bool:
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    return _status_code(error) in OVERLOAD_STATUS
+
+
+async def _first_chunk(iterator, timeout: float):
+    """在当前任务里取异步迭代器的第一段，超时抛出 asyncio.TimeoutError
+
+    不用 asyncio.wait_for：它会在新任务里（复制出的另一个context）运行 __anext__，
+    生成器里进入的span在那个context中设置，之后却在调用方的context中结束。
+    这里用定时器取消当前任务来实现超时，生成器始终在同一个context里执行。
+    """
+    task = asyncio.current_task()
+    timed_out = False
+
+    def expire():
+        nonlocal timed_out
+        timed_out = True
+        task.cancel()
+
+    handle = asyncio.get_running_loop().call_later(timeout, expire)
+    try:
+        return await iterator.__anext__()
+    except asyncio.CancelledError:
+        if not timed_out:
+            raise
+        # Python 3.11+ 记录了取消次数，自己发起的取消要撤回
+        if hasattr(task, "uncancel"):
+            task.uncancel()
+        raise asyncio.TimeoutError() from None
+    finally:
+        handle.cancel()
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积累 burst 个"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> float:
+        """不等待地取一个令牌；成功返回0，否则返回还需等待的秒数"""
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self, timeout: float = None) -> bool:
+        """取一个令牌；timeout内取不到返回False"""
+        async with self._lock:
+            self._refill()
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if timeout is not None and wait > timeout:
+                return False
+            if wait > 0:
+                # 持锁等待，保证先来的请求先拿到令牌
+                await asyncio.sleep(wait)
+                self._refill()
+            self._tokens -= 1
+            return True
+
+
+class AIMDLimiter:
+    """自适应并发上限
+
+    每个成功请求让上限增加 1/limit（约每轮增加1），
+    遇到过载信号（429、503、超时）时上限乘以 backoff。
+    """
+
+    def __init__(self, initial: int = 16, min_limit: int = 1, max_limit: int = 64,
+                 backoff: float = 0.5):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.in_flight = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, timeout: float = None):
+        async with self._cond:
+            await asyncio.wait_for(
+                self._cond.wait_for(lambda: self.in_flight < int(self.limit)),
+                timeout,
+            )
+            self.in_flight += 1
+
+    async def release(self, outcome: str = None):
+        """outcome: success / overload / None（失败或取消，不调整上限）"""
+        async with self._cond:
+            self.in_flight -= 1
+            if outcome == "success":
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif outcome == "overload":
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                logger.warning(f"上游过载，并发上限降为 {int(self.limit)}")
+            self._cond.notify_all()
+
+
+class CircuitBreaker:
+    """连续失败 failure_threshold 次后打开，reset_timeout 秒后放行一个探测请求"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def before_call(self):
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("熔断中，暂停调用Gemini")
+            self.state = "half_open"
+            self._probing = False
+        if self.state == "half_open":
+            if self._probing:
+                raise CircuitOpenError("熔断恢复探测中")
+            self._probing = True
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("熔断器关闭，恢复调用Gemini")
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.error(f"连续失败 {self.failures} 次，熔断 {self.reset_timeout} 秒")
+            self.state = "open"
+            self._opened_at = time.monotonic()
+        self._probing = False
+
+    def record_cancel(self):
+        """探测请求被取消时允许下一个请求继续探测"""
+        self._probing = False
+
+
+class ResilienceGuard:
+    """限流 + 自适应并发 + 熔断 + 重试"""
+
+    def __init__(self, limiter: AIMDLimiter, breaker: CircuitBreaker, bucket: TokenBucket = None,
+                 max_retries: int = 3, base_delay: float = 0.2, max_delay: float = 2.0,
+                 attempt_timeout: float = 30.0, deadline: float = 20.0):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.retries = 0
+        self.rejected = 0
+
+    async def _admit(self, deadline: float):
+        """熔断检查、取令牌、占并发槽位"""
+        loop = asyncio.get_running_loop()
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            self.rejected += 1
+            raise
+        try:
+            remaining = deadline - loop.time()
+            if self.bucket is not None and not await self.bucket.acquire(timeout=remaining):
+                raise RateLimitedError("等待限流令牌超时")
+            try:
+                await self.limiter.acquire(timeout=max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                raise RateLimitedError("等待并发槽位超时")
+        except BaseException:
+            self.rejected += 1
+            self.breaker.record_cancel()
+            raise
+
+    async def _after_failure(self, error: Exception, attempt: int, deadline: float) -> bool:
+        """记录一次失败；需要重试时等待退避时间并返回True"""
+        retryable = is_retryable(error)
+        await self.limiter.release("overload" if is_overload(error) else None)
+        if retryable:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_cancel()
+
+        loop = asyncio.get_running_loop()
+        # full jitter 指数退避
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if not retryable or attempt >= self.max_retries or loop.time() + delay >= deadline:
+            return False
+        logger.warning(f"Gemini调用失败，{delay:.2f}秒后重试 ({attempt + 1}/{self.max_retries}): {error}")
+        self.retries += 1
+        await asyncio.sleep(delay)
+        return True
+
+    async def call(self, fn):
+        """执行 fn() 返回的协程，失败时按策略重试"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        attempt = 0
+        while True:
+            await self._admit(deadline)
+            timeout = min(self.attempt_timeout, max(deadline - loop.time(), 0))
+            try:
+                result = await asyncio.wait_for(fn(), timeout)
+            except asyncio.CancelledError:
+                await self.limiter.release()
+                self.breaker.record_cancel()
+                raise
+            except Exception as e:
+                if await self._after_failure(e, attempt, deadline):
+                    attempt += 1
+                    continue
+                raise
+            await self.limiter.release("success")
+            self.breaker.record_success()
+            return result
+
+    async def stream(self, open_stream):
+        """流式版本：只在拿到第一段之前重试，之后的失败直接抛出"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        attempt = 0
+        while True:
+            await self._admit(deadline)
+            iterator = open_stream().__aiter__()
+            timeout = min(self.attempt_timeout, max(deadline - loop.time(), 0))
+            try:
+                first = await _first_chunk(iterator, timeout)
+                break
+            except StopAsyncIteration:
+                await self.limiter.release("success")
+                self.breaker.record_success()
+                return
+            except asyncio.CancelledError:
+                await self.limiter.release()
+                self.breaker.record_cancel()
+                raise
+            except Exception as e:
+                await iterator.aclose()
+                if await self._after_failure(e, attempt, deadline):
+                    attempt += 1
+                    continue
+                raise
+
+        outcome = None
+        try:
+            yield first
+            async for chunk in iterator:
+                yield chunk
+            outcome = "success"
+        except Exception as e:
+            if is_retryable(e):
+                self.breaker.record_failure()
+            if is_overload(e):
+                outcome = "overload"
+            raise
+        finally:
+            await self.limiter.release(outcome)
+            if outcome == "success":
+                self.breaker.record_success()
+            else:
+                self.breaker.record_cancel()
+
+    def stats(self) -> dict:
+        return {
+            "concurrency_limit": int(self.limiter.limit),
+            "in_flight": self.limiter.in_flight,
+            "breaker_state": self.breaker.state,
+            "retries": self.retries,
+            "rejected": self.rejected,
+        }
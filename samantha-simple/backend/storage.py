@@ -0,0 +1,437 @@
+"""对话持久化
+
+三种存储实现相同的接口（init_schema / save_conversation / save_conversations /
+get_history / update_emotions / get_summary / save_summary / close，均为async）：
+- SQLiteStore 维护一个小型长连接池，连接开启WAL模式和synchronous=NORMAL。
+  所有数据库操作都在专用线程池中执行，async代码调用时不会阻塞事件循环。单机部署使用。
+- PostgresStore 使用asyncpg连接池，多个worker或多台实例共享同一份历史。
+- InMemoryStore 只保存在进程内存中，用于测试和压测。
+"""
+import asyncio
+import bisect
+import logging
+import queue
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import config
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS conversations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        message TEXT,
+        response TEXT,
+        emotion TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    # 创建默认用户
+    "INSERT OR IGNORE INTO users (id, name) VALUES (1, 'Default User')",
+]
+
+# 数据库迁移：按顺序执行，已执行到的版本记录在 PRAGMA user_version
+MIGRATIONS = [
+    # 1: 历史查询索引。id随插入单调递增，与created_at同序且唯一，
+    # 按 (user_id, id) 建索引后，历史查询和游标分页都不需要全表扫描和排序
+    "CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations (user_id, id)",
+    # 2: 每个用户的滚动摘要，through_id 为已经并入摘要的最后一条对话
+    """
+    CREATE TABLE IF NOT EXISTS conversation_summaries (
+        user_id INTEGER PRIMARY KEY,
+        summary TEXT NOT NULL,
+        through_id INTEGER NOT NULL,
+        turns INTEGER NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+]
+
+# 固定SQL文本，配合连接的语句缓存复用预编译语句
+INSERT_CONVERSATION = """
+    INSERT INTO conversations (user_id, message, response, emotion)
+    VALUES (?, ?, ?, ?)
+"""
+
+UPDATE_EMOTION = "UPDATE conversations SET emotion = ? WHERE id = ?"
+
+SELECT_SUMMARY = "SELECT summary, through_id, turns FROM conversation_summaries WHERE user_id = ?"
+
+# 并发的两次合并以覆盖范围更大的为准，不会退回旧摘要
+UPSERT_SUMMARY = """
+    INSERT INTO conversation_summaries (user_id, summary, through_id, turns)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+        summary = excluded.summary,
+        through_id = excluded.through_id,
+        turns = excluded.turns,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE excluded.through_id > conversation_summaries.through_id
+"""
+
+SELECT_HISTORY = """
+    SELECT id, message, response, emotion, created_at
+    FROM conversations
+    WHERE user_id = ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+SELECT_HISTORY_BEFORE = """
+    SELECT id, message, response, emotion, created_at
+    FROM conversations
+    WHERE user_id = ? AND id < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+SELECT_HISTORY_AFTER = """
+    SELECT id, message, response, emotion, created_at
+    FROM conversations
+    WHERE user_id = ? AND id > ?
+    ORDER BY id ASC
+    LIMIT ?
+"""
+
+
+class SQLiteStore:
+    """带连接池的SQLite存储"""
+
+    def __init__(self, path: str = "samantha.db", pool_size: int = 4):
+        self.path = path
+        self.pool_size = pool_size
+        self._pool = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="sqlite")
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=5.0,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _with_connection(self, fn, *args):
+        """从池中取出一个连接执行fn，结束后归还"""
+        conn = self._pool.get()
+        try:
+            return fn(conn, *args)
+        finally:
+            self._pool.put(conn)
+
+    async def run(self, fn, *args):
+        """在数据库线程池中执行 fn(conn, *args)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._with_connection, fn, *args)
+
+    async def init_schema(self):
+        """建表并执行未完成的迁移，启动时调用"""
+        def create(conn):
+            with conn:
+                for statement in SCHEMA:
+                    conn.execute(statement)
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, statement in enumerate(MIGRATIONS[version:], start=version + 1):
+                with conn:
+                    conn.execute(statement)
+                    conn.execute(f"PRAGMA user_version = {number}")
+                logger.info(f"数据库迁移到版本 {number}")
+        await self.run(create)
+        logger.info("数据库初始化完成")
+
+    async def save_conversation(self, user_id: int, message: str, response: str, emotion: str):
+        """保存一轮对话"""
+        def insert(conn):
+            with conn:
+                conn.execute(INSERT_CONVERSATION, (user_id, message, response, emotion))
+        await self.run(insert)
+
+    async def save_conversations(self, records: list[tuple]):
+        """在一个事务中批量保存 (user_id, message, response, emotion) 记录"""
+        def insert_many(conn):
+            with conn:
+                conn.executemany(INSERT_CONVERSATION, records)
+        await self.run(insert_many)
+
+    async def get_history(self, user_id: int, limit: int = 50,
+                          before_id: int = None, after_id: int = None) -> list[dict]:
+        """按时间倒序获取用户的对话记录
+
+        before_id 取比该记录更早的一页，after_id 取比该记录更新的一页，
+        两者都不传时取最新的一页。
+        """
+        def select(conn):
+            if before_id is not None:
+                rows = conn.execute(SELECT_HISTORY_BEFORE, (user_id, before_id, limit)).fetchall()
+            elif after_id is not None:
+                rows = conn.execute(SELECT_HISTORY_AFTER, (user_id, after_id, limit)).fetchall()
+                rows.reverse()
+            else:
+                rows = conn.execute(SELECT_HISTORY, (user_id, limit)).fetchall()
+            return [dict(row) for row in rows]
+        return await self.run(select)
+
+    async def update_emotions(self, records: list[tuple]):
+        """在一个事务中批量更新 (emotion, id) 记录的情感标签"""
+        def update_many(conn):
+            with conn:
+                conn.executemany(UPDATE_EMOTION, records)
+        await self.run(update_many)
+
+    async def get_summary(self, user_id: int):
+        """返回用户的滚动摘要 {summary, through_id, turns}，没有时返回None"""
+        def select(conn):
+            row = conn.execute(SELECT_SUMMARY, (user_id,)).fetchone()
+            return dict(row) if row is not None else None
+        return await self.run(select)
+
+    async def save_summary(self, user_id: int, summary: str, through_id: int, turns: int):
+        """保存滚动摘要，只有覆盖到更新的对话时才会替换已有的摘要"""
+        def upsert(conn):
+            with conn:
+                conn.execute(UPSERT_SUMMARY, (user_id, summary, through_id, turns))
+        await self.run(upsert)
+
+    async def close(self):
+        """关闭线程池和所有连接"""
+        self._executor.shutdown(wait=True)
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+PG_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS conversations (
+        id BIGSERIAL PRIMARY KEY,
+        user_id INTEGER,
+        message TEXT,
+        response TEXT,
+        emotion TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "INSERT INTO users (id, name) VALUES (1, 'Default User') ON CONFLICT (id) DO NOTHING",
+    "CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations (user_id, id)",
+    """
+    CREATE TABLE IF NOT EXISTS conversation_summaries (
+        user_id INTEGER PRIMARY KEY,
+        summary TEXT NOT NULL,
+        through_id BIGINT NOT NULL,
+        turns INTEGER NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+]
+
+# 多个worker同时启动时用advisory lock串行建表
+PG_SCHEMA_LOCK = 0x5a3a7
+PG_INSERT_CONVERSATION = """
+    INSERT INTO conversations (user_id, message, response, emotion)
+    VALUES ($1, $2, $3, $4)
+"""
+PG_UPDATE_EMOTION = "UPDATE conversations SET emotion = $1 WHERE id = $2"
+PG_SELECT_SUMMARY = "SELECT summary, through_id, turns FROM conversation_summaries WHERE user_id = $1"
+PG_UPSERT_SUMMARY = """
+    INSERT INTO conversation_summaries (user_id, summary, through_id, turns)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (user_id) DO UPDATE SET
+        summary = excluded.summary,
+        through_id = excluded.through_id,
+        turns = excluded.turns,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE excluded.through_id > conversation_summaries.through_id
+"""
+# created_at 格式化成与SQLite相同的文本
+PG_COLUMNS = "id, message, response, emotion, to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at"
+PG_SELECT_HISTORY = f"""
+    SELECT {PG_COLUMNS}
+    FROM conversations
+    WHERE user_id = $1
+    ORDER BY id DESC
+    LIMIT $2
+"""
+PG_SELECT_HISTORY_BEFORE = f"""
+    SELECT {PG_COLUMNS}
+    FROM conversations
+    WHERE user_id = $1 AND id < $2
+    ORDER BY id DESC
+    LIMIT $3
+"""
+PG_SELECT_HISTORY_AFTER = f"""
+    SELECT {PG_COLUMNS}
+    FROM conversations
+    WHERE user_id = $1 AND id > $2
+    ORDER BY id ASC
+    LIMIT $3
+"""
+
+
+class PostgresStore:
+    """asyncpg连接池存储，需要安装 asyncpg"""
+
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self._pool = None
+
+    async def init_schema(self):
+        """创建连接池并建表，启动时调用"""
+        import asyncpg
+
+        if self._pool is None:
+            self._pool = await asyncpg.create_pool(
+                self.dsn, min_size=self.min_size, max_size=self.max_size
+            )
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", PG_SCHEMA_LOCK)
+                for statement in PG_SCHEMA:
+                    await conn.execute(statement)
+        logger.info("数据库初始化完成")
+
+    async def save_conversation(self, user_id: int, message: str, response: str, emotion: str):
+        """保存一轮对话"""
+        await self._pool.execute(PG_INSERT_CONVERSATION, user_id, message, response, emotion)
+
+    async def save_conversations(self, records: list[tuple]):
+        """在一个事务中批量保存 (user_id, message, response, emotion) 记录"""
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(PG_INSERT_CONVERSATION, records)
+
+    async def get_history(self, user_id: int, limit: int = 50,
+                          before_id: int = None, after_id: int = None) -> list[dict]:
+        """按时间倒序获取用户的对话记录，分页语义同 SQLiteStore.get_history"""
+        if before_id is not None:
+            rows = await self._pool.fetch(PG_SELECT_HISTORY_BEFORE, user_id, before_id, limit)
+        elif after_id is not None:
+            rows = await self._pool.fetch(PG_SELECT_HISTORY_AFTER, user_id, after_id, limit)
+            rows.reverse()
+        else:
+            rows = await self._pool.fetch(PG_SELECT_HISTORY, user_id, limit)
+        return [dict(row) for row in rows]
+
+    async def update_emotions(self, records: list[tuple]):
+        """在一个事务中批量更新 (emotion, id) 记录的情感标签"""
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(PG_UPDATE_EMOTION, records)
+
+    async def get_summary(self, user_id: int):
+        """返回用户的滚动摘要 {summary, through_id, turns}，没有时返回None"""
+        row = await self._pool.fetchrow(PG_SELECT_SUMMARY, user_id)
+        return dict(row) if row is not None else None
+
+    async def save_summary(self, user_id: int, summary: str, through_id: int, turns: int):
+        """保存滚动摘要，只有覆盖到更新的对话时才会替换已有的摘要"""
+        await self._pool.execute(PG_UPSERT_SUMMARY, user_id, summary, through_id, turns)
+
+    async def close(self):
+        """关闭连接池"""
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+
+class InMemoryStore:
+    """进程内存储，重启后丢失，用于测试和压测"""
+
+    def __init__(self):
+        self._next_id = 1
+        # user_id -> (id列表, 记录列表)，id递增，可以二分查找游标位置
+        self._users = {}
+        self._rows = {}
+        self._summaries = {}
+
+    async def init_schema(self):
+        pass
+
+    async def save_conversation(self, user_id: int, message: str, response: str, emotion: str):
+        """保存一轮对话"""
+        ids, rows = self._users.setdefault(user_id, ([], []))
+        row = {
+            "id": self._next_id,
+            "message": message,
+            "response": response,
+            "emotion": emotion,
+            "created_at": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        ids.append(self._next_id)
+        rows.append(row)
+        self._rows[self._next_id] = row
+        self._next_id += 1
+
+    async def save_conversations(self, records: list[tuple]):
+        """批量保存 (user_id, message, response, emotion) 记录"""
+        for record in records:
+            await self.save_conversation(*record)
+
+    async def get_history(self, user_id: int, limit: int = 50,
+                          before_id: int = None, after_id: int = None) -> list[dict]:
+        """按时间倒序获取用户的对话记录，分页语义同 SQLiteStore.get_history"""
+        ids, rows = self._users.get(user_id, ([], []))
+        if after_id is not None:
+            start = bisect.bisect_right(ids, after_id)
+            page = rows[start:start + limit]
+        else:
+            end = len(ids) if before_id is None else bisect.bisect_left(ids, before_id)
+            page = rows[max(end - limit, 0):end]
+        return [dict(row) for row in reversed(page)]
+
+    async def update_emotions(self, records: list[tuple]):
+        """批量更新 (emotion, id) 记录的情感标签"""
+        for emotion, conversation_id in records:
+            row = self._rows.get(conversation_id)
+            if row is not None:
+                row["emotion"] = emotion
+
+    async def get_summary(self, user_id: int):
+        """返回用户的滚动摘要 {summary, through_id, turns}，没有时返回None"""
+        summary = self._summaries.get(user_id)
+        return dict(summary) if summary is not None else None
+
+    async def save_summary(self, user_id: int, summary: str, through_id: int, turns: int):
+        """保存滚动摘要，只有覆盖到更新的对话时才会替换已有的摘要"""
+        current = self._summaries.get(user_id)
+        if current is None or through_id > current["through_id"]:
+            self._summaries[user_id] = {"summary": summary, "through_id": through_id, "turns": turns}
+
+    async def close(self):
+        pass
+
+
+def create_store():
+    """按配置创建对话存储"""
+    if config.STORAGE_BACKEND == "postgres":
+        return PostgresStore(config.DATABASE_URL, max_size=config.DB_POOL_SIZE)
+    if config.STORAGE_BACKEND == "memory":
+        return InMemoryStore()
+    if config.STORAGE_BACKEND != "sqlite":
+        raise ValueError(f"未知的存储后端: {config.STORAGE_BACKEND}")
+    return SQLiteStore(config.DB_PATH, pool_size=config.DB_POOL_SIZE)
@@ -0,0 +1,122 @@
+"""滚动对话摘要
+
+每个用户维护一份摘要，记录已经并入摘要的最后一条对话id（through_id）。
+用户每新增 every 轮对话就提交一个后台任务，把摘要之后、最近 keep_recent 轮之前的
+对话并入摘要；最近的几轮由 ContextAssembler 原样提供。
+拼入prompt的只有长度固定的摘要和最近几轮，不随对话总数增长。
+"""
+import logging
+import time
+from collections import OrderedDict
+
+from context import render_turn
+from metrics import track
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# 摘要在进程内缓存的时间（秒），其他进程合并后最多过这么久可见
+SUMMARY_CACHE_TTL = 300
+
+
+class ConversationSummarizer:
+    """按用户增量合并对话摘要"""
+
+    def __init__(self, llm, store, prompts, every: int = 20, keep_recent: int = 20,
+                 max_chars: int = 300, fold_limit: int = 100, max_users: int = 10000):
+        self.llm = llm
+        self.store = store
+        self.prompts = prompts
+        self.every = every
+        self.keep_recent = keep_recent
+        self.max_chars = max_chars
+        # 一次合并的最大轮数，积压更多时分多次合并
+        self.fold_limit = fold_limit
+        self.max_users = max_users
+        # user_id -> 上次提交任务后新增的轮数
+        self._counts = OrderedDict()
+        # user_id -> (读取时间, 摘要文本)
+        self._cache = OrderedDict()
+        self._folding = set()
+        self.folds = 0
+        self.folded_turns = 0
+
+    def record_turn(self, user_id: int) -> bool:
+        """记录新的一轮对话，需要合并摘要时返回True"""
+        count = self._counts.pop(user_id, 0) + 1
+        if count >= self.every:
+            return True
+        self._counts[user_id] = count
+        while len(self._counts) > self.max_users:
+            self._counts.popitem(last=False)
+        return False
+
+    async def get(self, user_id: int) -> str:
+        """返回用户的摘要，没有时返回空字符串"""
+        cached = self._cache.get(user_id)
+        if cached is not None and time.monotonic() - cached[0] < SUMMARY_CACHE_TTL:
+            self._cache.move_to_end(user_id)
+            return cached[1]
+        row = await self.store.get_summary(user_id)
+        summary = row["summary"] if row is not None else ""
+        self._remember(user_id, summary)
+        return summary
+
+    def _remember(self, user_id: int, summary: str):
+        self._cache[user_id] = (time.monotonic(), summary)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_users:
+            self._cache.popitem(last=False)
+
+    async def fold(self, user_id: int) -> bool:
+        """把积压的较早对话并入摘要，还有积压需要再次合并时返回True"""
+        if user_id in self._folding:
+            return False
+        self._folding.add(user_id)
+        try:
+            with track("summarize"), span("summarize", user_id=user_id) as current:
+                return await self._fold(user_id, current)
+        finally:
+            self._folding.discard(user_id)
+
+    async def _fold(self, user_id: int, current) -> bool:
+        row = await self.store.get_summary(user_id)
+        summary = row["summary"] if row is not None else ""
+        through_id = row["through_id"] if row is not None else 0
+        turns = row["turns"] if row is not None else 0
+
+        # 摘要之后最早的一页，留下最近的 keep_recent 轮不合并
+        page = await self.store.get_history(user_id, self.fold_limit + self.keep_recent, after_id=through_id)
+        page.reverse()
+        batch = page[:max(len(page) - self.keep_recent, 0)]
+        current.set_attribute("turns", len(batch))
+        if len(batch) < self.every:
+            return False
+
+        contents, gen_config = await self.prompts.build(
+            "summary",
+            max_chars=self.max_chars,
+            summary=summary or "（无）",
+            turns="".join(render_turn(r["message"], r["response"]) for r in batch),
+        )
+        response = await self.llm.generate(contents, generation_config=gen_config)
+        new_summary = (response.text or "").strip()[:self.max_chars]
+        if not new_summary:
+            raise RuntimeError("摘要为空")
+
+        await self.store.save_summary(user_id, new_summary, batch[-1]["id"], turns + len(batch))
+        self._remember(user_id, new_summary)
+        self.folds += 1
+        self.folded_turns += len(batch)
+        logger.info(f"用户 {user_id} 的摘要已合并 {len(batch)} 轮（共 {turns + len(batch)} 轮）")
+        # 取到的是满页，说明后面还有积压
+        return len(page) == self.fold_limit + self.keep_recent
+
+    def stats(self) -> dict:
+        return {
+            "folds": self.folds,
+            "folded_turns": self.folded_turns,
+            "cached_users": len(self._cache),
+            "every": self.every,
+            "keep_recent": self.keep_recent,
+        }
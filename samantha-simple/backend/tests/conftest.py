@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 后端模块按脚本方式互相导入（import config 等），测试时把 backend/ 加入搜索路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
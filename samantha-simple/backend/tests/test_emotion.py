@@ -0,0 +1,82 @@
+from emotion import EmotionClassifier
+
+THRESHOLD = 0.5
+
+# 带标注的小样本，覆盖闲聊、疑问、单个情感词、否定和词典以外的情绪表达
+SAMPLE = [
+    ("你好，Samantha！", "neutral"),
+    ("今天天气怎么样", "neutral"),
+    ("周末想去海边走走，有什么建议吗", "neutral"),
+    ("帮我推荐一本书", "neutral"),
+    ("明天早上八点提醒我开会", "neutral"),
+    ("你是谁", "neutral"),
+    ("我在上班", "neutral"),
+    ("晚饭吃了面条", "neutral"),
+    ("what time is it", "neutral"),
+    ("can you recommend a movie", "neutral"),
+    ("I'm going to the store", "neutral"),
+    ("tell me a joke", "neutral"),
+    ("我刚刚拿到了offer，太开心了！", "happy"),
+    ("哈哈哈 太好了", "happy"),
+    ("谢谢你一直陪着我", "happy"),
+    ("今天和朋友玩得很开心", "happy"),
+    ("I'm so happy today", "happy"),
+    ("thanks, that was awesome", "happy"),
+    ("I love this song", "happy"),
+    ("今天工作好累，什么都不想做", "sad"),
+    ("我好难过", "sad"),
+    ("一个人好孤独", "sad"),
+    ("我不开心", "sad"),
+    ("I feel so lonely", "sad"),
+    ("I miss my family", "sad"),
+    ("I am not happy", "sad"),
+    ("为什么总是有人插队，气死我了", "angry"),
+    ("真是烦死了", "angry"),
+    ("我受够了这个垃圾系统", "angry"),
+    ("I hate mondays", "angry"),
+    ("this is so annoying", "angry"),
+    ("给我讲一个轻松一点的小故事吧", "calm"),
+    ("今天在公园散步，很惬意", "calm"),
+    ("终于可以休息一下了", "calm"),
+    ("I feel relaxed", "calm"),
+    ("just chilling at home", "calm"),
+    ("我在准备考试，有点紧张", "sad"),
+    ("最近睡眠不太好，晚上总是醒", "sad"),
+    ("I don't really love this", "sad"),
+    ("not bad", "calm"),
+]
+
+classifier = EmotionClassifier()
+
+
+def test_sample_escalation_rate_and_local_accuracy():
+    local = [(classifier.classify(text), label) for text, label in SAMPLE]
+    local = [(emotion, label) for (emotion, confidence), label in local if confidence >= THRESHOLD]
+    escalated = len(SAMPLE) - len(local)
+    # 当前为 16/40：hybrid模式省掉一半以上的Gemini调用
+    assert escalated / len(SAMPLE) <= 0.5
+    # 留在本地的结果都要对，拿不准的交给Gemini
+    assert all(emotion == label for emotion, label in local)
+
+
+def test_clean_single_hit_stays_local():
+    for text, expected in [("我好难过", "sad"), ("I hate mondays", "angry"), ("今天天气怎么样", "neutral")]:
+        emotion, confidence = classifier.classify(text)
+        assert emotion == expected
+        assert confidence >= THRESHOLD
+
+
+def test_negation_and_conflict_escalate():
+    for text in ["I am not happy", "I don't really love this", "I'm happy but also sad"]:
+        _, confidence = classifier.classify(text)
+        assert confidence < THRESHOLD
+
+
+def test_negation_stays_within_clause():
+    emotion, _ = classifier.classify("not sure why. I'm so happy and excited")
+    assert emotion == "happy"
+
+
+def test_no_lexicon_hit_escalates():
+    _, confidence = classifier.classify("晚饭吃了面条")
+    assert confidence < THRESHOLD
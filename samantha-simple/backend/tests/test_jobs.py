@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+
+from jobs import JobQueue, MemoryBroker, QueueFull, SQLiteBroker
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_broker(request, tmp_path):
+    def make(**kwargs):
+        if request.param == "memory":
+            return MemoryBroker(**kwargs)
+        return SQLiteBroker(str(tmp_path / "jobs.db"), **kwargs)
+    return make
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_late_ack_from_expired_lease_is_ignored(make_broker):
+    async def main():
+        broker = make_broker()
+        await broker.init()
+        await broker.enqueue("work", {"n": 1})
+        first = await broker.reserve(lease=0.05)
+        await asyncio.sleep(0.1)
+        # 租约过期，任务被另一个worker重新领取
+        second = await broker.reserve(lease=60)
+        assert second.id == first.id and second.attempts == 2
+        assert first.attempts == 1
+
+        # 原来的worker迟到的确认不能结束新的租约
+        assert not await broker.ack(first)
+        assert not await broker.retry(first, 0, "late")
+        assert not await broker.bury(first, "late")
+        assert (await broker.stats())["leased"] == 1
+
+        assert await broker.ack(second)
+        stats = await broker.stats()
+        assert stats["leased"] == stats["ready"] == stats["dead"] == 0
+        await broker.close()
+    run(main())
+
+
+def test_enqueue_respects_max_pending(make_broker):
+    async def main():
+        broker = make_broker(max_pending=3)
+        await broker.init()
+        for n in range(3):
+            await broker.enqueue("work", {"n": n})
+        with pytest.raises(QueueFull):
+            await broker.enqueue("work", {"n": 3})
+        await broker.close()
+    run(main())
+
+
+def test_queue_retries_then_succeeds(make_broker):
+    async def main():
+        queue = JobQueue(make_broker(), workers=2, base_delay=0.01, max_delay=0.02, poll_interval=0.01)
+        calls = []
+
+        async def flaky(n):
+            calls.append(n)
+            if len(calls) < 3:
+                raise RuntimeError("boom")
+
+        queue.register("flaky", flaky)
+        await queue.start()
+        await queue.submit("flaky", n=1)
+        for _ in range(200):
+            if queue.counts.get("flaky", {}).get("succeeded"):
+                break
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        assert calls == [1, 1, 1]
+        assert queue.counts["flaky"] == {"enqueued": 1, "retried": 2, "succeeded": 1}
+    run(main())
+
+
+def test_queue_dead_letters_after_max_attempts(make_broker):
+    async def main():
+        broker = make_broker()
+        queue = JobQueue(broker, workers=1, max_attempts=3, base_delay=0.01, max_delay=0.01,
+                         poll_interval=0.01)
+
+        async def broken():
+            raise ValueError("always")
+
+        queue.register("broken", broken)
+        await queue.start()
+        await queue.submit("broken")
+        for _ in range(200):
+            if queue.counts.get("broken", {}).get("dead"):
+                break
+            await asyncio.sleep(0.01)
+        stats = await broker.stats()
+        await queue.stop()
+        assert queue.counts["broken"] == {"enqueued": 1, "retried": 2, "dead": 1}
+        assert stats["dead"] == 1
+        assert stats["recent_dead"][0]["attempts"] == 3
+        assert "ValueError: always" in stats["recent_dead"][0]["error"]
+    run(main())
+
+
+def test_visibility_timeout_hands_job_to_another_worker(make_broker):
+    async def main():
+        queue = JobQueue(make_broker(), workers=2, visibility_timeout=0.1, base_delay=0.01,
+                         max_delay=0.01, poll_interval=0.01)
+        attempts = []
+
+        async def slow():
+            attempts.append(len(attempts) + 1)
+            if len(attempts) == 1:
+                # 第一次处理超过租约时间，被wait_for取消
+                await asyncio.sleep(1)
+
+        queue.register("slow", slow)
+        await queue.start()
+        await queue.submit("slow")
+        for _ in range(200):
+            if queue.counts.get("slow", {}).get("succeeded"):
+                break
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        assert attempts == [1, 2]
+        assert queue.counts["slow"]["succeeded"] == 1
+    run(main())
+
+
+def test_memory_queue_drains_on_stop():
+    async def main():
+        queue = JobQueue(MemoryBroker(), workers=2, poll_interval=0.01)
+        done = []
+
+        async def work(n):
+            await asyncio.sleep(0.01)
+            done.append(n)
+
+        queue.register("work", work)
+        await queue.start()
+        for n in range(20):
+            await queue.submit("work", n=n)
+        await queue.stop(timeout=5)
+        assert sorted(done) == list(range(20))
+    run(main())
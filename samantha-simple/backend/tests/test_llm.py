@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from llm import SingleFlight
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_concurrent_calls_share_one_request():
+    async def main():
+        flight = SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "reply"
+
+        results = await asyncio.gather(*(flight.do("key", fetch) for _ in range(5)))
+        assert results == ["reply"] * 5
+        assert len(calls) == 1
+        assert flight.stats() == {"in_flight": 0, "started": 1, "coalesced": 4}
+        # 完成后相同的键重新发起请求
+        await flight.do("key", fetch)
+        assert len(calls) == 2
+    run(main())
+
+
+def test_cancelling_one_waiter_keeps_request_running():
+    async def main():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            return "reply"
+
+        first = asyncio.create_task(flight.do("key", fetch))
+        second = asyncio.create_task(flight.do("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        assert flight.in_flight == 1
+        release.set()
+        assert await second == "reply"
+        with pytest.raises(asyncio.CancelledError):
+            await first
+    run(main())
+
+
+def test_cancelling_last_waiter_cancels_request():
+    async def main():
+        flight = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def fetch():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(flight.do("key", fetch)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert flight.in_flight == 0
+
+        # 被取消的请求不会被后来的调用复用
+        async def fresh():
+            return "fresh"
+
+        assert await flight.do("key", fresh) == "fresh"
+    run(main())
+
+
+def test_errors_reach_every_waiter():
+    async def main():
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream")
+
+        results = await asyncio.gather(
+            *(flight.do("key", fail) for _ in range(3)), return_exceptions=True
+        )
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert flight.in_flight == 0
+    run(main())
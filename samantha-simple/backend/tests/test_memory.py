@@ -0,0 +1,65 @@
+import asyncio
+import multiprocessing
+import os
+
+import numpy as np
+
+from memory import HashingEmbedder, LongTermMemory, VectorIndex
+
+DIM = 64
+
+
+def _write(directory: str, writer: int, count: int):
+    """在独立进程里向同一个用户的索引写入 count 条记忆"""
+    async def run():
+        memory = LongTermMemory(HashingEmbedder(DIM), directory)
+        for i in range(count):
+            await memory.remember(1, f"writer {writer} message {i}", "ok")
+        memory.close()
+    asyncio.run(run())
+
+
+def test_two_writers_share_one_index(tmp_path):
+    ctx = multiprocessing.get_context("spawn")
+    # 两个进程合计写入超过初始容量（256），中途会扩容向量文件
+    writers = [ctx.Process(target=_write, args=(str(tmp_path), w, 150)) for w in range(2)]
+    for p in writers:
+        p.start()
+    for p in writers:
+        p.join(60)
+        assert p.exitcode == 0
+
+    index = VectorIndex(str(tmp_path / "1"), DIM)
+    assert index.count == 300
+    expected = {f"用户：writer {w} message {i}\nSamantha：ok" for w in range(2) for i in range(150)}
+    assert set(index.texts) == expected
+
+    # 每一行向量都对应同一行的文本，没有被另一个进程覆盖或错位
+    embedder = HashingEmbedder(DIM)
+    for row, text in enumerate(index.texts):
+        message = text.split("\n")[0][len("用户："):]
+        np.testing.assert_allclose(index.vectors[row], embedder._embed_one(f"{message}\nok"), atol=1e-6)
+    index.close()
+
+
+def test_reader_sees_records_from_another_instance(tmp_path):
+    async def run():
+        reader = LongTermMemory(HashingEmbedder(DIM), str(tmp_path), min_score=0.0)
+        writer = LongTermMemory(HashingEmbedder(DIM), str(tmp_path))
+        await writer.remember(1, "first", "ok")
+        assert len(await reader.recall(1, "first")) == 1
+        # reader已经打开了索引，之后另一个实例追加的记录也要读到
+        await writer.remember(1, "second", "ok")
+        assert len(await reader.recall(1, "second")) == 2
+        reader.close()
+        writer.close()
+    asyncio.run(run())
+
+
+def test_recall_without_memories_creates_no_files(tmp_path):
+    async def run():
+        memory = LongTermMemory(HashingEmbedder(DIM), str(tmp_path))
+        assert await memory.recall(42, "hello") == []
+        memory.close()
+    asyncio.run(run())
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,198 @@
+import asyncio
+import contextvars
+
+import httpx
+import pytest
+
+from resilience import AIMDLimiter, CircuitBreaker, CircuitOpenError, ResilienceGuard, TokenBucket
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def make_guard(**kwargs):
+    kwargs.setdefault("base_delay", 0.001)
+    kwargs.setdefault("max_delay", 0.002)
+    return ResilienceGuard(AIMDLimiter(initial=4), CircuitBreaker(failure_threshold=3), **kwargs)
+
+
+def test_token_bucket_burst_then_wait():
+    async def main():
+        bucket = TokenBucket(rate=20, burst=2)
+        assert bucket.try_acquire() == 0
+        assert bucket.try_acquire() == 0
+        # 令牌用完，约1/20秒后补充一个
+        assert 0 < bucket.try_acquire() <= 0.05
+        assert not await bucket.acquire(timeout=0.001)
+        assert await bucket.acquire(timeout=0.2)
+    run(main())
+
+
+def test_aimd_grows_on_success_and_halves_on_overload():
+    async def main():
+        limiter = AIMDLimiter(initial=4, min_limit=1, max_limit=5)
+        for _ in range(4):
+            await limiter.acquire()
+            await limiter.release("success")
+        # 每次成功增加 1/limit，4次约增加1
+        assert 4.9 < limiter.limit < 5
+        for _ in range(10):
+            await limiter.acquire()
+            await limiter.release("success")
+        assert limiter.limit == 5
+
+        await limiter.acquire()
+        await limiter.release("overload")
+        assert limiter.limit == 2.5
+        for _ in range(3):
+            await limiter.acquire()
+            await limiter.release("overload")
+        assert limiter.limit == 1
+        # 失败或取消不调整上限
+        await limiter.acquire()
+        await limiter.release(None)
+        assert limiter.limit == 1 and limiter.in_flight == 0
+    run(main())
+
+
+def test_aimd_blocks_at_limit():
+    async def main():
+        limiter = AIMDLimiter(initial=2)
+        await limiter.acquire()
+        await limiter.acquire()
+        with pytest.raises(asyncio.TimeoutError):
+            await limiter.acquire(timeout=0.01)
+        waiter = asyncio.create_task(limiter.acquire(timeout=1))
+        await asyncio.sleep(0)
+        await limiter.release("success")
+        await waiter
+        assert limiter.in_flight == 2
+    run(main())
+
+
+def test_circuit_breaker_transitions():
+    async def main():
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        breaker.before_call()
+        breaker.record_failure()
+        assert breaker.state == "closed"
+        breaker.record_failure()
+        assert breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+        await asyncio.sleep(0.06)
+        # 只放行一个探测请求
+        breaker.before_call()
+        assert breaker.state == "half_open"
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+        # 探测被取消，下一个请求接着探测；探测失败立即重新打开
+        breaker.record_cancel()
+        breaker.before_call()
+        breaker.record_failure()
+        assert breaker.state == "open"
+
+        await asyncio.sleep(0.06)
+        breaker.before_call()
+        breaker.record_success()
+        assert breaker.state == "closed" and breaker.failures == 0
+        breaker.before_call()
+    run(main())
+
+
+def test_call_retries_transient_errors():
+    async def main():
+        guard = make_guard()
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise httpx.ConnectError("reset")
+            return "ok"
+
+        assert await guard.call(flaky) == "ok"
+        assert guard.retries == 2
+        assert guard.limiter.in_flight == 0
+        assert guard.breaker.state == "closed"
+    run(main())
+
+
+def test_call_opens_breaker_after_repeated_failures():
+    async def main():
+        guard = make_guard(max_retries=0)
+
+        async def broken():
+            raise httpx.ConnectError("down")
+
+        for _ in range(3):
+            with pytest.raises(httpx.ConnectError):
+                await guard.call(broken)
+        with pytest.raises(CircuitOpenError):
+            await guard.call(broken)
+        assert guard.limiter.in_flight == 0
+    run(main())
+
+
+_var = contextvars.ContextVar("test_var", default=None)
+
+
+def test_stream_runs_generator_in_caller_context():
+    async def main():
+        guard = make_guard()
+
+        async def chunks():
+            # 和span一样：进入时设置，结束时用token重置，要求在同一个context中
+            token = _var.set("inside")
+            try:
+                yield "a"
+                yield "b"
+            finally:
+                _var.reset(token)
+
+        got = [chunk async for chunk in guard.stream(chunks)]
+        assert got == ["a", "b"]
+        assert _var.get() is None
+        assert guard.limiter.in_flight == 0
+    run(main())
+
+
+def test_stream_retries_when_first_chunk_times_out():
+    async def main():
+        guard = make_guard(attempt_timeout=0.05)
+        opened = []
+
+        async def chunks():
+            opened.append(1)
+            if len(opened) == 1:
+                await asyncio.sleep(10)
+            yield "late"
+
+        got = [chunk async for chunk in guard.stream(chunks)]
+        assert got == ["late"]
+        assert len(opened) == 2 and guard.retries == 1
+        assert guard.limiter.in_flight == 0
+    run(main())
+
+
+def test_stream_outer_cancel_is_not_a_timeout():
+    async def main():
+        guard = make_guard(attempt_timeout=5)
+
+        async def chunks():
+            await asyncio.sleep(10)
+            yield "never"
+
+        async def consume():
+            return [chunk async for chunk in guard.stream(chunks)]
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.02)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert guard.retries == 0
+        assert guard.limiter.in_flight == 0
+    run(main())
@@ -0,0 +1,16 @@
+import os
+
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT = os.path.dirname(BACKEND)
+
+
+# Vercel入口各自带一份存储模块的副本，修改backend/后要同步复制
+@pytest.mark.parametrize("deploy", ["api", os.path.join("vercel-deploy", "api")])
+@pytest.mark.parametrize("name", ["storage.py", "config.py"])
+def test_vendored_copy_matches_backend(deploy, name):
+    with open(os.path.join(BACKEND, name), "rb") as f:
+        expected = f.read()
+    with open(os.path.join(ROOT, deploy, name), "rb") as f:
+        assert f.read() == expected, f"{deploy}/{name} 与 backend/{name} 不一致，请重新复制"
@@ -0,0 +1,74 @@
+import asyncio
+
+from storage import InMemoryStore
+from writer import ConversationWriter
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class SlowStore(InMemoryStore):
+    """每次批量写入都要等一会，模拟stop()时仍有写入在进行"""
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    async def save_conversations(self, records):
+        self.batches.append(len(records))
+        await asyncio.sleep(0.02)
+        await super().save_conversations(records)
+
+
+class FlakyStore(InMemoryStore):
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+
+    async def save_conversations(self, records):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("database is locked")
+        await super().save_conversations(records)
+
+
+def test_stop_drains_every_pending_record():
+    async def main():
+        store = SlowStore()
+        writer = ConversationWriter(store, batch_size=10, flush_interval=1)
+        writer.start()
+        for i in range(35):
+            await writer.submit(1, f"message {i}", f"reply {i}", "neutral")
+        # 让后台任务取走第一批，stop()时有写入在进行、有未满的批次、队列里还有记录
+        await asyncio.sleep(0.01)
+        await writer.stop()
+
+        assert writer.pending == 0
+        history = await store.get_history(1, limit=100)
+        assert sorted(row["message"] for row in history) == sorted(f"message {i}" for i in range(35))
+        assert max(store.batches) <= 10
+    run(main())
+
+
+def test_records_flush_after_interval_without_stop():
+    async def main():
+        store = InMemoryStore()
+        writer = ConversationWriter(store, batch_size=100, flush_interval=0.01)
+        writer.start()
+        await writer.submit(7, "hi", "hello", "happy")
+        await asyncio.sleep(0.1)
+        assert len(await store.get_history(7)) == 1
+        await writer.stop()
+    run(main())
+
+
+def test_failed_flush_is_retried():
+    async def main():
+        store = FlakyStore(failures=1)
+        writer = ConversationWriter(store, flush_interval=0.01)
+        writer.start()
+        await writer.submit(3, "hi", "hello", "calm")
+        await writer.stop()
+        assert len(await store.get_history(3)) == 1
+    run(main())
@@ -0,0 +1,213 @@
+"""请求追踪
+
+仿照OpenTelemetry的span模型：每个HTTP请求是一个trace，情感分析、回复生成、
+Gemini调用和数据库操作是其中的span。父子关系通过contextvars在协程间传递。
+采样在trace开始时决定，结束的span写入进程内的环形缓冲，
+通过 /debug/traces 以JSON查看，不需要外部collector。
+"""
+import contextvars
+import os
+import random
+import re
+import time
+from collections import OrderedDict, deque
+
+_current = contextvars.ContextVar("samantha_span", default=None)
+
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns",
+                 "attributes", "status")
+
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, attributes: dict = None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.status = "ok"
+
+    @property
+    def recording(self) -> bool:
+        return True
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_ns / 1e9,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _NonRecordingSpan:
+    """未被采样的trace中的span，所有操作都是空操作"""
+
+    __slots__ = ()
+    trace_id = None
+    recording = False
+
+    def set_attribute(self, key: str, value):
+        pass
+
+
+NON_RECORDING = _NonRecordingSpan()
+
+
+class RingBufferExporter:
+    """保存最近结束的span"""
+
+    def __init__(self, max_spans: int = 2000):
+        self._spans = deque(maxlen=max_spans)
+
+    def export(self, span: Span):
+        self._spans.append(span)
+
+    def traces(self, limit: int = 20, trace_id: str = None) -> list[dict]:
+        """按trace分组，最新的trace在前"""
+        grouped = OrderedDict()
+        for span in reversed(self._spans):
+            if trace_id is not None and span.trace_id != trace_id:
+                continue
+            grouped.setdefault(span.trace_id, []).append(span)
+        result = []
+        for tid, spans in list(grouped.items())[:limit]:
+            spans.sort(key=lambda s: s.start_ns)
+            result.append({"trace_id": tid, "spans": [s.to_dict() for s in spans]})
+        return result
+
+
+class _SpanScope:
+    """span的上下文管理器：进入时设为当前span，退出时结束并导出"""
+
+    __slots__ = ("_tracer", "_span", "_token")
+
+    def __init__(self, tracer, span):
+        self._tracer = tracer
+        self._span = span
+
+    def __enter__(self):
+        self._token = _current.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # 异步生成器可能在另一个上下文中结束
+            pass
+        span = self._span
+        if span.recording:
+            span.end_ns = time.time_ns()
+            if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+                span.status = "error"
+                span.attributes["error"] = f"{exc_type.__name__}: {exc}"
+            self._tracer.exporter.export(span)
+        return False
+
+
+class Tracer:
+    def __init__(self, exporter: RingBufferExporter = None, sample_rate: float = 1.0):
+        self.exporter = exporter or RingBufferExporter()
+        self.sample_rate = sample_rate
+
+    def _root(self, name: str, attributes: dict, traceparent: str = None):
+        match = _TRACEPARENT_RE.match(traceparent or "")
+        if match:
+            # 沿用上游传来的trace和采样决定
+            trace_id, parent_id, flags = match.groups()
+            if not int(flags, 16) & 1:
+                return NON_RECORDING
+            return Span(name, trace_id, parent_id, attributes)
+        if random.random() >= self.sample_rate:
+            return NON_RECORDING
+        return Span(name, os.urandom(16).hex(), None, attributes)
+
+    def span(self, name: str, traceparent: str = None, **attributes) -> _SpanScope:
+        """开始一个span；没有当前span时开始新的trace"""
+        parent = _current.get()
+        if parent is None:
+            span = self._root(name, attributes, traceparent)
+        elif not parent.recording:
+            span = NON_RECORDING
+        else:
+            span = Span(name, parent.trace_id, parent.span_id, attributes)
+        return _SpanScope(self, span)
+
+
+tracer = Tracer()
+
+
+def configure(sample_rate: float, max_spans: int):
+    """按配置设置采样率和缓冲大小"""
+    tracer.sample_rate = sample_rate
+    tracer.exporter = RingBufferExporter(max_spans)
+
+
+def span(name: str, **attributes) -> _SpanScope:
+    return tracer.span(name, **attributes)
+
+
+def current_span():
+    return _current.get() or NON_RECORDING
+
+
+def set_usage(span, model: str, response):
+    """把Gemini响应的模型名和token用量记到span上，model为None时取响应里的model_version"""
+    if not span.recording or response is None:
+        return
+    model = model or getattr(response, "model_version", None)
+    if model:
+        span.set_attribute("gen_ai.request.model", model)
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    if usage.prompt_token_count:
+        span.set_attribute("gen_ai.usage.input_tokens", usage.prompt_token_count)
+    if usage.candidates_token_count:
+        span.set_attribute("gen_ai.usage.output_tokens", usage.candidates_token_count)
+
+
+class TracingMiddleware:
+    """为每个HTTP请求创建根span，响应头带上 X-Trace-Id
+
+    使用纯ASGI中间件，流式响应发送完毕后根span才结束。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for key, value in scope.get("headers", []):
+            if key == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+
+        name = f"{scope['method']} {scope['path']}"
+        with tracer.span(name, traceparent=traceparent, **{"http.method": scope["method"],
+                                                            "http.target": scope["path"]}) as root:
+            async def send_with_trace(message):
+                if message["type"] == "http.response.start" and root.recording:
+                    root.set_attribute("http.status_code", message["status"])
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-trace-id", root.trace_id.encode()))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace)
@@ -0,0 +1,158 @@
+"""Gemini HTTP连接池
+
+所有LLM请求共用一组长连接：异步和同步各一个httpx连接池，开启HTTP/2多路复用
+（需要安装 h2，未安装时退回HTTP/1.1），共享同一个SSL上下文。连接保持时间和池大小
+按我们的并发量配置，突发流量时复用已建立的连接，不再重复DNS解析和TLS握手。
+启动时可以预先建立连接。
+"""
+import asyncio
+import logging
+import os
+import ssl
+
+import certifi
+import httpx
+
+from metrics import record_connection
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://generativelanguage.googleapis.com/"
+# 预建连接的超时（秒）：httpcore自身没有默认超时，上游卡住时不能拖住启动
+PREWARM_TIMEOUT = 5.0
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# httpcore trace事件 -> 计数名
+_TRACE_EVENTS = {
+    "connection.connect_tcp.complete": "connections",
+    "connection.start_tls.complete": "tls_handshakes",
+    "http11.send_request_headers.started": "http1_requests",
+    "http2.send_request_headers.started": "http2_requests",
+}
+
+
+def create_ssl_context() -> ssl.SSLContext:
+    """所有连接共用一个SSL上下文，证书只加载一次"""
+    return ssl.create_default_context(
+        cafile=os.environ.get("SSL_CERT_FILE", certifi.where()),
+        capath=os.environ.get("SSL_CERT_DIR"),
+    )
+
+
+class _TracedAsyncTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, owner, **kwargs):
+        super().__init__(**kwargs)
+        self._owner = owner
+
+    async def handle_async_request(self, request):
+        request.extensions["trace"] = self._owner._async_trace
+        return await super().handle_async_request(request)
+
+
+class _TracedTransport(httpx.HTTPTransport):
+    def __init__(self, owner, **kwargs):
+        super().__init__(**kwargs)
+        self._owner = owner
+
+    def handle_request(self, request):
+        request.extensions["trace"] = self._owner._trace
+        return super().handle_request(request)
+
+
+class LLMTransport:
+    """LLM请求共用的连接池"""
+
+    def __init__(self, http2: bool = True, max_connections: int = 64,
+                 max_keepalive: int = 20, keepalive_expiry: float = 120.0):
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("未安装h2，Gemini连接使用HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        ssl_context = create_ssl_context()
+        # 重试由 resilience.py 负责，连接池本身不重试
+        self.async_transport = _TracedAsyncTransport(
+            self, http2=http2, limits=limits, verify=ssl_context, retries=0
+        )
+        self.sync_transport = _TracedTransport(
+            self, http2=http2, limits=limits, verify=ssl_context, retries=0
+        )
+        self.counts = dict.fromkeys(_TRACE_EVENTS.values(), 0)
+
+    def _trace(self, event: str, info: dict):
+        name = _TRACE_EVENTS.get(event)
+        if name is not None:
+            self.counts[name] += 1
+            if name in ("connections", "tls_handshakes"):
+                record_connection(name)
+
+    async def _async_trace(self, event: str, info: dict):
+        self._trace(event, info)
+
+    def client_args(self) -> tuple[dict, dict]:
+        """返回传给SDK的 (client_args, async_client_args)"""
+        return {"transport": self.sync_transport}, {"transport": self.async_transport}
+
+    async def prewarm(self, base_url: str = None, connections: int = 1,
+                      timeout: float = PREWARM_TIMEOUT):
+        """预先建立连接（DNS解析、TCP和TLS握手），失败或超时只记录日志"""
+        url = base_url or DEFAULT_BASE_URL
+        # 直接调用transport时不经过httpx.Client，超时要放在请求的extensions里
+        extensions = {"timeout": {"connect": timeout, "read": timeout, "write": timeout, "pool": timeout}}
+
+        async def connect():
+            request = httpx.Request("HEAD", url, extensions=extensions)
+            response = await self.async_transport.handle_async_request(request)
+            await response.aclose()
+
+        try:
+            # DNS解析不受httpcore超时控制，整体再限定一次
+            results = await asyncio.wait_for(
+                asyncio.gather(*(connect() for _ in range(connections)), return_exceptions=True),
+                timeout * 2,
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"预建Gemini连接超时（{timeout * 2:.0f}s），跳过")
+            return
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            logger.warning(f"预建Gemini连接失败 ({len(errors)}/{connections}): {errors[0]!r}")
+        else:
+            logger.info(f"已预建 {connections} 个Gemini连接")
+
+    def pool_stats(self, sync: bool = False) -> dict:
+        """连接池当前状态；sync=True 时为thread模式使用的同步连接池"""
+        pool = (self.sync_transport if sync else self.async_transport)._pool
+        connections = pool.connections
+        idle = sum(1 for c in connections if c.is_idle())
+        queued = sum(1 for r in getattr(pool, "_requests", []) if r.is_queued())
+        return {
+            "connections": len(connections),
+            "active": len(connections) - idle,
+            "idle": idle,
+            # 等待空闲连接的请求数，持续大于0说明连接池已饱和
+            "queued": queued,
+            "max_connections": pool._max_connections,
+        }
+
+    def stats(self) -> dict:
+        return {
+            "http2": self.http2,
+            "async_pool": self.pool_stats(),
+            "sync_pool": self.pool_stats(sync=True),
+            **self.counts,
+        }
+
+    async def close(self):
+        await self.async_transport.aclose()
+        self.sync_transport.close()
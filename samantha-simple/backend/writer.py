@@ -0,0 +1,106 @@
+"""对话写入缓冲
+
+请求路径只把记录放进内存队列，后台任务按条数或时间阈值
+把记录攒成一批，用一次 executemany 事务写入数据库。
+"""
+import asyncio
+import logging
+
+from metrics import track
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationWriter:
+    """异步批量写入（write-behind）"""
+
+    def __init__(self, store, batch_size: int = 100, flush_interval: float = 0.05,
+                 max_pending: int = 10000, max_retries: int = 2):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._batch = []
+        self._task = None
+        self._inflight = None
+
+    @property
+    def pending(self) -> int:
+        """尚未写入的记录数"""
+        return self._queue.qsize() + len(self._batch)
+
+    def start(self):
+        """启动后台写入任务"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, user_id: int, message: str, response: str, emotion: str):
+        """提交一条记录；队列满时等待，形成反压"""
+        await self._queue.put((user_id, message, response, emotion))
+
+    async def stop(self):
+        """停止后台任务并写完剩余的记录"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        if self._inflight is not None:
+            await self._inflight
+            self._inflight = None
+        batch, self._batch = self._batch, []
+        await self._flush(batch)
+        while not self._queue.empty():
+            await self._flush(self._take(self.batch_size))
+        logger.info("写入缓冲已清空")
+
+    def _take(self, limit: int) -> list[tuple]:
+        items = []
+        while len(items) < limit and not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
+
+    async def _collect(self):
+        """等到第一条记录后，最多再等 flush_interval 凑满一批"""
+        self._batch.append(await self._queue.get())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(self._batch) < self.batch_size:
+            self._batch.extend(self._take(self.batch_size - len(self._batch)))
+            timeout = deadline - loop.time()
+            if len(self._batch) >= self.batch_size or timeout <= 0:
+                break
+            try:
+                self._batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def _run(self):
+        while True:
+            await self._collect()
+            batch, self._batch = self._batch, []
+            # 写入不受stop()取消影响，stop()会等它完成
+            self._inflight = asyncio.ensure_future(self._flush(batch))
+            await asyncio.shield(self._inflight)
+            self._inflight = None
+
+    async def _flush(self, batch: list[tuple]):
+        if not batch:
+            return
+        for attempt in range(self.max_retries + 1):
+            try:
+                with track("db_flush"):
+                    await self.store.save_conversations(batch)
+                logger.debug(f"批量写入 {len(batch)} 条对话")
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"批量写入失败，丢弃 {len(batch)} 条对话: {e}")
+                    return
+                logger.warning(f"批量写入失败，重试: {e}")
+                await asyncio.sleep(0.1 * (attempt + 1))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+批量对话命令行工具
+
+把一个文件里的消息分块提交给 /chat/batch，结果以NDJSON追加写入输出文件。
+输入可以是 .jsonl（每行包含 message，可选 user_id、id、history）
+或纯文本（每行一条消息）；没有id的条目用行号作为id。
+
+可以随时中断后重新运行：输出文件里已有的条目会跳过，
+服务端按job_id记录进度，同一块重新提交时不会重复处理已完成的条目。
+
+用法：
+    python batch_chat.py conversations.jsonl -o results.ndjson
+    python batch_chat.py messages.txt -o emotions.ndjson --task emotion --no-save
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import httpx
+
+RETRY_STATUS = {409, 429, 500, 502, 503, 504}
+
+
+def load_items(path: str) -> list[dict]:
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                item = json.loads(line)
+            else:
+                item = {"message": line}
+            item["id"] = str(item.get("id", lineno))
+            items.append(item)
+    return items
+
+
+def load_done(path: str) -> set:
+    """输出文件里已完成的条目id"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                continue
+    return done
+
+
+def default_job_id(path: str, task: str) -> str:
+    """按输入文件内容和任务类型生成稳定的job_id，重新运行时沿用"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return f"{task}-{digest.hexdigest()[:16]}"
+
+
+def submit(client: httpx.Client, url: str, payload: dict, out, retries: int, written: set) -> dict:
+    """提交一块，把结果写入输出文件，返回服务端的done汇总；失败时按指数退避重试
+
+    written 是输出文件里已有的条目id。中途断开后重试会重新提交整块，
+    服务端会重放已完成的条目，这些条目不再重复写入。
+    """
+    for attempt in range(retries + 1):
+        try:
+            with client.stream("POST", f"{url}/chat/batch", json=payload) as response:
+                if response.status_code in RETRY_STATUS and attempt < retries:
+                    raise httpx.HTTPStatusError("retry", request=response.request, response=response)
+                response.raise_for_status()
+                summary = None
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    kind = event.pop("event")
+                    if kind == "result":
+                        if event["id"] in written:
+                            continue
+                        out.write(json.dumps(event, ensure_ascii=False) + "\n")
+                        out.flush()
+                        written.add(event["id"])
+                    elif kind == "error":
+                        print(f"  ✗ {event['id']}: {event['error']}", file=sys.stderr)
+                    elif kind == "done":
+                        summary = event
+                if summary is None:
+                    raise httpx.RemoteProtocolError("响应在done之前结束")
+                return summary
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            if attempt >= retries:
+                raise
+            delay = min(2 ** attempt, 30)
+            print(f"  请求失败 ({e})，{delay}s 后重试", file=sys.stderr)
+            time.sleep(delay)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量提交消息到 /chat/batch")
+    parser.add_argument("input", help=".jsonl 或纯文本文件")
+    parser.add_argument("-o", "--output", required=True, help="结果输出文件（NDJSON，追加写入）")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--task", choices=("chat", "emotion"), default="chat")
+    parser.add_argument("--no-save", action="store_true", help="不把回复写入对话记录")
+    parser.add_argument("--job-id", default=None, help="默认按输入文件内容生成")
+    parser.add_argument("--chunk", type=int, default=1000, help="每次请求的条数")
+    parser.add_argument("--concurrency", type=int, default=None, help="服务端并发数，默认用服务端配置")
+    parser.add_argument("--retries", type=int, default=5)
+    args = parser.parse_args()
+
+    items = load_items(args.input)
+    done = load_done(args.output)
+    todo = [item for item in items if item["id"] not in done]
+    job_id = args.job_id or default_job_id(args.input, args.task)
+    print(f"任务 {job_id}: 共 {len(items)} 条，已完成 {len(items) - len(todo)} 条，待处理 {len(todo)} 条")
+
+    totals = {"completed": 0, "resumed": 0, "failed": 0}
+    started = time.time()
+    with httpx.Client(timeout=httpx.Timeout(30, read=None)) as client, \
+            open(args.output, "a", encoding="utf-8") as out:
+        for start in range(0, len(todo), args.chunk):
+            payload = {
+                "items": todo[start:start + args.chunk],
+                "job_id": job_id,
+                "task": args.task,
+                "save": not args.no_save,
+                "concurrency": args.concurrency,
+            }
+            summary = submit(client, args.url, payload, out, args.retries, done)
+            for key in totals:
+                totals[key] += summary[key]
+            print(f"  {min(start + args.chunk, len(todo))}/{len(todo)} "
+                  f"(新完成 {summary['completed']}，续跑 {summary['resumed']}，失败 {summary['failed']})")
+
+    elapsed = time.time() - started
+    print(f"完成: 新完成 {totals['completed']}，续跑 {totals['resumed']}，失败 {totals['failed']}，"
+          f"耗时 {elapsed:.1f}s")
+    return 1 if totals["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
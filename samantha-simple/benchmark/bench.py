@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Samantha AI 压测脚本
+
+启动本地Gemini模拟服务和后端，按目标RPS以开环方式（到达时间不受响应快慢影响）
+压测 /chat、/chat/stream 和 /history，报告p50/p95/p99延迟、吞吐量和错误率，
+并与保存的基线比较，出现退化时以非零状态退出。
+
+用法：
+    python bench.py                          # 默认参数，与 baseline.json 比较
+    python bench.py --rps 50 --duration 60   # 调整负载
+    python bench.py --save-baseline          # 把本次结果保存为新基线
+    python bench.py --url http://localhost:8000 --scenarios history   # 压测已运行的服务
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(os.path.dirname(BENCH_DIR), "backend")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+SCENARIOS = ("chat", "stream", "history")
+MESSAGES = [
+    "你好，Samantha！",
+    "今天工作好累，什么都不想做",
+    "我刚刚拿到了offer，太开心了！",
+    "为什么总是有人插队，气死我了",
+    "周末想去海边走走，有什么建议吗",
+    "最近睡眠不太好，晚上总是醒",
+    "给我讲一个轻松一点的小故事吧",
+    "我在准备考试，有点紧张",
+]
+
+
+def percentile(values: list, q: float) -> float:
+    """线性插值的分位数，q取0~100"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+class Result:
+    __slots__ = ("latency", "ttfb", "ok", "error")
+
+    def __init__(self, latency: float, ok: bool, ttfb: float = None, error: str = None):
+        self.latency = latency
+        self.ttfb = ttfb
+        self.ok = ok
+        self.error = error
+
+
+def _message(i: int) -> str:
+    # 加上序号避免命中回复缓存
+    return f"{random.choice(MESSAGES)} ({i})"
+
+
+async def request_chat(client: httpx.AsyncClient, i: int, users: int) -> Result:
+    start = time.perf_counter()
+    response = await client.post("/chat", json={"message": _message(i), "user_id": random.randint(1, users)})
+    ok = response.status_code == 200
+    return Result(time.perf_counter() - start, ok, error=None if ok else str(response.status_code))
+
+
+async def request_stream(client: httpx.AsyncClient, i: int, users: int) -> Result:
+    start = time.perf_counter()
+    ttfb = None
+    done = False
+    body = {"message": _message(i), "user_id": random.randint(1, users)}
+    async with client.stream("POST", "/chat/stream?format=ndjson", json=body) as response:
+        if response.status_code != 200:
+            return Result(time.perf_counter() - start, False, error=str(response.status_code))
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            event = json.loads(line)["event"]
+            if event == "delta" and ttfb is None:
+                ttfb = time.perf_counter() - start
+            elif event == "done":
+                done = True
+    return Result(time.perf_counter() - start, done, ttfb=ttfb, error=None if done else "incomplete")
+
+
+async def request_history(client: httpx.AsyncClient, i: int, users: int) -> Result:
+    start = time.perf_counter()
+    response = await client.get(f"/history/{random.randint(1, users)}", params={"limit": 20})
+    ok = response.status_code == 200
+    return Result(time.perf_counter() - start, ok, error=None if ok else str(response.status_code))
+
+
+REQUESTS = {"chat": request_chat, "stream": request_stream, "history": request_history}
+
+
+async def _measure(send, client, i: int, users: int, scheduled: float) -> Result:
+    # 延迟从计划发送时刻算起，发送端落后时排队时间也计入（避免coordinated omission）
+    lag = time.perf_counter() - scheduled
+    try:
+        result = await send(client, i, users)
+    except Exception as e:
+        result = Result(time.perf_counter() - scheduled - lag, False, error=type(e).__name__)
+    result.latency += lag
+    if result.ttfb is not None:
+        result.ttfb += lag
+    return result
+
+
+async def open_loop(client: httpx.AsyncClient, scenario: str, rps: float, duration: float,
+                    users: int, poisson: bool = True) -> tuple[list, float]:
+    """按目标速率发送请求，不等待前一个请求完成；返回结果和实际耗时"""
+    send = REQUESTS[scenario]
+    tasks = []
+    start = time.perf_counter()
+    next_at = start
+    i = 0
+    while next_at < start + duration:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(_measure(send, client, i, users, next_at)))
+        i += 1
+        next_at += random.expovariate(rps) if poisson else 1 / rps
+    results = await asyncio.gather(*tasks)
+    return results, time.perf_counter() - start
+
+
+def summarize(results: list, elapsed: float, rps: float) -> dict:
+    ok = [r for r in results if r.ok]
+    latencies = [r.latency * 1000 for r in ok]
+    errors = {}
+    for r in results:
+        if not r.ok:
+            errors[r.error] = errors.get(r.error, 0) + 1
+    summary = {
+        "target_rps": rps,
+        "requests": len(results),
+        "ok": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "errors": errors,
+        "throughput": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        "max_ms": round(max(latencies), 1) if latencies else 0.0,
+    }
+    ttfbs = [r.ttfb * 1000 for r in ok if r.ttfb is not None]
+    if ttfbs:
+        summary["ttfb_p50_ms"] = round(percentile(ttfbs, 50), 1)
+        summary["ttfb_p95_ms"] = round(percentile(ttfbs, 95), 1)
+        summary["ttfb_p99_ms"] = round(percentile(ttfbs, 99), 1)
+    return summary
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """返回相对基线退化的指标说明"""
+    regressions = []
+    for scenario, current in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(scenario)
+        if base is None:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms", "ttfb_p50_ms", "ttfb_p95_ms", "ttfb_p99_ms"):
+            if key in base and key in current and current[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{scenario} {key}: {base[key]} -> {current[key]}")
+        if current["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{scenario} throughput: {base['throughput']} -> {current['throughput']}")
+        if current["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(f"{scenario} error_rate: {base['error_rate']} -> {current['error_rate']}")
+    return regressions
+
+
+def print_report(results: dict, baseline: dict = None):
+    columns = ("requests", "throughput", "error_rate", "p50_ms", "p95_ms", "p99_ms", "ttfb_p50_ms")
+    print()
+    print(f"{'scenario':<10}" + "".join(f"{c:>13}" for c in columns))
+    for scenario, summary in results["scenarios"].items():
+        print(f"{scenario:<10}" + "".join(f"{summary.get(c, '-'):>13}" for c in columns))
+        base = (baseline or {}).get("scenarios", {}).get(scenario)
+        if base:
+            print(f"{'  baseline':<10}" + "".join(f"{base.get(c, '-'):>13}" for c in columns))
+        if summary["errors"]:
+            print(f"  errors: {summary['errors']}")
+    print()
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"进程已退出: {' '.join(process.args)}")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"等待 {url} 超时")
+
+
+def start_services(args, workdir: str) -> list:
+    """启动Gemini模拟服务和后端，返回子进程列表"""
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "fake_gemini.py"),
+        "--port", str(args.fake_port),
+        "--latency-median", str(args.latency_median),
+        "--latency-p99", str(args.latency_p99),
+        "--tokens-per-second", str(args.tokens_per_second),
+        "--output-tokens", str(args.output_tokens),
+        "--error-rate", str(args.error_rate),
+        "--seed", str(args.seed),
+    ])
+    env = {
+        **os.environ,
+        "GEMINI_API_KEY": "benchmark",
+        "GEMINI_BASE_URL": f"http://127.0.0.1:{args.fake_port}",
+        "DB_PATH": os.path.join(workdir, "bench.db"),
+        "MEMORY_DIR": os.path.join(workdir, "memory"),
+    }
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    # 后端日志默认丢弃，避免刷屏；需要排查时用 --backend-log 保存
+    log = open(args.backend_log, "w") if args.backend_log else subprocess.DEVNULL
+    backend = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=log,
+        stderr=log,
+    )
+    processes = [fake, backend]
+    try:
+        _wait_ready(f"http://127.0.0.1:{args.fake_port}/stats", fake)
+        _wait_ready(f"http://127.0.0.1:{args.port}/health", backend)
+    except Exception:
+        stop_services(processes)
+        raise
+    return processes
+
+
+def stop_services(processes: list):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def run_benchmark(url: str, args) -> dict:
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=200)
+    timeout = httpx.Timeout(args.timeout)
+    scenarios = {}
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=timeout) as client:
+        for scenario in args.scenarios:
+            rps = args.history_rps if scenario == "history" else args.rps
+            if args.warmup > 0:
+                await open_loop(client, scenario, rps, args.warmup, args.users)
+            print(f"压测 {scenario}: {rps} RPS, {args.duration} 秒...")
+            results, elapsed = await open_loop(client, scenario, rps, args.duration, args.users,
+                                               poisson=not args.constant)
+            scenarios[scenario] = summarize(results, elapsed, rps)
+    return {
+        "config": {
+            "rps": args.rps,
+            "history_rps": args.history_rps,
+            "duration": args.duration,
+            "users": args.users,
+            "latency_median": args.latency_median,
+            "latency_p99": args.latency_p99,
+            "tokens_per_second": args.tokens_per_second,
+            "output_tokens": args.output_tokens,
+            "error_rate": args.error_rate,
+            "env": args.env,
+        },
+        "scenarios": scenarios,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Samantha AI 压测")
+    parser.add_argument("--url", help="压测已运行的服务，不启动模拟Gemini和后端")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--rps", type=float, default=20, help="/chat 和 /chat/stream 的目标RPS")
+    parser.add_argument("--history-rps", type=float, default=100, help="/history 的目标RPS")
+    parser.add_argument("--duration", type=float, default=20, help="每个场景的压测时长（秒）")
+    parser.add_argument("--warmup", type=float, default=3, help="每个场景正式计时前的预热时长（秒）")
+    parser.add_argument("--users", type=int, default=500, help="随机选取的用户数")
+    parser.add_argument("--constant", action="store_true", help="固定间隔发送，默认按泊松过程到达")
+    parser.add_argument("--timeout", type=float, default=30, help="单个请求的超时（秒）")
+    parser.add_argument("--port", type=int, default=8765, help="后端端口")
+    parser.add_argument("--fake-port", type=int, default=8766, help="Gemini模拟服务端口")
+    parser.add_argument("--latency-median", type=float, default=300, help="模拟Gemini首token延迟中位数（毫秒）")
+    parser.add_argument("--latency-p99", type=float, default=1200, help="模拟Gemini首token延迟p99（毫秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=80, help="模拟Gemini输出速度")
+    parser.add_argument("--output-tokens", type=int, default=40, help="模拟Gemini每条回复的token数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟Gemini注入错误的比例")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="传给后端的环境变量，可重复")
+    parser.add_argument("--backend-log", help="后端日志写入的文件")
+    parser.add_argument("--output", help="结果写入的JSON文件")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="比较用的基线文件")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基线")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许相对基线变差的比例")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        url = args.url
+        if url is None:
+            processes = start_services(args, workdir)
+            url = f"http://127.0.0.1:{args.port}"
+        try:
+            results = asyncio.run(run_benchmark(url, args))
+        finally:
+            stop_services(processes)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print_report(results)
+        print(f"基线已保存到 {args.baseline}")
+        return 0
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if baseline is None:
+        print("没有基线，跳过比较")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("⚠️ 相对基线出现退化：")
+        for line in regressions:
+            print(f"   {line}")
+        return 1
+    print("✅ 未发现相对基线的退化")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+本地Gemini模拟服务
+
+实现 generateContent、streamGenerateContent 和 cachedContents 三个REST接口，供压测使用。
+延迟、输出速度和错误率都可以配置：
+- 首token延迟服从对数正态分布，由中位数和p99确定
+- 输出按固定的token速率生成，流式接口逐段返回
+- 按比例注入429/500/503错误
+
+用法：
+    python fake_gemini.py --port 9000 --latency-median 300 --latency-p99 1200 --error-rate 0.01
+后端设置 GEMINI_BASE_URL=http://127.0.0.1:9000 即可使用。
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+EMOTIONS = ["happy", "sad", "angry", "calm", "neutral"]
+REPLY = "我明白你的感受，谢谢你愿意和我分享。无论发生什么，我都会在这里陪着你，我们可以慢慢聊。"
+ERROR_STATUS = {429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE"}
+# 每个token约等于的中文字数
+CHARS_PER_TOKEN = 1.5
+
+
+class FakeGemini:
+    """按配置生成模拟的Gemini响应"""
+
+    def __init__(self, latency_median: float = 300, latency_p99: float = 1200,
+                 tokens_per_second: float = 80, output_tokens: int = 40,
+                 error_rate: float = 0.0, error_codes=(429, 500, 503), seed: int = None):
+        # 对数正态分布：中位数为exp(mu)，p99为exp(mu + 2.326 * sigma)
+        self.mu = math.log(max(latency_median, 1) / 1000)
+        self.sigma = max(math.log(max(latency_p99, latency_median) / max(latency_median, 1)) / 2.326, 0.0)
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        # 上下文缓存：缓存名 -> (system instruction文本, token数)
+        self.caches = {}
+
+    def create_cache(self, body: dict) -> dict:
+        name = f"cachedContents/fake-{len(self.caches) + 1}"
+        system = _text(body.get("systemInstruction"))
+        tokens = _count_tokens(system)
+        self.caches[name] = (system, tokens)
+        return {"name": name, "model": body.get("model"), "usageMetadata": {"totalTokenCount": tokens}}
+
+    def system_text(self, body: dict) -> tuple[str, int]:
+        """返回 (system instruction文本, 来自缓存的token数)"""
+        cached = self.caches.get(body.get("cachedContent"))
+        if cached is not None:
+            return cached
+        return _text(body.get("systemInstruction")), 0
+
+    def first_token_delay(self) -> float:
+        return self.random.lognormvariate(self.mu, self.sigma)
+
+    def maybe_error(self):
+        """按错误率返回要注入的错误响应，否则返回None"""
+        self.requests += 1
+        if self.error_rate <= 0 or self.random.random() >= self.error_rate:
+            return None
+        self.errors += 1
+        code = self.random.choice(self.error_codes)
+        return JSONResponse(
+            status_code=code,
+            content={"error": {"code": code, "message": "injected by fake_gemini", "status": ERROR_STATUS.get(code, "UNKNOWN")}},
+        )
+
+    def answer(self, body: dict) -> str:
+        """按请求的prompt和结构化输出配置给出回复文本"""
+        system, _ = self.system_text(body)
+        prompt = "".join(_text(content) for content in body.get("contents", []))
+        generation_config = body.get("generationConfig") or {}
+        schema = generation_config.get("responseSchema") or {}
+        schema_type = str(schema.get("type", "")).upper()
+        if schema_type == "ARRAY":
+            # 批量情感分析：数组长度与prompt里的JSON数组相同
+            return json.dumps([self.random.choice(EMOTIONS) for _ in range(_array_length(prompt))])
+        if schema_type == "OBJECT":
+            return json.dumps({"emotion": self.random.choice(EMOTIONS), "response": self.reply_text()},
+                              ensure_ascii=False)
+        if "happy, sad, angry, calm, neutral" in system + prompt:
+            return self.random.choice(EMOTIONS)
+        return self.reply_text()
+
+    def reply_text(self) -> str:
+        length = int(self.output_tokens * CHARS_PER_TOKEN)
+        return (REPLY * (length // len(REPLY) + 1))[:length]
+
+    def generation_time(self, text: str) -> float:
+        if self.tokens_per_second <= 0:
+            return 0.0
+        return _count_tokens(text) / self.tokens_per_second
+
+
+def _text(content) -> str:
+    return "".join(part.get("text", "") for part in (content or {}).get("parts", []))
+
+
+def _count_tokens(text: str) -> int:
+    return max(1, int(len(text) / CHARS_PER_TOKEN))
+
+
+def _array_length(prompt: str) -> int:
+    match = re.search(r"\[.*\]", prompt, re.S)
+    if match:
+        try:
+            return len(json.loads(match.group(0)))
+        except ValueError:
+            pass
+    return 1
+
+
+def _response(text: str, prompt_tokens: int, output_tokens: int, model: str, finish: bool = True,
+              cached_tokens: int = 0) -> dict:
+    candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+    if finish:
+        candidate["finishReason"] = "STOP"
+    return {
+        "candidates": [candidate],
+        "usageMetadata": {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens,
+            **({"cachedContentTokenCount": cached_tokens} if cached_tokens else {}),
+        },
+        "modelVersion": model,
+    }
+
+
+def _prompt_tokens(fake: FakeGemini, body: dict) -> tuple[int, int]:
+    """返回 (prompt总token数, 其中来自上下文缓存的token数)"""
+    system, cached_tokens = fake.system_text(body)
+    tokens = _count_tokens(json.dumps(body.get("contents", []), ensure_ascii=False))
+    return tokens + (cached_tokens or (_count_tokens(system) if system else 0)), cached_tokens
+
+
+def create_app(fake: FakeGemini) -> FastAPI:
+    app = FastAPI(title="Fake Gemini")
+
+    @app.post("/{version}/models/{model_action}")
+    async def generate(version: str, model_action: str, request: Request):
+        model, _, action = model_action.partition(":")
+        body = await request.json()
+        await asyncio.sleep(fake.first_token_delay())
+        error = fake.maybe_error()
+        if error is not None:
+            return error
+
+        text = fake.answer(body)
+        prompt_tokens, cached_tokens = _prompt_tokens(fake, body)
+        if action != "streamGenerateContent":
+            await asyncio.sleep(fake.generation_time(text))
+            return _response(text, prompt_tokens, _count_tokens(text), model, cached_tokens=cached_tokens)
+
+        async def chunks():
+            # 每段约8个token，按token速率输出
+            step = max(1, int(8 * CHARS_PER_TOKEN))
+            pieces = [text[i:i + step] for i in range(0, len(text), step)]
+            for i, piece in enumerate(pieces):
+                if i:
+                    await asyncio.sleep(fake.generation_time(piece))
+                last = i == len(pieces) - 1
+                data = _response(piece, prompt_tokens, _count_tokens(text[:(i + 1) * step]), model,
+                                 finish=last, cached_tokens=cached_tokens)
+                yield f"data: {json.dumps(data, ensure_ascii=False)}\r\n\r\n"
+
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+    @app.post("/{version}/cachedContents")
+    async def create_cache(version: str, request: Request):
+        return fake.create_cache(await request.json())
+
+    @app.get("/stats")
+    async def stats():
+        return {"requests": fake.requests, "errors": fake.errors, "cached_contents": len(fake.caches)}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地Gemini模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-median", type=float, default=300, help="首token延迟中位数（毫秒）")
+    parser.add_argument("--latency-p99", type=float, default=1200, help="首token延迟p99（毫秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=80, help="输出速度，0表示立即返回")
+    parser.add_argument("--output-tokens", type=int, default=40, help="每条回复的token数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入错误的比例（0~1）")
+    parser.add_argument("--error-codes", default="429,500,503", help="注入的HTTP状态码，逗号分隔")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    fake = FakeGemini(
+        latency_median=args.latency_median,
+        latency_p99=args.latency_p99,
+        tokens_per_second=args.tokens_per_second,
+        output_tokens=args.output_tokens,
+        error_rate=args.error_rate,
+        error_codes=[int(code) for code in args.error_codes.split(",") if code],
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(fake), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Vercel入口冷启动分析
+
+在全新的Python进程中导入 api/index.py（或 vercel-deploy/api/index.py），
+分别测量 LAZY_INIT=true 和 false 时的导入耗时，用 -X importtime 列出最耗时的模块，
+并单独测量延迟初始化推迟到第一次请求时的开销。
+
+用法：
+    python profile_cold_start.py
+    python profile_cold_start.py --target vercel-deploy --runs 10 --top 20
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TARGETS = {
+    "api": os.path.join(ROOT, "api"),
+    "vercel-deploy": os.path.join(ROOT, "vercel-deploy", "api"),
+}
+
+# 在子进程中执行：计时导入index，并在延迟模式下计时第一次使用时的初始化
+PROBE = """
+import asyncio, json, time
+start = time.perf_counter()
+import index
+imported = time.perf_counter()
+init = getattr(index, "get_client", None) or getattr(index, "get_genai")
+init()
+asyncio.run(index.ensure_db())
+ready = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "first_use_ms": (ready - imported) * 1000}))
+"""
+
+
+def run_probe(directory: str, lazy: bool, importtime: bool = False) -> tuple[dict, str]:
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "LAZY_INIT": "true" if lazy else "false",
+            "PYTHONDONTWRITEBYTECODE": "1",
+            "TMPDIR": tmp,
+        }
+        command = [sys.executable]
+        if importtime:
+            command += ["-X", "importtime"]
+        command += ["-c", PROBE]
+        result = subprocess.run(command, cwd=directory, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "导入失败")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def parse_importtime(stderr: str) -> list[tuple[int, str]]:
+    """解析 -X importtime 的输出，返回 (累计微秒, 顶层包名)
+
+    统计index直接导入的模块，以及index导入之后（第一次使用时）在顶层导入的模块。
+    """
+    totals = {}
+    lines = [line for line in stderr.splitlines() if line.startswith("import time:") and "cumulative" not in line]
+    # importtime按导入完成的顺序输出，index的子模块出现在index那一行之前
+    index_at = next((i for i, line in enumerate(lines) if line.rstrip().endswith("| index")), len(lines))
+    for i, line in enumerate(lines):
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        package = name.strip().split(".")[0]
+        if package == "index":
+            continue
+        if (depth == 1 and i < index_at) or (depth == 0 and i > index_at):
+            totals[package] = totals.get(package, 0) + int(cumulative)
+    return sorted(((us, name) for name, us in totals.items()), reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vercel入口冷启动分析")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="vercel-deploy")
+    parser.add_argument("--runs", type=int, default=5, help="每种模式测量的次数，取中位数")
+    parser.add_argument("--top", type=int, default=15, help="列出最耗时的顶层包数量")
+    args = parser.parse_args()
+
+    directory = TARGETS[args.target]
+    print(f"📦 分析 {os.path.relpath(os.path.join(directory, 'index.py'), ROOT)}（{args.runs} 次取中位数）")
+    print()
+
+    try:
+        run_probe(directory, lazy=True)
+    except RuntimeError as e:
+        print(f"❌ 无法导入: {e}")
+        print("   请先安装该入口的依赖（requirements.txt）")
+        return 1
+
+    for lazy in (False, True):
+        samples = [run_probe(directory, lazy)[0] for _ in range(args.runs)]
+        import_ms = statistics.median(s["import_ms"] for s in samples)
+        first_use_ms = statistics.median(s["first_use_ms"] for s in samples)
+        mode = "LAZY_INIT=true " if lazy else "LAZY_INIT=false"
+        print(f"{mode}  导入 {import_ms:8.1f} ms   第一次使用时初始化 {first_use_ms:8.1f} ms")
+
+    print()
+    for lazy in (False, True):
+        _, stderr = run_probe(directory, lazy, importtime=True)
+        mode = "LAZY_INIT=true" if lazy else "LAZY_INIT=false"
+        print(f"⏱️ {mode} 时导入index最耗时的顶层包（含第一次使用时的导入）：")
+        for us, name in parse_importtime(stderr)[:args.top]:
+            print(f"   {us / 1000:8.1f} ms  {name}")
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
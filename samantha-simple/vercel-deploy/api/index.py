@@ -1,13 +1,37 @@
 import os
+import sys
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import google.genai as genai
-import sqlite3
+import threading
 from datetime import datetime
 
-# Gemini客户端
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY", "your-gemini-api-key-here"))
+# 对话存储使用后端的存储接口，由 STORAGE_BACKEND 选择 sqlite / postgres / memory。
+# storage.py 和 config.py 是 backend/ 中同名文件的副本，随入口一起部署（不依赖部署目录以外的文件），
+# 修改后端的这两个文件后要同步复制过来（backend/tests/test_vendored.py 会检查）。
+# Serverless实例只有/tmp可写，SQLite默认放在那里（实例回收后数据丢失）
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("DB_PATH", "/tmp/samantha.db")
+import storage
+
+# 延迟初始化：Gemini SDK的导入、客户端创建和建表都推迟到第一次用到时，
+# 缩短冷启动时间；之后同一实例的热调用复用已初始化的状态。
+# 设为false时在导入时全部完成（原来的行为）。
+LAZY_INIT = os.getenv("LAZY_INIT", "true").lower() == "true"
+
+_init_lock = threading.Lock()
+_client = None
+_db_ready = False
+
+def get_client():
+    """创建Gemini客户端，只在第一次调用时导入SDK"""
+    global _client
+    if _client is None:
+        with _init_lock:
+            if _client is None:
+                import google.genai as genai
+                _client = genai.Client(api_key=os.getenv("GEMINI_API_KEY", "your-gemini-api-key-here"))
+    return _client
 
 app = FastAPI(title="Samantha AI API", version="1.0.0")
 
@@ -35,44 +59,43 @@ class HistoryResponse(BaseModel):
     emotion: str
     created_at: str
 
-# 数据库路径（Vercel建议用内存或外部DB，演示用本地文件）
-DB_PATH = "/tmp/samantha.db"
+_store = None
 
-def init_db():
+def get_store():
+    """按配置创建对话存储，同一实例只创建一次"""
+    global _store
+    if _store is None:
+        with _init_lock:
+            if _store is None:
+                _store = storage.create_store()
+    return _store
+
+async def ensure_db():
+    """第一次读写数据库前建表，成功后同一实例不再重复；失败时返回503并带上原因"""
+    global _db_ready
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                message TEXT,
-                response TEXT,
-                emotion TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                name TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        cursor.execute("""
-            INSERT OR IGNORE INTO users (id, name) VALUES (1, 'Default User')
-        """)
-        conn.commit()
-        conn.close()
+        store = get_store()
+        if not _db_ready:
+            await store.init_schema()
+            _db_ready = True
     except Exception as e:
         print(f"数据库初始化失败: {e}")
+        raise HTTPException(status_code=503, detail=f"数据库不可用: {e}")
+    return store
+
+if not LAZY_INIT:
+    get_client()
+    get_store()
 
-init_db()
+@app.on_event("startup")
+async def startup():
+    if not LAZY_INIT:
+        await ensure_db()
 
 def analyze_emotion(text: str) -> str:
     try:
         prompt = f"分析以下文本的情感，只返回：happy, sad, angry, calm, neutral\n\n文本：{text}"
-        response = client.models.generate_content(
+        response = get_client().models.generate_content(
             model="gemini-1.5-flash",
             contents=prompt
         )
@@ -98,7 +121,7 @@ def generate_response(message: str, emotion: str) -> str:
 
 用户消息：{message}
 """
-        response = client.models.generate_content(
+        response = get_client().models.generate_content(
             model="gemini-1.5-flash",
             contents=prompt
         )
@@ -108,50 +131,36 @@ def generate_response(message: str, emotion: str) -> str:
         print(f"AI回复生成失败: {e}")
         return f"抱歉，我现在无法回应。请稍后再试。"
 
-def save_conversation(user_id: int, message: str, response: str, emotion: str):
+async def save_conversation(store, user_id: int, message: str, response: str, emotion: str):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO conversations (user_id, message, response, emotion)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, message, response, emotion))
-        conn.commit()
-        conn.close()
+        await store.save_conversation(user_id, message, response, emotion)
     except Exception as e:
         print(f"保存对话失败: {e}")
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
+    # 数据库不可用时在调用Gemini之前返回503
+    store = await ensure_db()
     try:
         emotion = analyze_emotion(request.message)
         response = generate_response(request.message, emotion)
-        save_conversation(request.user_id, request.message, response, emotion)
+        await save_conversation(store, request.user_id, request.message, response, emotion)
         return ChatResponse(response=response, emotion=emotion)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/history/{user_id}", response_model=list[HistoryResponse])
 async def get_history(user_id: int, limit: int = 50):
+    store = await ensure_db()
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT message, response, emotion, created_at
-            FROM conversations
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-            LIMIT ?
-        """, (user_id, limit))
-        results = cursor.fetchall()
-        conn.close()
+        rows = await store.get_history(user_id, limit)
         history = [
             HistoryResponse(
-                message=row[0],
-                response=row[1],
-                emotion=row[2],
-                created_at=row[3]
-            ) for row in results
+                message=row["message"],
+                response=row["response"],
+                emotion=row["emotion"],
+                created_at=str(row["created_at"])
+            ) for row in rows
         ]
         return history
     except Exception as e: